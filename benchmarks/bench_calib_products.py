@@ -0,0 +1,82 @@
+""" Compare the legacy and memory-mappable master calibration layouts.
+
+For the 16 ccds of a processed day, the master bias and flats are read with
+the legacy reader (ztfimg.CCD.from_filename) and, after conversion to the
+"mmap" layout (see ztfin2p3.io.write_calib_product) in a temporary
+directory, with read_calib_product(memmap=True). Each read is followed by
+the detrending arithmetic applied to a fake raw ccd.
+
+Usage
+-----
+python benchmarks/bench_calib_products.py 20190404 --filtername zr
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import ztfimg
+
+from ztfin2p3.io import (get_daily_biasfile, get_daily_flatfile,
+                         read_calib_product, write_calib_product)
+
+
+def detrend(raw, bias, flat):
+    out = raw - bias
+    out /= flat
+    return out
+
+
+def run(files, reader, raw):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for biasfile, flatfile in files:
+        detrend(raw, reader(biasfile), reader(flatfile))
+    timing = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timing, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("day", help="processed day (YYYYMMDD)")
+    parser.add_argument("--filtername", default="zr")
+    parser.add_argument("--tmpdir", default=None)
+    args = parser.parse_args()
+
+    files = [(get_daily_biasfile(args.day, ccdid),
+              get_daily_flatfile(args.day, ccdid, filtername=args.filtername))
+             for ccdid in range(1, 17)]
+    raw = np.random.default_rng(0).normal(
+        1000, 10, size=ztfimg.CCD.SHAPE).astype("float32")
+
+    def legacy_reader(filename):
+        return ztfimg.CCD.from_filename(filename, as_path=True).get_data()
+
+    def mmap_reader(filename):
+        return read_calib_product(filename, memmap=True)[0]
+
+    timing, peak = run(files, legacy_reader, raw)
+    print(f"legacy fits : {timing:7.2f} s, peak {peak / 1024**2:8.1f} MiB")
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        mmap_files = []
+        for biasfile, flatfile in files:
+            pair = []
+            for filename in (biasfile, flatfile):
+                data, header = read_calib_product(filename, memmap=False)
+                fileout = os.path.join(tmpdir, os.path.basename(filename))
+                pair.append(write_calib_product(fileout, data, header=header,
+                                                product_format="mmap"))
+            mmap_files.append(pair)
+
+        timing, peak = run(mmap_files, mmap_reader, raw)
+        print(f"mmap layout : {timing:7.2f} s, peak {peak / 1024**2:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
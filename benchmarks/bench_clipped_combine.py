@@ -0,0 +1,74 @@
+""" Compare astropy's sigma_clip and the median/std clipping kernel.
+
+A synthetic [nimages, 6144, 6160] float32 stack is combined with the
+calib configuration (sigma=3, maxiters=1, median/std, nanmedian) using
+astropy.stats.sigma_clip (legacy path of get_meandata) and
+ztfin2p3.builder.sigma_clip_median_std, both on the full stack and by
+strips through get_tiled_meandata.
+
+Usage
+-----
+python benchmarks/bench_clipped_combine.py --nimages 20
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from astropy.stats import sigma_clip
+
+from ztfin2p3.builder import get_tiled_meandata, sigma_clip_median_std
+
+SHAPE = (6144, 6160)
+CLIPPING_PROP = dict(sigma=3, maxiters=1, cenfunc="median", stdfunc="std",
+                     masked=False, axis=0)
+
+
+def legacy(datas):
+    return np.nanmedian(sigma_clip(datas, copy=True, **CLIPPING_PROP), axis=0)
+
+
+def kernel(datas):
+    return np.nanmedian(sigma_clip_median_std(datas, sigma=3, axis=0), axis=0)
+
+
+def tiled(datas, max_bytes):
+    return get_tiled_meandata(datas, sigma_clip=3, mergedhow="nanmedian",
+                              clipping_prop=CLIPPING_PROP, max_bytes=max_bytes)
+
+
+def run(func, *args):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = func(*args)
+    timing = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, timing, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nimages", type=int, default=20)
+    parser.add_argument("--max-bytes", type=int, default=1024**3,
+                        help="memory budget of the tiled combine")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    datas = rng.normal(1000, 10, size=(args.nimages, *SHAPE)).astype("float32")
+    datas[rng.random(datas.shape, dtype="float32") < 1e-3] += 500
+
+    reference, timing, peak = run(legacy, datas)
+    print(f"astropy sigma_clip : {timing:7.2f} s, peak {peak / 1024**3:6.2f} GiB")
+
+    for name, func, args_ in [("kernel", kernel, (datas,)),
+                              ("tiled kernel", tiled, (datas, args.max_bytes))]:
+        out, timing, peak = run(func, *args_)
+        diff = np.nanmax(np.abs(out - reference))
+        print(f"{name:18s} : {timing:7.2f} s, peak {peak / 1024**3:6.2f} GiB, "
+              f"max |diff| {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
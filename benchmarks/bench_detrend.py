@@ -0,0 +1,110 @@
+""" Compare the legacy and in-place detrending arithmetic of build_science_data.
+
+A synthetic raw ccd is detrended with a synthetic bias and flat, first with
+the legacy arithmetic (flat*flat_coef, -= bias, /= flat, *= fp norm and
+quadrant split through ztfimg.CCD), then with
+ztfin2p3.science.detrend_inplace with a precomputed flat correction and
+quadrant views. Both must give identical quadrants.
+
+The allocations per exposure are counted as the number of full ccd frames
+allocated, line by line, by each detrending (tracemalloc), on top of the
+raw data copy.
+
+Usage
+-----
+python benchmarks/bench_detrend.py --nexposures 20
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import ztfimg
+
+from ztfin2p3.science import _split_quadrants, detrend_inplace
+
+
+def legacy(raw, bias, flat, flat_coef, fp_flat_norm):
+    calib_data = raw.copy()  # rawccd.get_data() returns a new array
+    flat_data = flat.copy()  # flat.get_data()
+    flat_data *= flat_coef
+    calib_data -= bias
+    calib_data /= flat_data
+    calib_data *= fp_flat_norm
+    sciccd = ztfimg.CCD.from_data(calib_data)
+    return sciccd.get_quadrantdata(from_data=True, reorder=False)
+
+
+def inplace(raw, bias, flat_data, fp_flat_norm):
+    calib_data = raw.copy()  # rawccd.get_data() returns a new array
+    detrend_inplace(calib_data, bias, flat_data, fp_flat_norm)
+    return _split_quadrants(calib_data)
+
+
+def timeit(func, nexposures, *args):
+    t0 = time.perf_counter()
+    for _ in range(nexposures):
+        func(*args)
+    return (time.perf_counter() - t0) / nexposures
+
+
+def count_allocations(func, framesize, *args):
+    """ number of frames allocated by func, measured after each of its lines """
+    count = 0
+
+    def _local(frame, event, arg):
+        nonlocal count
+        if event in ("line", "return"):
+            _, peak = tracemalloc.get_traced_memory()
+            count += round(peak / framesize)
+            tracemalloc.stop() # restart the peak at this line
+            tracemalloc.start()
+        return _local
+
+    def _global(frame, event, arg):
+        return _local if frame.f_code is func.__code__ else None
+
+    tracemalloc.start()
+    sys.settrace(_global)
+    try:
+        func(*args)
+    finally:
+        sys.settrace(None)
+        tracemalloc.stop()
+    return count - 1 # the raw data copy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nexposures", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = ztfimg.CCD.SHAPE
+    raw = rng.normal(1000, 10, size=shape).astype("float32")
+    bias = rng.normal(200, 1, size=shape).astype("float32")
+    flat = rng.normal(1, 0.01, size=shape).astype("float32")
+    flat_coef, fp_flat_norm = 1.02, 0.98
+    framesize = raw.nbytes
+
+    t0 = time.perf_counter()
+    flat_data = flat * flat_coef # once per flat, see get_flat_scale
+    print(f"flat correction (once per flat): {(time.perf_counter() - t0) * 1e3:8.1f} ms")
+
+    expected = legacy(raw, bias, flat, flat_coef, fp_flat_norm)
+    quads = inplace(raw, bias, flat_data, fp_flat_norm)
+    assert all(np.array_equal(quad, np.asarray(quad_)) for quad, quad_ in zip(quads, expected))
+    print("in-place quadrants identical to the legacy ones")
+
+    for name, func, args_ in [("legacy", legacy, (raw, bias, flat, flat_coef, fp_flat_norm)),
+                              ("inplace", inplace, (raw, bias, flat_data, fp_flat_norm))]:
+        timing = timeit(func, args.nexposures, *args_)
+        nalloc = count_allocations(func, framesize, *args_)
+        print(f"{name:8s}: {timing * 1e3:8.1f} ms/exposure, "
+              f"{nalloc} frame allocations/exposure")
+
+
+if __name__ == "__main__":
+    main()
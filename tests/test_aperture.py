@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ztfimg.base import Image
+
+from ztfin2p3 import catalog
+from ztfin2p3.aperture import get_aperture_photometry, get_batch_aperture_photometry
+
+
+class _Quadrant:
+    """ minimal science quadrant, 1 arcsec pixels. """
+    use_dask = False
+    shape = (200, 150)
+
+    def __init__(self, fieldid, rcid, ra, dec, seed):
+        self.header = {"FIELDID": fieldid, "RCID": rcid, "OBSMJD": 59000.}
+        self.ra, self.dec = ra, dec
+        rng = np.random.default_rng(seed)
+        self.data = rng.normal(100, 5, size=self.shape).astype("float32")
+
+    def get_header(self):
+        return self.header
+
+    def get_center(self, system="radec"):
+        return self.ra, self.dec
+
+    def add_coord_to_catalog(self, cat, coord="xy", in_fov=True):
+        cat = cat.copy()
+        cat["x"] = (cat["ra"] - self.ra) * 3600 + self.shape[1] / 2
+        cat["y"] = (cat["dec"] - self.dec) * 3600 + self.shape[0] / 2
+        if in_fov:
+            cat = cat[cat["x"].between(0, self.shape[1]) & cat["y"].between(0, self.shape[0])]
+        return cat
+
+    def get_data(self, apply_mask=True, rm_bkgd=True):
+        return self.data.copy()
+
+    def get_mask(self):
+        return np.zeros(self.shape, dtype=bool)
+
+    def get_noise(self, which="rms"):
+        return np.full(self.shape, 5, dtype="float32")
+
+    def get_aperture(self, x, y, radius, bkgann=None, data=None, mask=None,
+                     err=None, as_dataframe=False):
+        return Image._get_aperture(data, x, y, radius, bkgann=bkgann, err=err,
+                                   mask=mask, as_dataframe=as_dataframe)
+
+
+def _sky(fields=((150.0, 20.0), (10.0, -5.0)), nstars=60):
+    """ fixed sky catalog, stars around each field center """
+    rng = np.random.default_rng(1)
+    cats = []
+    for ra, dec in fields:
+        cat = pd.DataFrame({"ra": ra + rng.uniform(-150, 150, nstars) / 3600,
+                            "dec": dec + rng.uniform(-150, 150, nstars) / 3600,
+                            **{f"phot_{band}_mean_mag": rng.uniform(12, 18, nstars)
+                               for band in ["g", "bp", "rp"]}})
+        # neighbours just outside the first image do not count in its isolation.
+        cat.loc[0, ["ra", "dec"]] = ra + 70 / 3600, dec
+        cat.loc[1, ["ra", "dec"]] = ra + 80 / 3600, dec
+        cats.append(cat)
+    cat = pd.concat(cats, ignore_index=True)
+    cat.insert(0, "source_id", np.arange(len(cat)))
+    return cat
+
+
+SKY = _sky()
+
+
+def _refcatalog(ra, dec, radius, which, **kwargs):
+    inradius = np.hypot((SKY["ra"] - ra) * np.cos(np.deg2rad(dec)), SKY["dec"] - dec) <= radius
+    return SKY[inradius].reset_index(drop=True)
+
+
+@pytest.fixture
+def sciimgs(monkeypatch):
+    monkeypatch.setattr(catalog, "get_refcatalog", _refcatalog)
+    return [_Quadrant(600, 3, 150.0, 20.0, seed=0),
+            _Quadrant(601, 7, 10.0, -5.0, seed=1),
+            _Quadrant(600, 3, 150.0 + 5 / 3600, 20.0, seed=2)]
+
+
+def test_batch_aperture_photometry(sciimgs):
+    batch = get_batch_aperture_photometry(sciimgs, cat="gaia_dr3",
+                                          image_keys=["a", "b", "c"]).to_pandas()
+    assert batch.columns[0] == "image"
+    assert list(batch["image"].unique()) == ["a", "b", "c"]
+    for key, sciimg in zip(["a", "b", "c"], sciimgs):
+        expected = get_aperture_photometry(sciimg, cat="gaia_dr3")
+        apcat = batch[batch["image"] == key].drop(columns="image").reset_index(drop=True)
+        pd.testing.assert_frame_equal(apcat, expected)
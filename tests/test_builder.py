@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clip
+
+from ztfin2p3.builder import get_meandata, get_tiled_meandata, sigma_clip_median_std
+
+CLIPPING_PROP = dict(maxiters=1, cenfunc="median", stdfunc="std", masked=False)
+
+
+def _stack(nimages=20, shape=(64, 48), seed=0):
+    rng = np.random.default_rng(seed)
+    datas = rng.normal(1000, 10, size=(nimages, *shape)).astype("float32")
+    # outliers and invalid pixels
+    datas[rng.random(datas.shape) < 0.01] += 500
+    datas[3, 5, :] = np.nan
+    datas[:, 7, 7] = np.nan
+    return datas
+
+
+@pytest.mark.parametrize("sigma", [1, 2.5, 3])
+def test_sigma_clip_median_std(sigma):
+    datas = _stack()
+    expected = sigma_clip(datas.copy(), sigma=sigma, axis=0, **CLIPPING_PROP)
+    clipped = sigma_clip_median_std(datas, sigma=sigma, axis=0)
+    np.testing.assert_array_equal(np.isnan(clipped), np.isnan(expected))
+    np.testing.assert_allclose(clipped, expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("mergedhow", ["nanmean", "nanmedian"])
+def test_get_meandata_clip_kernel(mergedhow):
+    datas = _stack()
+    expected = getattr(np, mergedhow)(
+        sigma_clip(datas.copy(), sigma=3, axis=0, **CLIPPING_PROP), axis=0
+    )
+    mean = get_meandata(datas.copy(), sigma_clip=3, mergedhow=mergedhow,
+                        clipping_prop={**CLIPPING_PROP, "copy": False})
+    np.testing.assert_allclose(mean, expected, rtol=1e-6, equal_nan=True)
+
+
+def test_get_tiled_meandata(tmp_path):
+    datas = _stack(nimages=7)
+    corr = np.full(datas.shape[1:], 100, dtype="float32")
+    prop = dict(sigma_clip=3, mergedhow="nanmedian", clipping_prop=CLIPPING_PROP)
+    expected = get_meandata(datas - corr, **prop)
+    # a small budget forces one row per strip.
+    mean = get_tiled_meandata(list(datas), corr=corr, max_bytes=1, tmpdir=tmp_path, **prop)
+    np.testing.assert_allclose(mean, expected, rtol=1e-6, equal_nan=True)
+    assert list(tmp_path.iterdir()) == []
+
+
+class _Image:
+    def __init__(self, data):
+        self.data = data
+
+    def get_data(self, **kwargs):
+        return self.data.copy()
+
+
+@pytest.mark.parametrize("weights", [None, 2.0, "nanmedian"])
+def test_get_tiled_meandata_sources(tmp_path, weights):
+    datas = _stack(nimages=5)
+    corr = np.full(datas.shape[1:], 100, dtype="float32")
+    prop = dict(sigma_clip=3, mergedhow="nanmean", clipping_prop=CLIPPING_PROP)
+    fromdata = get_tiled_meandata([_Image(d) for d in datas], corr=corr, weights=weights,
+                                  max_bytes=1, tmpdir=tmp_path, **prop)
+    # memory-mapped arrays are read strip by strip
+    np.save(tmp_path / "stack.npy", datas)
+    stack = np.load(tmp_path / "stack.npy", mmap_mode="r")
+    fromarray = get_tiled_meandata(list(stack), corr=corr, weights=weights,
+                                   max_bytes=1, **prop)
+    np.testing.assert_array_equal(fromarray, fromdata)
+
+
+class _RawFrame:
+    """ ccd-sized float64 frame, generated when read """
+    def __init__(self, seed, shape=(6160, 6144)):
+        self.seed, self.shape = seed, shape
+
+    def get_data(self, **kwargs):
+        data = np.random.default_rng(self.seed).normal(1000, 10, size=self.shape)
+        data[::97, ::89] += 500 # outliers
+        return data
+
+
+def test_get_tiled_meandata_float32(tmp_path):
+    # float32 stacking of real-sized float64 frames vs float64 stacking.
+    frames = [_RawFrame(seed) for seed in range(5)]
+    prop = dict(sigma_clip=3, mergedhow="nanmedian", clipping_prop=CLIPPING_PROP,
+                tmpdir=tmp_path, max_bytes=64 * 1024**2)
+    mean32 = get_tiled_meandata(frames, dtype="float32", **prop)
+    mean64 = get_tiled_meandata(frames, dtype="float64", **prop)
+    assert mean32.dtype == mean64.dtype == "float64"
+    # float32 rounding (2 eps), except for the few pixels with a value on
+    # the clipping threshold within this rounding.
+    close = np.isclose(mean32, mean64, rtol=2.5e-7, atol=0)
+    assert close.mean() > 1 - 1e-5
+
+
+def test_get_tiled_meandata_scratch(tmp_path):
+    frames = [_RawFrame(seed, shape=(64, 48)) for seed in range(3)]
+    with pytest.raises(ValueError, match="max_scratch_bytes"):
+        get_tiled_meandata(frames, tmpdir=tmp_path, max_scratch_bytes=3 * 64 * 48 * 4 - 1)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_get_tiled_meandata_noimage():
+    with pytest.raises(ValueError, match="no images"):
+        get_tiled_meandata([])
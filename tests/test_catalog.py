@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+import astropy.units as u
+from astropy.coordinates import Distance, SkyCoord
+from astropy.time import Time
+
+from ztfin2p3 import catalog
+from ztfin2p3.catalog import GAIA_DR3_EPOCH_MJD, propagate_proper_motion
+
+
+def _stars(nstars=500, seed=0):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, nstars)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-0.99, 0.99, nstars)))
+    pmra = rng.normal(0, 50, nstars)
+    pmdec = rng.normal(0, 50, nstars)
+    pmra[:5], pmdec[:5] = 5000, -3000 # high proper motion stars
+    parallax = rng.uniform(0.1, 50, nstars)
+    return ra, dec, pmra, pmdec, parallax
+
+
+def _separation_mas(ra1, dec1, ra2, dec2):
+    return SkyCoord(ra1, dec1, unit="deg").separation(
+        SkyCoord(ra2, dec2, unit="deg")).to_value("mas")
+
+
+@pytest.mark.parametrize("mjd", [58200.3, 59900.7])
+def test_propagate_proper_motion(mjd):
+    ra, dec, pmra, pmdec, _ = _stars()
+    c = SkyCoord(ra * u.deg, dec * u.deg,
+                 pm_ra_cosdec=pmra * u.mas / u.yr, pm_dec=pmdec * u.mas / u.yr,
+                 obstime=Time("J2016"))
+    expected = c.apply_space_motion(Time(mjd, format="mjd"))
+
+    ra_t, dec_t = propagate_proper_motion(ra, dec, pmra, pmdec,
+                                          Time(mjd, format="mjd").tdb.mjd)
+    sep = _separation_mas(ra_t, dec_t, expected.ra.deg, expected.dec.deg)
+    assert sep.max() < 0.1
+
+
+def test_propagate_proper_motion_parallax():
+    ra, dec, pmra, pmdec, parallax = _stars()
+    rv = np.random.default_rng(1).normal(0, 100, len(ra))
+    c = SkyCoord(ra * u.deg, dec * u.deg,
+                 distance=Distance(parallax=parallax * u.mas),
+                 pm_ra_cosdec=pmra * u.mas / u.yr, pm_dec=pmdec * u.mas / u.yr,
+                 radial_velocity=rv * u.km / u.s, obstime=Time("J2016"))
+    expected = c.apply_space_motion(Time(59900.7, format="mjd"))
+
+    ra_t, dec_t = propagate_proper_motion(ra, dec, pmra, pmdec,
+                                          Time(59900.7, format="mjd").tdb.mjd,
+                                          parallax=parallax, radial_velocity=rv)
+    sep = _separation_mas(ra_t, dec_t, expected.ra.deg, expected.dec.deg)
+    assert sep.max() < 1
+
+
+def test_propagate_proper_motion_epochs():
+    ra, dec, pmra, pmdec, _ = _stars(50)
+    mjds = np.array([GAIA_DR3_EPOCH_MJD, 58200.3, 59900.7])
+    ra_t, dec_t = propagate_proper_motion(ra, dec, pmra, pmdec, mjds)
+    assert ra_t.shape == dec_t.shape == (3, 50)
+    np.testing.assert_allclose(ra_t[0], ra, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(dec_t[0], dec, rtol=0, atol=1e-12)
+    for i, mjd in enumerate(mjds):
+        ra_i, dec_i = propagate_proper_motion(ra, dec, pmra, pmdec, mjd)
+        np.testing.assert_array_equal(ra_t[i], ra_i)
+        np.testing.assert_array_equal(dec_t[i], dec_i)
+
+
+def test_get_field_refcatalog_oversized(monkeypatch):
+    calls = []
+    def _get_refcatalog(ra, dec, radius, which, **kwargs):
+        calls.append(radius)
+        return pd.DataFrame({"ra": np.zeros(100), "dec": np.zeros(100)})
+
+    monkeypatch.setattr(catalog, "get_refcatalog", _get_refcatalog)
+    monkeypatch.setattr(catalog, "FIELD_CACHE", catalog.MetaDataCache(maxbytes=10))
+    monkeypatch.setattr(catalog, "_OVERSIZED_FIELDS", set())
+    assert len(catalog.get_field_refcatalog(600, 10, 20, "gaia_dr3")) == 100
+    # too large to be cached: not loaded again.
+    assert catalog.get_field_refcatalog(600, 10, 20, "gaia_dr3") is None
+    assert calls == [catalog.FIELD_RADIUS]
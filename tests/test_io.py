@@ -0,0 +1,41 @@
+import os
+
+import pandas as pd
+import pytest
+
+from ztfin2p3 import io
+
+
+@pytest.fixture
+def cal_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(io, "CAL_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _write_catalog(kind, rows):
+    filepath = io.get_calib_catalogfile(kind, 2019)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    pd.DataFrame(rows).to_parquet(filepath)
+
+
+def test_compact_calib_log_rebuild(cal_dir):
+    # legacy catalogs (no FILEPATH) of a day with a missing bias: 15 + 48 masters.
+    _write_catalog("bias", [dict(PERIOD="20190404", CCDID=ccdid, IMGTYPE="bias")
+                            for ccdid in range(1, 16)])
+    _write_catalog("flat", [dict(PERIOD="20190404", CCDID=ccdid, IMGTYPE="flat",
+                                 FILTRKEY=filtername)
+                            for ccdid in range(1, 17) for filtername in ["zg", "zr", "zi"]])
+
+    # the bias of ccd 1 is rebuilt.
+    filename = cal_dir / "bias.fits"
+    filename.write_bytes(b"")
+    io.append_calib_log("bias", str(filename), dict(PERIOD="20190404", CCDID=1, IMGTYPE="bias"))
+    assert io.compact_calib_log("bias", 2019) == 1
+
+    uncut = pd.read_parquet(io.get_calib_catalogfile("bias", 2019, uncut=True))
+    assert sorted(uncut["CCDID"]) == list(range(1, 16))
+    assert uncut.loc[uncut["CCDID"] == 1, "FILEPATH"].tolist() == [str(filename)]
+    # the day is still incomplete.
+    assert len(pd.read_parquet(io.get_calib_catalogfile("bias", 2019))) == 0
+    assert len(pd.read_parquet(io.get_calib_catalogfile("flat", 2019))) == 0
+    assert not os.path.exists(io.get_calib_logfile("bias", 2019))
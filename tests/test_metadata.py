@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+from astropy import time
+
+from ztfin2p3 import metadata
+from ztfin2p3.metadata import RawBiasMetaData
+
+
+def _monthly_metadata(ndays=10, seed=0):
+    rng = np.random.default_rng(seed)
+    obsdate = (pd.Timestamp("2019-04-01") +
+               pd.to_timedelta(np.sort(rng.uniform(0, ndays, 16 * ndays)), unit="D"))
+    data = pd.DataFrame({"obsdate": obsdate.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                         "obsjd": time.Time(obsdate.to_pydatetime()).jd,
+                         "ccdid": rng.integers(1, 17, len(obsdate)),
+                         "fid": rng.integers(1, 4, len(obsdate)),
+                         "filefracday": (obsdate.strftime("%Y%m%d").astype("int64") * 10**6 +
+                                         ((obsdate - obsdate.normalize()) / pd.Timedelta("1D")
+                                          * 10**6).astype("int64")),
+                         "field": 0,
+                         "filtercode": "zg",
+                         "imgtypecode": "b"})
+    # monthly files are not sorted by obsjd
+    return data.sample(frac=1, random_state=seed)
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata, "LOCALSOURCE", str(tmp_path))
+    monkeypatch.setattr(metadata, "MONTHLY_CACHE", metadata.MetaDataCache())
+
+    class _Handler(RawBiasMetaData):
+        @classmethod
+        def get_monthly_metadatafile(cls, year, month):
+            return str(tmp_path / f"rawbias_metadata_{int(year):04d}{int(month):02d}.parquet")
+
+    _monthly_metadata().to_parquet(_Handler.get_monthly_metadatafile(2019, 4))
+    return _Handler
+
+
+@pytest.mark.parametrize("columns", [None, ["fid"]])
+def test_metadatastore_roundtrip(handler, columns):
+    prop = dict(ccdid=[1, 2], columns=columns)
+    legacy = handler.get_metadata(["2019-04-03", "2019-04-07"], use_store=False, **prop)
+    handler.build_metadatastore(2019, 4)
+    assert handler.is_metadatastore_current(2019, 4)
+    store = handler.get_metadata(["2019-04-03", "2019-04-07"], use_store=True, **prop)
+    assert len(store) > 0
+    # the store is sorted by obsjd, the monthly index is kept.
+    pd.testing.assert_frame_equal(store.sort_index(), legacy.sort_index())
+
+
+def test_metadatastore_stale(handler):
+    handler.build_metadatastore(2019, 4)
+    # exposures added to the monthly file after the store build.
+    filepath = handler.get_monthly_metadatafile(2019, 4)
+    data = pd.concat([pd.read_parquet(filepath), _monthly_metadata(seed=1)],
+                     ignore_index=True)
+    data.to_parquet(filepath)
+    assert not handler.is_metadatastore_current(2019, 4)
+    store = handler.get_metadata(["2019-04-01", "2019-04-11"], use_store=True)
+    assert len(store) == len(data)
+
+
+def test_parse_metaheader_column_nullable_int():
+    column = metadata._parse_metaheader_column(pd.Series(["3", None, " 12", ""]))
+    assert column.dtype == "Int64"
+    hdr = metadata._typed_metaheader_to_header({"NMATCHES": column.iloc[2],
+                                                "SEEING": column.iloc[1]})
+    assert hdr["NMATCHES"] == 12 and isinstance(hdr["NMATCHES"], int)
+    assert "SEEING" not in hdr
+    # actual floats are kept as such.
+    assert metadata._parse_metaheader_column(pd.Series(["1.5", None])).dtype == "float64"
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+import ztfimg
+
+from ztfin2p3.io import get_daily_biasfile
+from ztfin2p3.science import CalibrationIndex, _split_quadrants, detrend_inplace
+
+
+def test_split_quadrants():
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000, 10, size=ztfimg.CCD.SHAPE).astype("float32")
+    expected = ztfimg.CCD.from_data(data).get_quadrantdata(from_data=True, reorder=False)
+    quads = _split_quadrants(data)
+    assert len(quads) == 4
+    for quad, expected_quad in zip(quads, expected):
+        assert np.shares_memory(quad, data)
+        np.testing.assert_array_equal(quad, np.asarray(expected_quad))
+
+
+def test_split_quadrants_stack():
+    data = np.arange(2 * 8 * 6, dtype="float32").reshape(2, 8, 6)
+    for i, image in enumerate(data):
+        for quad, quad_i in zip(_split_quadrants(data), _split_quadrants(image)):
+            np.testing.assert_array_equal(quad[i], quad_i)
+
+
+@pytest.mark.parametrize("fp_flat_norm", [None, 0.98])
+def test_detrend_inplace(fp_flat_norm):
+    rng = np.random.default_rng(1)
+    raw = rng.normal(1000, 10, size=(3, 130, 96)).astype("float32")
+    bias = rng.normal(200, 1, size=raw.shape[1:]).astype("float32")
+    flat = rng.normal(1, 0.01, size=raw.shape[1:]).astype("float32")
+    flat_data = flat * 1.02
+    flat_copy, bias_copy = flat_data.copy(), bias.copy()
+
+    # per-file arithmetic of build_science_data
+    expected = raw.copy()
+    expected -= bias
+    expected /= flat_data
+    if fp_flat_norm is not None:
+        expected *= fp_flat_norm
+
+    data = raw.copy()
+    out = detrend_inplace(data, bias, flat_data, fp_flat_norm, strip_rows=64)
+    assert out is data
+    assert np.array_equal(data, expected)
+    assert np.array_equal(flat_data, flat_copy) and np.array_equal(bias, bias_copy)
+
+
+def _calibration_index(tmp_path, periods):
+    for year, periods_ in periods.items():
+        filepath = CalibrationIndex(tmp_path).get_catalog_file("bias", year)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame({"PERIOD": periods_, "CCDID": 1}).to_parquet(filepath)
+    return CalibrationIndex(tmp_path)
+
+
+def test_calibration_index_resolve(tmp_path):
+    index = _calibration_index(tmp_path, {2019: ["20191230"], 2020: ["20200102"]})
+    # the time of the day is kept: 2019-12-31T23:00 is closer to 2020-01-02.
+    dates = ["2019-12-31T10:00", "2019-12-31T23:00"]
+    assert index.resolve(dates, 1) == [get_daily_biasfile("20191230", 1),
+                                       get_daily_biasfile("20200102", 1)]
+    # only the catalogs of the given years are searched.
+    assert index.resolve(dates, 1, years=[2019, 2019]) == [get_daily_biasfile("20191230", 1)] * 2
+    assert index.resolve(["2020-01-05"], 1, max_timedelta="1d", errors="coerce") == [None]
@@ -6,6 +6,9 @@ from ztfin2p3.scripts.calib import calib
 from ztfin2p3.scripts.parse_cal import parse_cal
 from ztfin2p3.scripts.slurm import run
 from ztfin2p3.scripts.catpipe import catpipe
+from ztfin2p3.scripts.field_refcats import field_refcats
+from ztfin2p3.scripts.convert_refcat import convert_refcat
+from ztfin2p3.scripts.metadata_store import metadata_store
 
 
 @click.group()
@@ -19,6 +22,9 @@ cli.add_command(d2a)
 cli.add_command(parse_cal)
 cli.add_command(run)
 cli.add_command(catpipe)
+cli.add_command(field_refcats)
+cli.add_command(convert_refcat)
+cli.add_command(metadata_store)
 
 
 if __name__ == "__main__":
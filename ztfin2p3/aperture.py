@@ -116,7 +116,9 @@ def get_aperture_photometry(sciimg, cat="gaia_dr2",
                                 bkgann=[10,11], 
                                 joined=True,
                                 refcat_radius=0.7,
-                                apply_proper_motion=False):
+                                apply_proper_motion=False,
+                                field_refcat=False,
+                                pm_method="astropy"):
     """ run  aperture photometry on science image given input catalog.
     
     Parameters
@@ -165,6 +167,16 @@ def get_aperture_photometry(sciimg, cat="gaia_dr2",
         should the returned aperture photometry catalog be joined
         with the input catalog ?
         ** WARNING dask_level='medium' & joined=True may failed due to serialization issues **
+
+    field_refcat: bool
+        = ignored if cat is not a str =
+        use the precomputed catalog of the image field and rcid
+        (see catalog.build_field_refcats), if it exists.
+
+    pm_method: str
+        = ignored if apply_proper_motion is False =
+        astropy (SkyCoord.apply_space_motion) or numpy
+        (catalog.propagate_proper_motion, faster).
         
     Returns
     -------
@@ -215,7 +227,9 @@ def get_aperture_photometry(sciimg, cat="gaia_dr2",
     
         cat = get_img_refcatalog(sciimg, cat, coord=coord, radius=refcat_radius, 
                                  apply_proper_motion=apply_proper_motion, 
-                                 mjd_cat=mjd_cat) # this handles dask.
+                                 mjd_cat=mjd_cat,
+                                 use_field_refcat=field_refcat,
+                                 pm_method=pm_method) # this handles dask.
         
         if columns is not None: #
             if coord == 'ij' : 
@@ -271,6 +285,169 @@ def get_aperture_photometry(sciimg, cat="gaia_dr2",
 
     return ap_dataframe
 
+def get_batch_aperture_photometry(sciimgs, cat="gaia_dr3", image_keys=None,
+                                  minimal_columns=True,
+                                  seplimit=20,
+                                  radius=np.linspace(2,10,9),
+                                  bkgann=[10,11],
+                                  refcat_radius=0.7,
+                                  apply_proper_motion=False,
+                                  field_refcat=False,
+                                  pm_method="astropy"):
+    """ run the aperture photometry on a batch of science images.
+
+    The images are grouped by (FIELDID, RCID): the reference catalog is
+    read once per group, the proper motion is applied to all the epochs
+    of the group at once. The apertures are measured by aperture_sums,
+    one sep.sum_circle call per image for all its stars and radii (sep
+    works on a single image, there is no cross-image kernel). As in
+    get_aperture_photometry,
+    the (self-)isolation is computed on the stars in the image; without
+    proper motion, it is computed once per set of stars of the group.
+
+    Parameters
+    ----------
+    sciimgs: list
+        ztfimg.ScienceQuadrant (not dasked), e.g. the quadrants of the
+        exposures of a d2a batch.
+
+    cat: str
+        name of a catalog accessible from get_refcatalog.
+
+    image_keys: list, None
+        key of each image, stored in the 'image' column. The image
+        index in sciimgs if None.
+
+    field_refcat: bool
+        use the precomputed catalog of the field and rcid
+        (see catalog.build_field_refcats), if it exists.
+
+    pm_method: str
+        = ignored if apply_proper_motion is False =
+        astropy or numpy (all epochs of a group at once).
+
+    minimal_columns, seplimit, radius, bkgann, refcat_radius, apply_proper_motion:
+        see get_aperture_photometry.
+
+    Returns
+    -------
+    pyarrow.Table
+        the joined catalogs (get_aperture_photometry format) of all
+        images, with the 'image' key as first column.
+    """
+    import pyarrow as pa
+    from astropy.time import Time
+    from .catalog import (FIELD_REFCAT_MARGIN, _KNOWN_COLUMNS, get_field_refcat,
+                          get_refcatalog, propagate_catalog, select_in_radius)
+
+    if image_keys is None:
+        image_keys = list(range(len(sciimgs)))
+    if len(image_keys) != len(sciimgs):
+        raise ValueError("image_keys and sciimgs must have the same length")
+
+    columns = None
+    if minimal_columns:
+        if cat in _MINIMAL_COLNAMES:
+            columns = _MINIMAL_COLNAMES[cat]
+        else:
+            warnings.warn(f"no minimal columns implemented for {cat}")
+
+    radius = np.atleast_1d(radius)[:,None] # broadcasting
+    headers = [sciimg.get_header() for sciimg in sciimgs]
+    groups = {}
+    for i, header in enumerate(headers):
+        groups.setdefault((int(header["FIELDID"]), int(header["RCID"])), []).append(i)
+
+    tables = [None] * len(sciimgs)
+    for (fieldid, rcid), indices in groups.items():
+        # - group catalog, before proper motion
+        refcat = get_field_refcat(fieldid, rcid, cat) if field_refcat else None
+        if refcat is None:
+            ra, dec = sciimgs[indices[0]].get_center("radec")
+            refcat = get_refcatalog(ra, dec, refcat_radius + FIELD_REFCAT_MARGIN, cat,
+                                    colnames=_KNOWN_COLUMNS.get(cat))
+
+        if apply_proper_motion:
+            mjds = [Time(headers[i]["OBSMJD"], format="mjd") for i in indices]
+            ras, decs = propagate_catalog(refcat, cat, mjds, pm_method=pm_method)
+
+        isolations = {} # stars of the image -> isolation
+
+        for k, i in enumerate(indices):
+            sciimg = sciimgs[i]
+            cat_ = refcat.copy()
+            if apply_proper_motion:
+                cat_["ra"], cat_["dec"] = ras[k], decs[k]
+
+            ra, dec = sciimg.get_center("radec")
+            cat_ = select_in_radius(cat_, ra, dec, refcat_radius)
+            cat_ = sciimg.add_coord_to_catalog(cat_, coord="xy", in_fov=True)
+            if columns is not None:
+                cat_ = cat_[columns]
+            if apply_proper_motion: # the positions differ between epochs
+                isolated = get_isolated(cat_, seplimit=seplimit)
+            else:
+                stars = cat_[["ra", "dec"]].to_numpy().tobytes()
+                if stars not in isolations:
+                    isolations[stars] = get_isolated(cat_, seplimit=seplimit)
+                isolated = isolations[stars]
+            cat_ = cat_.join(isolated)
+
+            data = sciimg.get_data(apply_mask=True, rm_bkgd=True) # cleaned image
+            apdata = aperture_sums(data, cat_["x"].values, cat_["y"].values, radius,
+                                   bkgann=bkgann, mask=sciimg.get_mask(),
+                                   err=sciimg.get_noise("rms"))
+
+            cat_ = cat_.reset_index(drop=True)
+            cat_ = cat_.astype({col : 'float32' for col in cat_.columns[cat_.dtypes == 'float64']})
+            apcat = cat_.join(_aperture_to_dataframe(apdata, radius.ravel()))
+            apcat.insert(0, "image", image_keys[i])
+            tables[i] = pa.Table.from_pandas(apcat, preserve_index=False)
+
+    return pa.concat_tables(tables)
+
+
+def aperture_sums(data, x, y, radius, bkgann=None, mask=None, err=None, subpix=0):
+    """ aperture photometry of one image (one sep.sum_circle call for all
+    the stars and radii), used by the batch photometry.
+
+    Parameters
+    ----------
+    data: 2d-array
+        image (a float32 copy is only made if needed).
+
+    x, y: array
+        aperture centers in pixels, [nstars].
+
+    radius: array
+        aperture radius in pixels, broadcastable with x ([nradius, 1]).
+
+    bkgann, mask, err, subpix:
+        see sep.sum_circle.
+
+    Returns
+    -------
+    array
+        (counts, counterr, flag) of size (3, nradius, nstars).
+    """
+    from sep import sum_circle
+    data = np.ascontiguousarray(data, dtype="float32")
+    return np.asarray(sum_circle(data, np.atleast_1d(x), np.atleast_1d(y), radius,
+                                 err=err, mask=mask, bkgann=bkgann, subpix=subpix))
+
+
+def _aperture_to_dataframe(apdata, radius):
+    """ aperture_sums output as get_aperture_photometry columns
+    (f_i, f_i_e, f_i_f and r_i for each radius). """
+    nradius = len(radius)
+    ap_dataframe = pandas.DataFrame({**{f'f_{k}': apdata[0, k] for k in range(nradius)},
+                                     **{f'f_{k}_e': apdata[1, k] for k in range(nradius)},
+                                     **{f'f_{k}_f': apdata[2, k] for k in range(nradius)}},
+                                    dtype="float32")
+    ap_dataframe[[f'r_{k}' for k in range(nradius)]] = radius.astype(np.uint8)
+    return ap_dataframe.astype({f'f_{k}_f': np.uint8 for k in range(nradius)})
+
+
 def store_aperture_catalog(cat, new_filename, **kwargs):
     """ store the given catalog into the new filename 
     
@@ -1,6 +1,11 @@
 """ Top level calibration builder class """
 
+import contextlib
 import copy
+import logging
+import os
+import shutil
+import tempfile
 import warnings
 
 import dask.array as da
@@ -11,6 +16,14 @@ from ztfimg import collection, CCD
 
 __all__ = ["CalibrationBuilder"]
 
+# default memory budget of the tiled stacking (see get_tiled_meandata)
+STACK_MAXBYTES = 1024**3
+# full-strip temporaries made by the strip reduction (clipping, nan-reduction)
+_STRIP_COPIES = 4
+# default maximum size of the scratch files of the tiled stacking
+# (the corrected raw frames of a ccd build, ~150MB per float32 frame).
+SCRATCH_MAXBYTES = 4 * 1024**3
+
 
 class CalibrationBuilder:  # /day /week /month
 
@@ -358,6 +371,11 @@ class CalibrationBuilder:  # /day /week /month
         chunkreduction=2,
         dask_on_header=False,
         get_data_props={},
+        tiled=None,
+        max_bytes=STACK_MAXBYTES,
+        tmpdir=None,
+        max_scratch_bytes=SCRATCH_MAXBYTES,
+        dtype="float32",
         **kwargs,
     ):
         """build the mean data.
@@ -399,6 +417,27 @@ class CalibrationBuilder:  # /day /week /month
         dask_on_header: bool
             should dask be used on header merging ?
 
+        tiled: bool, None
+            use the tiled stacking (see get_tiled_meandata) ?
+            None means tiled if the images are not dasked.
+
+        max_bytes: int
+            = ignored if not tiled =
+            memory budget of the tiled stacking.
+
+        tmpdir: str, None
+            = ignored if not tiled =
+            directory of the scratch files of the corrected raw frames
+            (None: system default).
+
+        max_scratch_bytes: int, None
+            = ignored if not tiled =
+            maximum size of the scratch files (None: no limit).
+
+        dtype: str
+            = ignored if not tiled =
+            dtype of the stacked frames (see get_tiled_meandata).
+
         **kwargs goes to self.imgcollection.get_meandata
 
         Returns
@@ -412,20 +451,38 @@ class CalibrationBuilder:  # /day /week /month
         """
 
         # This could be updated in the calibration function #
+        if isinstance(corr, CCD):
+            corr = corr.get_data()
+
+        if tiled is None:
+            tiled = not self.use_dask
 
-        data = self.imgcollection.get_data(
+        get_data_props = dict(
             corr_overscan=corr_overscan,
             corr_nl=corr_nl,
             corr_pocket=corr_pocket,
             **get_data_props,
         )
+        if tiled:
+            data = get_tiled_meandata(
+                self.imgcollection.images,
+                corr=corr,
+                get_data_props=get_data_props,
+                max_bytes=max_bytes,
+                tmpdir=tmpdir,
+                max_scratch_bytes=max_scratch_bytes,
+                dtype=dtype,
+                **kwargs,
+            )
+        else:
+            data = self.imgcollection.get_data(**get_data_props)
+            if corr is not None:
+                if isinstance(data, np.ndarray):
+                    data -= corr  # data is a fresh stack
+                else:
+                    data = data - corr
 
-        if corr is not None:
-            if isinstance(corr, CCD):
-                corr = corr.get_data()
-            data = data - corr
-
-        data = get_meandata(data, chunkreduction=chunkreduction, **kwargs)
+            data = get_meandata(data, chunkreduction=chunkreduction, **kwargs)
 
         if incl_header:
             header = self.build_header(keys=header_keys, use_dask=dask_on_header)
@@ -496,6 +553,14 @@ class CalibrationBuilder:  # /day /week /month
 
         return self._imgcollection
 
+    @property
+    def use_dask(self):
+        """are the images of the collection dasked ?"""
+        images = getattr(self.imgcollection, "images", None)
+        if not images:
+            return False
+        return bool(getattr(images[0], "use_dask", False))
+
     @property
     def data(self):
         """merged data.
@@ -638,8 +703,236 @@ def get_meandata(
 
         if use_dask:
             datas = datas.map_blocks(scipy_clipping, **clipping_prop)
+        elif _use_clip_kernel(clipping_prop):
+            datas = sigma_clip_median_std(
+                datas,
+                sigma=clipping_prop["sigma"],
+                sigma_lower=clipping_prop["sigma_lower"],
+                sigma_upper=clipping_prop["sigma_upper"],
+                axis=axis,
+                copy=clipping_prop.get("copy", True),
+            )
         else:
             datas = scipy_clipping(datas, **clipping_prop)
 
     # Let's go.
     return getattr(npda, mergedhow)(datas, axis=axis)  # npda.mean(datas, axis=axis)
+
+
+def sigma_clip_median_std(datas, sigma=3, sigma_lower=None, sigma_upper=None,
+                          axis=0, copy=True):
+    """single iteration median/std sigma clipping, clipped values set to NaN.
+
+    This is equivalent to astropy.stats.sigma_clip(datas, maxiters=1,
+    cenfunc="median", stdfunc="std", masked=False) without masked arrays:
+    values strictly below median - sigma_lower*std or above
+    median + sigma_upper*std are replaced by NaN.
+
+    Parameters
+    ----------
+    datas: array
+        data to be clipped (e.g. [nimages, N, M]).
+
+    sigma, sigma_lower, sigma_upper: float
+        clipping bounds in std. sigma_lower/upper default to sigma.
+
+    axis: int
+        axis along which median and std are computed.
+
+    copy: bool
+        if False, datas is clipped in place (must be float).
+
+    Returns
+    -------
+    array
+        clipped data.
+    """
+    sigma_lower = sigma if sigma_lower is None else sigma_lower
+    sigma_upper = sigma if sigma_upper is None else sigma_upper
+
+    dtype = np.result_type(datas, "float32")
+    datas = np.array(datas, dtype=dtype) if copy else np.asarray(datas, dtype=dtype)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # all-nan pixels
+        center = np.nanmedian(datas, axis=axis, keepdims=True)
+        std = np.nanstd(datas, axis=axis, keepdims=True)
+
+    lower = center - std * sigma_lower
+    upper = center + std * sigma_upper
+    del center, std
+
+    clipped = np.less(datas, lower)
+    clipped |= np.greater(datas, upper)
+    datas[clipped] = np.nan
+    return datas
+
+
+def _use_clip_kernel(clipping_prop):
+    """can sigma_clip_median_std replace astropy's sigma_clip for these options ?"""
+    return (clipping_prop.get("maxiters") == 1
+            and clipping_prop.get("cenfunc") == "median"
+            and clipping_prop.get("stdfunc") == "std"
+            and not clipping_prop.get("masked", True)
+            and not clipping_prop.get("grow", False)
+            and set(clipping_prop) <= {"sigma", "sigma_lower", "sigma_upper", "axis",
+                                       "maxiters", "cenfunc", "stdfunc", "masked",
+                                       "copy", "grow"})
+
+
+def get_tiled_meandata(
+    images,
+    corr=None,
+    get_data_props={},
+    weights=None,
+    max_bytes=STACK_MAXBYTES,
+    tmpdir=None,
+    max_scratch_bytes=SCRATCH_MAXBYTES,
+    dtype="float32",
+    **kwargs,
+):
+    """get the mean 2d-array of the images [nimages, N, M]->[N, M]
+    with a memory budget that does not depend on the number of images.
+
+    The images are reduced by strips of rows, each strip going through
+    get_meandata(), into a preallocated output. 2d-arrays (including
+    memory-mapped ones) are read strip by strip, with no full copy.
+    Images with a get_data() method (e.g. ztfimg.RawCCD) need the full
+    frame for their corrections (overscan, non-linearity, pocket): each
+    one is read and corrected once and spilled into a scratch
+    memory-mapped file the strips are then read from. The scratch size
+    (nimages frames of dtype, ~150MB per float32 ccd frame) is checked
+    against max_scratch_bytes and the free space of tmpdir before
+    anything is written.
+
+    The strips are stacked in dtype. float32 (default) halves the memory
+    and scratch of a float64 stacking, at the price of float32 rounding
+    of the stacked values (~1e-7 relative, see tests/test_builder.py).
+
+    Parameters
+    ----------
+    images: list
+        images with a get_data() method (e.g. ztfimg.RawCCD)
+        or 2d-arrays.
+
+    corr: 2d-array, None
+        correction subtracted to each image (e.g. bias).
+
+    get_data_props: dict
+        kwargs entering the images get_data().
+
+    weights: str, float or array
+        multiplicative weighting coef for individual images
+        (see get_meandata). A string is applied on each full image.
+
+    max_bytes: int
+        memory budget of the strip reduction.
+
+    tmpdir: str, None
+        directory of the scratch files (None: system default).
+        Only used by images with a get_data() method.
+
+    max_scratch_bytes: int, None
+        maximum size of the scratch files (None: no limit).
+
+    dtype: str
+        dtype of the strips (and scratch files), float32 or float64.
+        The output keeps the dtype of the input images.
+
+    **kwargs goes to get_meandata() (sigma_clip, mergedhow, clipping_prop)
+
+    Returns
+    -------
+    2d-array
+        mean image (numpy)
+
+    Raises
+    ------
+    ValueError
+        if there is no image to combine or if the scratch files would
+        exceed max_scratch_bytes.
+
+    OSError
+        if tmpdir does not have the space for the scratch files.
+
+    See also
+    --------
+    get_meandata: mean image of an in-memory stack.
+    """
+    nimages = len(images)
+    if nimages == 0:
+        raise ValueError("no images to combine")
+
+    if weights is None or isinstance(weights, str):
+        scales = np.ones(nimages)
+    else:
+        scales = np.broadcast_to(np.asarray(weights, dtype="float"), (nimages,)).copy()
+
+    with contextlib.ExitStack() as stack:
+        sources, corrected = [], []
+        scratchdir = None
+        for i, image in enumerate(images):
+            if hasattr(image, "get_data"):
+                data = np.asarray(image.get_data(**get_data_props))
+                if scratchdir is None:
+                    scratchdir = stack.enter_context(tempfile.TemporaryDirectory(dir=tmpdir))
+                    _check_scratch(scratchdir, max_scratch_bytes,
+                                   sum(hasattr(image_, "get_data") for image_ in images)
+                                   * data.size * np.dtype(dtype).itemsize)
+                source = np.lib.format.open_memmap(
+                    os.path.join(scratchdir, f"image_{i}.npy"), mode="w+",
+                    dtype=dtype, shape=data.shape,
+                )
+                if corr is not None: # no temporary frame
+                    np.subtract(data, corr, out=source, casting="unsafe")
+                else:
+                    source[:] = data
+                if isinstance(weights, str):
+                    scales[i] = getattr(np, weights)(source)
+                srcdtype = data.dtype
+                del data
+            else:
+                source = image
+                if isinstance(weights, str): # one frame at a time
+                    frame = np.asarray(source, dtype=dtype)
+                    if corr is not None:
+                        frame = frame - corr
+                    scales[i] = getattr(np, weights)(frame)
+                    del frame
+                srcdtype = source.dtype
+            if i == 0:
+                outdtype = srcdtype if srcdtype.kind == "f" else np.dtype("float64")
+            sources.append(source)
+            corrected.append(hasattr(image, "get_data"))
+
+        nrows, ncols = sources[0].shape
+        rowbytes = nimages * ncols * np.dtype("float64").itemsize * _STRIP_COPIES
+        strip_rows = int(np.clip(max_bytes // rowbytes, 1, nrows))
+
+        buffer = np.empty((nimages, strip_rows, ncols), dtype=dtype)
+        out = np.empty((nrows, ncols), dtype=outdtype)
+        for start in range(0, nrows, strip_rows):
+            rows = slice(start, start + strip_rows)
+            strip = buffer[:, :min(strip_rows, nrows - start)]
+            for i, source in enumerate(sources):
+                if corr is not None and not corrected[i]:
+                    np.subtract(source[rows], corr[rows], out=strip[i], casting="unsafe")
+                else:
+                    strip[i] = source[rows]
+                if scales[i] != 1:
+                    strip[i] *= scales[i]
+            out[rows] = get_meandata(strip, axis=0, chunkreduction=None, **kwargs)
+        del sources
+
+    return out
+
+
+def _check_scratch(scratchdir, max_scratch_bytes, nbytes):
+    """raise if nbytes of scratch files do not fit in scratchdir or max_scratch_bytes"""
+    if max_scratch_bytes is not None and nbytes > max_scratch_bytes:
+        raise ValueError(f"the scratch files need {nbytes} bytes, more than "
+                         f"max_scratch_bytes={max_scratch_bytes}")
+    free = shutil.disk_usage(scratchdir).free
+    if nbytes > free:
+        raise OSError(f"the scratch files need {nbytes} bytes, only {free} "
+                      f"are free in {scratchdir} (see tmpdir)")
+    logging.getLogger(__name__).debug("%d bytes of scratch files in %s", nbytes, scratchdir)
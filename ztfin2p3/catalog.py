@@ -14,8 +14,10 @@ cat = catalog.get_img_refcatalog(sci, "gaia_dr2")
 # if sci is delayed or use_dask cat will be a dask.dataframe
 """
 
+import logging
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import erfa
 import pandas as pd
@@ -23,6 +25,9 @@ import numpy as np
 
 from ztfquery.io import LOCALSOURCE
 
+from .io import atomic_output
+from .metadata import MetaDataCache
+
 IN2P3_LOCATION = "/sps/lsst/datasets/refcats/htm/v1/"
 #"/sps/lsst/datasets/refcats/htm/v1/"
 IN2P3_CATNAME = {"ps1":"ps1_pv3_3pi_20170110",
@@ -31,6 +36,38 @@ IN2P3_CATNAME = {"ps1":"ps1_pv3_3pi_20170110",
                  "gaia_dr3" : ""}
 
 
+# maximum memory of the catalog tiles and field catalogs kept in memory.
+TILE_CACHE_MAXBYTES = 2 * 1024**3
+FIELD_CACHE_MAXBYTES = 2 * 1024**3
+# radius (deg) of a field catalog, covering the 64 quadrants of a ZTF field.
+FIELD_RADIUS = 5.5
+
+# lsst refcats HTM trees converted to parquet (see convert_htm_catalog).
+HTM_PARQUET_LOCATION = os.path.join(LOCALSOURCE, "calibrator", "refcats_htm")
+# precomputed per-(field, rcid) catalogs (see build_field_refcats).
+FIELD_REFCAT_DIR = os.path.join(LOCALSOURCE, "calibrator", "field_refcats")
+# extra radius (deg) of the field refcats, absorbing the pointing scatter.
+FIELD_REFCAT_MARGIN = 0.1
+
+# Gaia DR3 reference epoch (J2016.0 = JD 2457389.0) in MJD.
+GAIA_DR3_EPOCH_MJD = 57388.5
+# astronomical unit in km.yr/s (radial proper motion of the space motion).
+_AU_KMYR_PER_S = 4.740470446
+
+# process-wide caches, shared by all the quadrants processed.
+TILE_CACHE = MetaDataCache(maxbytes=TILE_CACHE_MAXBYTES)
+FIELD_CACHE = MetaDataCache(maxbytes=FIELD_CACHE_MAXBYTES)
+# field catalogs larger than FIELD_CACHE (see get_field_refcatalog)
+_OVERSIZED_FIELDS = set()
+
+
+def get_cache_info():
+    """ statistics of the tile and field catalog caches """
+    return {"tiles": TILE_CACHE.info(), "fields": FIELD_CACHE.info()}
+
+
+logger = logging.getLogger(__name__)
+
 _KNOWN_COLUMNS = {"gaia_dr2": ['id', 'coord_ra', 'coord_dec',
                                'phot_g_mean_flux','phot_bp_mean_flux', 'phot_rp_mean_flux' ,
                                'phot_g_mean_fluxErr', 'phot_bp_mean_fluxErr',
@@ -50,9 +87,20 @@ _KNOWN_COLUMNS = {"gaia_dr2": ['id', 'coord_ra', 'coord_dec',
                                 'phot_rp_mean_mag', 'grvs_mag', 'phot_variable_flag', 'pix64'],
                      }
 
+# columns of the field refcats: those used by the aperture photometry
+# (+ proper motions).
+_FIELD_REFCAT_COLUMNS = {"gaia_dr2": ['id', 'ra', 'dec',
+                                      'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag'],
+                         "gaia_dr3": ['source_id', 'ra', 'dec', 'pmra', 'pmdec',
+                                      'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag'],
+                         "ps1": ['id', 'ra', 'dec',
+                                 'g_mag', 'r_mag', 'i_mag', 'z_mag', 'y_mag'],
+                         }
+
 
 def get_img_refcatalog(
-    img, which, coord="xy", radius=0.7, in_fov=True, enrich=True, **kwargs
+    img, which, coord="xy", radius=0.7, in_fov=True, enrich=True,
+    use_field_cache=False, use_field_refcat=False, **kwargs
 ):
     """fetch an lsst refcats catalog stored at the cc-in2p3 for a given a
     ztfimg image.
@@ -79,6 +127,19 @@ def get_img_refcatalog(
     radius: float
         radius of circle in degrees
 
+    use_field_cache: bool
+        = ignored if dask is used =
+        get the catalog of the whole field (see get_field_refcatalog) and
+        select the stars within radius, so that all the quadrants of a
+        field share a single catalog read. Fields whose catalog does not
+        fit in FIELD_CACHE are queried per image.
+
+    use_field_refcat: bool
+        = ignored if dask is used =
+        use the precomputed catalog of the image field and rcid
+        (see build_field_refcats) if it exists. It only contains
+        the columns of _FIELD_REFCAT_COLUMNS.
+
     **kwargs goes to get_refcatalog (columns etc.)
 
     Returns
@@ -94,7 +155,29 @@ def get_img_refcatalog(
     else:
         colnames = _KNOWN_COLUMNS[which].copy()
 
-    if not use_dask:
+    field_refcat = None
+    if not use_dask and use_field_refcat:
+        header = img.get_header()
+        field_refcat = get_field_refcat(header["FIELDID"], header["RCID"], which)
+        if field_refcat is None:
+            logger.warning("no field refcat for field %s rcid %s, querying %s",
+                           header["FIELDID"], header["RCID"], which)
+
+    field_cat = None
+    if field_refcat is None and not use_dask and use_field_cache:
+        header = img.get_header()
+        field_cat = get_field_refcatalog(header["FIELDID"], header["RAD"], header["DECD"],
+                                         which=which, enrich=enrich, colnames=colnames)
+        if field_cat is None:
+            logger.info("field %s catalog does not fit in FIELD_CACHE, querying %s",
+                        header["FIELDID"], which)
+
+    if field_refcat is not None or field_cat is not None:
+        ra, dec = img.get_center("radec") # centroid of the image
+        cat = select_in_radius(field_refcat if field_refcat is not None else field_cat,
+                               ra, dec, radius)
+        cat = _apply_catalog_proper_motion(cat, which, **kwargs)
+    elif not use_dask:
         ra, dec = img.get_center("radec") # centroid of the image
         cat = get_refcatalog(ra, dec, radius=radius,
                                  which=which, enrich=enrich,
@@ -142,6 +225,9 @@ def get_refcatalog(
     colnames=None,
     mjd_cat=None,
     apply_proper_motion=False,
+    use_cache=True,
+    max_workers=8,
+    pm_method="astropy",
 ):
     """fetch an lsst refcats catalog stored at the cc-in2p3.
 
@@ -168,12 +254,24 @@ def get_refcatalog(
     colnames: list
         names of columns to be considered.
 
+    use_cache: bool
+        keep the read tiles (gaia_dr3) or trixels in the process-wide
+        tile cache (TILE_CACHE) ?
+
+    max_workers: int
+        number of threads reading the uncached tiles or trixels.
+
+    pm_method: str
+        = gaia_dr3 only =
+        how the proper motion is applied:
+        - astropy: SkyCoord.apply_space_motion
+        - numpy: propagate_proper_motion (faster, linear propagation)
+
     Returns
     -------
     DataFrame
     """
-    from .utils.tools import get_htm_intersect, njy_to_mag
-    from astropy.table import Table
+    from .utils.tools import get_htm_intersect
 
     if which not in IN2P3_CATNAME:
         raise NotImplementedError(f" Only {list(IN2P3_CATNAME.keys())} CC-IN2P3 catalogs implemented ; {which} given")
@@ -181,79 +279,619 @@ def get_refcatalog(
     if which=='gaia_dr3':
         from .utils.tools import get_healpix_intersect
 
-        dirpath = os.path.join(LOCALSOURCE, "calibrator", "gaia_dr3_astro")
         pix_id = get_healpix_intersect(ra, dec, radius, nside=64)
         if colnames is None:
             colnames = _KNOWN_COLUMNS[which]
 
-        cat = [pd.read_parquet(os.path.join(dirpath, f"gaiadr3_pix64_{healpix_i}.parquet"),
-                                   columns=colnames)
-               for healpix_i in pix_id]
-        cat = pd.concat(cat).reset_index(drop=True)
-
-        if apply_proper_motion:
-            # nan pms are replaced by 0 so that we don't loose these stars
-            cat.loc[cat.pmdec.isna(),'pmdec']=0
-            cat.loc[cat.pmra.isna(),'pmra']=0
-
-            from astropy.time import Time
-            import astropy.units as u
-            from astropy.coordinates import SkyCoord
-
-            c = SkyCoord(
-                cat.ra.values,
-                cat.dec.values,
-                unit=(u.deg, u.deg),
-                equinox="J2000",
-                pm_ra_cosdec=cat.pmra.values * u.mas / u.yr,
-                pm_dec=cat.pmdec.values * u.mas / u.yr,
-                obstime=Time("J2016"),
-            )
-            if mjd_cat is None:
-                raise ValueError("mjd_cat is None here, it should be the data to which we want to move the position using proper motion (in MJD)")
-            else:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", erfa.ErfaWarning)
-                    c_obs_epoch = c.apply_space_motion(mjd_cat)
-                cat['dec']=c_obs_epoch.dec.deg
-                cat['ra']=c_obs_epoch.ra.deg
+        cat = get_gaia_tiles(pix_id, colnames, nside=64, use_cache=use_cache,
+                             max_workers=max_workers)
+        cat = _apply_catalog_proper_motion(cat, which, mjd_cat=mjd_cat,
+                                           apply_proper_motion=apply_proper_motion,
+                                           pm_method=pm_method)
 
     else:
-        if apply_proper_motion:
-            raise NotImplementedError(
-                f"Only gaia_dr3 catalog can handle proper motion for now. {which} given"
-            )
+        _apply_catalog_proper_motion(None, which, apply_proper_motion=apply_proper_motion)
 
         hmt_id = get_htm_intersect(ra, dec, radius, depth=7)
+        cat = get_htm_trixels(which, hmt_id, colnames=colnames, enrich=enrich,
+                              use_cache=use_cache, max_workers=max_workers)
+
+    return cat
+
+
+def get_gaia_tiles(pix_ids, columns, nside=64, use_cache=True, max_workers=8):
+    """read the Gaia DR3 healpix tiles (gaiadr3_pix{nside}_{pix}.parquet).
+
+    Tiles are kept in the process-wide TILE_CACHE, keyed on
+    (nside, pix, columns), and the uncached ones are read concurrently.
+
+    Parameters
+    ----------
+    pix_ids: list
+        healpix pixels.
+
+    columns: list
+        columns to be read.
+
+    nside: int
+        healpix nside of the tiles.
+
+    use_cache: bool
+        use the tile cache ?
+
+    max_workers: int
+        number of reading threads.
+
+    Returns
+    -------
+    DataFrame
+        concatenated tiles.
+    """
+    dirpath = os.path.join(LOCALSOURCE, "calibrator", "gaia_dr3_astro")
+    columns = list(columns)
+
+    def _read(pix):
+        filepath = os.path.join(dirpath, f"gaiadr3_pix{nside}_{pix}.parquet")
+        def _loader():
+            return pd.read_parquet(filepath, columns=columns)
+        if not use_cache:
+            return _loader()
+        return TILE_CACHE.get((nside, int(pix), tuple(columns)), filepath, _loader)
+
+    tiles = _map_threads(_read, pix_ids, max_workers)
+    # a new dataframe: the cached tiles are never modified.
+    return pd.concat(tiles).reset_index(drop=True)
+
+
+def _map_threads(func, items, max_workers):
+    """list(map(func, items)), on a thread pool if worth it."""
+    items = list(items)
+    if len(items) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+    return [func(item) for item in items]
+
+
+# =============== #
+#  HTM refcats    #
+# =============== #
+def get_trixel_filepath(which, htm_id, fmt="parquet"):
+    """path of an HTM trixel of a lsst refcats catalog.
+
+    Parameters
+    ----------
+    which: str
+        Name of the catalog (see get_refcatalog).
+
+    htm_id: int
+        HTM trixel id (depth 7).
+
+    fmt: str
+        - fits: original trixel, in $ZTFREFCAT (default IN2P3_LOCATION)
+        - parquet: converted trixel (see convert_htm_catalog), in
+          $ZTFREFCAT_PARQUET (default HTM_PARQUET_LOCATION)
+
+    Returns
+    -------
+    str
+    """
+    if fmt == "fits":
         catpath = os.getenv("ZTFREFCAT", IN2P3_LOCATION)
-        dirpath = os.path.join(catpath, IN2P3_CATNAME[which])
-        # all tables
-        tables = [
-            Table.read(
-                os.path.join(dirpath, f"{htm_id_}.fits"),
-                unit_parse_strict="silent",
-                mask_invalid=False,
-            )
-            for htm_id_ in hmt_id
-        ]
-
-        # table.to_pandas() only accepts single-value columns.
-        if colnames is None:
-            # assume all tables have the same format.
-            t_ = tables[0]
-            colnames = [col.name for col in t_.itercols() if col.ndim == 1]
+    elif fmt == "parquet":
+        catpath = os.getenv("ZTFREFCAT_PARQUET", HTM_PARQUET_LOCATION)
+    else:
+        raise ValueError(f"Cannot parse fmt {fmt} | fits or parquet accepted.")
+    return os.path.join(catpath, IN2P3_CATNAME[which], f"{htm_id}.{fmt}")
+
+
+def _enriched_columns(colnames):
+    """columns added by _enrich_refcat to a catalog with colnames."""
+    fluxcol = [col for col in colnames if col.endswith("_flux")]
+    fluxcolerr = [col for col in colnames if col.endswith("_fluxErr")]
+    return (["ra", "dec"] + [col.replace("_flux", "_mag") for col in fluxcol]
+            + [col.replace("_flux", "_mag") for col in fluxcolerr])
+
+
+def _enrich_refcat(cat):
+    """add ra, dec in degrees and AB magnitudes to a lsst refcats catalog."""
+    from .utils.tools import njy_to_mag
+    # - ra, dec in degrees
+    cat["ra"] = cat["coord_ra"] * (180 / np.pi)
+    cat["dec"] = cat["coord_dec"] * (180 / np.pi)
+    # - mags
+    fluxcol = [col for col in  cat.columns if col.endswith("_flux")]
+    fluxcolerr = [col for col in  cat.columns if col.endswith("_fluxErr")]
+    magcol = [col.replace("_flux","_mag") for col in fluxcol]
+    magcolerr = [col.replace("_flux","_mag") for col in fluxcolerr]
+    cat[magcol], cat[magcolerr] = njy_to_mag( cat[fluxcol].values,cat[fluxcolerr].values )
+    return cat
 
-        cat = pd.concat([t_[colnames].to_pandas() for t_ in tables]).reset_index(drop=True)
 
-        if enrich:
-            # - ra, dec in degrees
-            cat["ra"] = cat["coord_ra"] * (180 / np.pi)
-            cat["dec"] = cat["coord_dec"] * (180 / np.pi)
-            # - mags
-            fluxcol = [col for col in  cat.columns if col.endswith("_flux")]
-            fluxcolerr = [col for col in  cat.columns if col.endswith("_fluxErr")]
-            magcol = [col.replace("_flux","_mag") for col in fluxcol]
-            magcolerr = [col.replace("_flux","_mag") for col in fluxcolerr]
-            cat[magcol], cat[magcolerr] = njy_to_mag( cat[fluxcol].values,cat[fluxcolerr].values )
+def _read_fits_trixel(filepath, colnames=None):
+    """read a fits trixel as a dataframe of its single-value columns."""
+    from astropy.table import Table
+    table = Table.read(filepath, unit_parse_strict="silent", mask_invalid=False)
+    # table.to_pandas() only accepts single-value columns.
+    if colnames is None:
+        colnames = [col.name for col in table.itercols() if col.ndim == 1]
+    return table[colnames].to_pandas()
+
+
+def read_htm_trixel(which, htm_id, colnames=None, enrich=True):
+    """read an HTM trixel of a lsst refcats catalog.
+
+    The converted parquet trixel is used if it exists (see
+    convert_htm_catalog), the original fits one otherwise.
+
+    Parameters
+    ----------
+    which: str
+        Name of the catalog (see get_refcatalog).
+
+    htm_id: int
+        HTM trixel id (depth 7).
+
+    colnames: list
+        names of the (original) columns to read, all if None.
+
+    enrich: bool
+        add ra, dec in degrees and the magnitudes ?
+
+    Returns
+    -------
+    DataFrame
+    """
+    filepath = get_trixel_filepath(which, htm_id, fmt="parquet")
+    if not os.path.isfile(filepath):
+        cat = _read_fits_trixel(get_trixel_filepath(which, htm_id, fmt="fits"), colnames)
+        return _enrich_refcat(cat) if enrich else cat
+
+    if colnames is None:
+        import pyarrow.parquet as pq
+        names = pq.read_schema(filepath).names
+        enriched = set(_enriched_columns(names))
+        colnames = [name for name in names if name not in enriched]
+    columns = list(colnames) + (_enriched_columns(colnames) if enrich else [])
+    return pd.read_parquet(filepath, columns=columns)
+
+
+def get_htm_trixels(which, htm_ids, colnames=None, enrich=True, use_cache=True,
+                    max_workers=8):
+    """read the HTM trixels of a lsst refcats catalog.
+
+    Trixels are kept in the process-wide TILE_CACHE, keyed on
+    (which, htm_id, colnames, enrich), and the uncached ones are read
+    concurrently.
+
+    Parameters
+    ----------
+    which: str
+        Name of the catalog (see get_refcatalog).
+
+    htm_ids: list
+        HTM trixel ids (depth 7).
+
+    colnames, enrich:
+        see read_htm_trixel.
+
+    use_cache: bool
+        use the tile cache ?
+
+    max_workers: int
+        number of reading threads.
+
+    Returns
+    -------
+    DataFrame
+        concatenated trixels.
+    """
+    key_colnames = tuple(colnames) if colnames is not None else None
+
+    def _read(htm_id):
+        def _loader():
+            return read_htm_trixel(which, htm_id, colnames=colnames, enrich=enrich)
+        if not use_cache:
+            return _loader()
+        filepath = get_trixel_filepath(which, htm_id, fmt="parquet")
+        if not os.path.isfile(filepath):
+            filepath = get_trixel_filepath(which, htm_id, fmt="fits")
+        return TILE_CACHE.get(("htm", which, int(htm_id), key_colnames, enrich),
+                              filepath, _loader)
+
+    trixels = _map_threads(_read, htm_ids, max_workers)
+    # a new dataframe: the cached trixels are never modified.
+    return pd.concat(trixels).reset_index(drop=True)
+
+
+def convert_htm_trixel(which, htm_id, overwrite=False):
+    """convert a fits HTM trixel into parquet, with ra, dec in degrees and
+    the magnitudes precomputed.
+
+    Returns
+    -------
+    str
+        path of the parquet trixel.
+    """
+    filepath = get_trixel_filepath(which, htm_id, fmt="parquet")
+    if os.path.isfile(filepath) and not overwrite:
+        return filepath
+
+    cat = _enrich_refcat(_read_fits_trixel(get_trixel_filepath(which, htm_id, fmt="fits")))
+    with atomic_output(filepath) as tmpfile:
+        cat.to_parquet(tmpfile, index=False)
+    return filepath
+
+
+def convert_htm_catalog(which, htm_ids=None, overwrite=False, max_workers=8):
+    """convert the fits HTM trixels of a lsst refcats catalog into parquet.
+
+    Parameters
+    ----------
+    which: str
+        Name of the catalog (see get_refcatalog).
 
+    htm_ids: list
+        trixels to convert, all the fits trixels of the catalog if None.
+
+    overwrite: bool
+        convert again the existing parquet trixels ?
+
+    max_workers: int
+        number of converting threads.
+
+    Returns
+    -------
+    list
+        paths of the parquet trixels.
+    """
+    if htm_ids is None:
+        from glob import glob
+        dirpath = os.path.dirname(get_trixel_filepath(which, 0, fmt="fits"))
+        htm_ids = sorted(int(os.path.basename(f).split(".")[0])
+                         for f in glob(os.path.join(dirpath, "*.fits")))
+
+    return _map_threads(lambda htm_id: convert_htm_trixel(which, htm_id, overwrite=overwrite),
+                        htm_ids, max_workers)
+
+
+def get_field_refcatalog(fieldid, ra, dec, which, radius=FIELD_RADIUS,
+                         enrich=True, colnames=None):
+    """reference catalog of a whole ZTF field, without proper motion.
+
+    The catalog is kept in the process-wide FIELD_CACHE, so that all
+    the quadrants of the field are served by a single read. A catalog
+    larger than the cache (FIELD_CACHE_MAXBYTES) cannot be shared: it is
+    returned once, and the next calls for this field return None so that
+    the callers query their own (smaller) region instead.
+
+    Parameters
+    ----------
+    fieldid: int
+        ZTF field id.
+
+    ra, dec: float
+        field center coordinates in degrees (e.g. RAD, DECD header keys).
+
+    which: str
+        Name of the catalog (see get_refcatalog).
+
+    radius: float
+        radius of the field catalog in degrees.
+
+    Returns
+    -------
+    DataFrame, None
+        the cached dataframe, do not modify it in place.
+        None if the field catalog is known not to fit in FIELD_CACHE.
+    """
+    key = (which, int(fieldid), float(radius), enrich,
+           tuple(colnames) if colnames is not None else None)
+    if key in _OVERSIZED_FIELDS:
+        return None
+
+    def _loader():
+        return get_refcatalog(ra, dec, radius, which, enrich=enrich,
+                              colnames=colnames, apply_proper_motion=False)
+    cat = FIELD_CACHE.get(key, None, _loader)
+    if cat.memory_usage(deep=True).sum() > FIELD_CACHE.maxbytes: # not cached
+        _OVERSIZED_FIELDS.add(key)
+    return cat
+
+
+def select_in_radius(cat, ra, dec, radius):
+    """stars of the catalog within radius (deg) of (ra, dec) (deg).
+
+    Returns
+    -------
+    DataFrame
+        a new dataframe.
+    """
+    ra0, dec0 = np.deg2rad(ra), np.deg2rad(dec)
+    if "ra" in cat.columns:
+        ra_, dec_ = np.deg2rad(cat["ra"].values), np.deg2rad(cat["dec"].values)
+    else: # lsst refcats, not enriched, coordinates in radians
+        ra_, dec_ = cat["coord_ra"].values, cat["coord_dec"].values
+    cos_sep = (np.sin(dec0) * np.sin(dec_) +
+               np.cos(dec0) * np.cos(dec_) * np.cos(ra_ - ra0))
+    return cat[cos_sep >= np.cos(np.deg2rad(radius))].reset_index(drop=True)
+
+
+def _apply_catalog_proper_motion(cat, which, mjd_cat=None, apply_proper_motion=False,
+                                 pm_method="astropy", **kwargs):
+    """move the catalog positions from J2016 to mjd_cat (gaia_dr3 only)."""
+    if not apply_proper_motion:
+        return cat
+
+    if which != "gaia_dr3":
+        raise NotImplementedError(
+            f"Only gaia_dr3 catalog can handle proper motion for now. {which} given"
+        )
+    if mjd_cat is None:
+        raise ValueError("mjd_cat is None here, it should be the data to which we want to move the position using proper motion (in MJD)")
+    if pm_method not in ("astropy", "numpy"):
+        raise ValueError(f"Cannot parse pm_method {pm_method} | astropy or numpy accepted.")
+
+    # nan pms are replaced by 0 so that we don't loose these stars
+    cat = cat.copy()
+    cat.loc[cat.pmdec.isna(),'pmdec']=0
+    cat.loc[cat.pmra.isna(),'pmra']=0
+
+    if pm_method == "numpy":
+        mjd = mjd_cat.tdb.mjd if hasattr(mjd_cat, "tdb") else mjd_cat
+        cat['ra'], cat['dec'] = propagate_proper_motion(
+            cat.ra.values, cat.dec.values, cat.pmra.values, cat.pmdec.values, mjd
+        )
+        return cat
+
+    from astropy.time import Time
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord
+
+    c = SkyCoord(
+        cat.ra.values,
+        cat.dec.values,
+        unit=(u.deg, u.deg),
+        equinox="J2000",
+        pm_ra_cosdec=cat.pmra.values * u.mas / u.yr,
+        pm_dec=cat.pmdec.values * u.mas / u.yr,
+        obstime=Time("J2016"),
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", erfa.ErfaWarning)
+        c_obs_epoch = c.apply_space_motion(mjd_cat)
+    cat['dec']=c_obs_epoch.dec.deg
+    cat['ra']=c_obs_epoch.ra.deg
     return cat
+
+
+def propagate_catalog(cat, which, mjd_cats, pm_method="numpy"):
+    """positions of the catalog stars at several epochs (gaia_dr3 only).
+
+    Parameters
+    ----------
+    cat: DataFrame
+        catalog with ra, dec, pmra and pmdec (at J2016).
+
+    which: str
+        Name of the catalog.
+
+    mjd_cats: list
+        epochs (astropy.time.Time or MJD), [nepochs].
+
+    pm_method: str
+        astropy or numpy (all epochs at once), see get_refcatalog.
+
+    Returns
+    -------
+    array, array
+        ra, dec in degrees, [nepochs, nstars].
+    """
+    if which != "gaia_dr3":
+        raise NotImplementedError(
+            f"Only gaia_dr3 catalog can handle proper motion for now. {which} given"
+        )
+    if pm_method == "numpy":
+        mjds = [mjd.tdb.mjd if hasattr(mjd, "tdb") else mjd for mjd in mjd_cats]
+        # nan pms are replaced by 0 so that we don't loose these stars
+        return propagate_proper_motion(cat.ra.values, cat.dec.values,
+                                       np.nan_to_num(cat.pmra.values),
+                                       np.nan_to_num(cat.pmdec.values),
+                                       np.asarray(mjds, dtype="float64"))
+
+    moved = [_apply_catalog_proper_motion(cat, which, mjd_cat=mjd, apply_proper_motion=True,
+                                          pm_method=pm_method)
+             for mjd in mjd_cats]
+    return (np.stack([cat_.ra.values for cat_ in moved]),
+            np.stack([cat_.dec.values for cat_ in moved]))
+
+
+def propagate_proper_motion(ra, dec, pmra, pmdec, mjd, parallax=None,
+                            radial_velocity=None, epoch_mjd=GAIA_DR3_EPOCH_MJD):
+    """propagate star positions from epoch_mjd to mjd.
+
+    The stars move along straight lines at constant space velocity
+    (linear propagation of the Gaia documentation, without light-time
+    effects): u(t) = p (1 + mu_r dt) + (pmra e_ra + pmdec e_dec) dt,
+    normalised, where p is the unit vector at epoch_mjd and mu_r the
+    radial proper motion (parallax * radial_velocity / A), only used
+    when both are given.
+
+    Parameters
+    ----------
+    ra, dec: array
+        coordinates at epoch_mjd in degrees, [nstars].
+
+    pmra, pmdec: array
+        proper motions in mas/yr (pmra includes cos(dec)), [nstars].
+
+    mjd: float, array
+        target epoch(s) in MJD (TDB). With [nepochs] epochs, the outputs
+        are [nepochs, nstars].
+
+    parallax: array, None
+        parallax in mas.
+
+    radial_velocity: array, None
+        radial velocity in km/s.
+
+    epoch_mjd: float
+        catalog epoch in MJD, J2016.0 for Gaia DR3.
+
+    Returns
+    -------
+    array, array
+        ra, dec in degrees at mjd.
+    """
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    mas_to_rad = np.deg2rad(1 / 3.6e6)
+    pmra, pmdec = np.asarray(pmra) * mas_to_rad, np.asarray(pmdec) * mas_to_rad
+    # julian years, broadcast over the stars.
+    dt = (np.asarray(mjd, dtype="float64") - epoch_mjd) / 365.25
+    dt = dt[..., None]
+
+    sin_ra, cos_ra = np.sin(ra), np.cos(ra)
+    sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+    # unit vector and (east, north) tangent vectors at the catalog epoch.
+    p = np.stack([cos_dec * cos_ra, cos_dec * sin_ra, sin_dec])
+    e_ra = np.stack([-sin_ra, cos_ra, np.zeros_like(ra)])
+    e_dec = np.stack([-sin_dec * cos_ra, -sin_dec * sin_ra, cos_dec])
+
+    radial = 1 # (1 + mu_r dt)
+    if parallax is not None and radial_velocity is not None:
+        mu_r = np.asarray(parallax) * np.asarray(radial_velocity) / _AU_KMYR_PER_S * mas_to_rad
+        radial = 1 + mu_r * dt
+
+    # [3, (nepochs,) nstars]
+    u = (p[:, None] * radial + (pmra * e_ra + pmdec * e_dec)[:, None] * dt)
+    u = u if np.ndim(mjd) else u[:, 0]
+    ra_t = np.rad2deg(np.arctan2(u[1], u[0])) % 360
+    dec_t = np.rad2deg(np.arctan2(u[2], np.hypot(u[0], u[1])))
+    return ra_t, dec_t
+
+
+def get_field_refcat_filepath(fieldid, rcid, which):
+    """path of the precomputed catalog of a field and rcid.
+
+    Returns
+    -------
+    str
+        FIELD_REFCAT_DIR/{which}/{fieldid:06d}/ztfin2p3_{which}_{fieldid:06d}_rc{rcid:02d}.parquet
+    """
+    fieldid, rcid = int(fieldid), int(rcid)
+    return os.path.join(FIELD_REFCAT_DIR, which, f"{fieldid:06d}",
+                        f"ztfin2p3_{which}_{fieldid:06d}_rc{rcid:02d}.parquet")
+
+
+def get_field_refcat(fieldid, rcid, which):
+    """precomputed catalog of a field and rcid (see build_field_refcats).
+
+    The catalog is kept in the process-wide FIELD_CACHE and reloaded if
+    the file changed.
+
+    Returns
+    -------
+    DataFrame, None
+        the cached dataframe (do not modify it in place), None if the
+        catalog has not been built.
+    """
+    filepath = get_field_refcat_filepath(fieldid, rcid, which)
+    if not os.path.isfile(filepath):
+        return None
+    return FIELD_CACHE.get(("refcat", which, int(fieldid), int(rcid)), filepath,
+                           lambda: pd.read_parquet(filepath))
+
+
+def get_quadrant_center(header):
+    """ra, dec (deg) of the center of a science quadrant from its header wcs."""
+    from astropy.wcs import WCS
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        wcs = WCS(header)
+    ra, dec = wcs.all_pix2world((header["NAXIS1"] - 1) / 2, (header["NAXIS2"] - 1) / 2, 0)
+    return float(ra), float(dec)
+
+
+def build_field_refcat(fieldid, rcid, ra, dec, which, radius=0.7,
+                       margin=FIELD_REFCAT_MARGIN, overwrite=False):
+    """build and store the catalog of a field and rcid.
+
+    Stars within radius+margin of the quadrant center (ra, dec) are
+    stored with the columns of _FIELD_REFCAT_COLUMNS, positions at the
+    catalog epoch (no proper motion applied).
+
+    Parameters
+    ----------
+    fieldid, rcid: int
+        ZTF field and readout channel (quadrant) ids.
+
+    ra, dec: float
+        quadrant center in degrees (see get_quadrant_center).
+
+    which: str
+        Name of the catalog (see get_refcatalog).
+
+    radius: float
+        radius of the catalog in degrees (refcat_radius of the aperture
+        photometry).
+
+    margin: float
+        extra radius in degrees, covering the pointing scatter of the field.
+
+    overwrite: bool
+        rebuild the catalog if it exists ?
+
+    Returns
+    -------
+    str
+        path of the catalog.
+    """
+    filepath = get_field_refcat_filepath(fieldid, rcid, which)
+    if os.path.isfile(filepath) and not overwrite:
+        return filepath
+
+    columns = _FIELD_REFCAT_COLUMNS[which]
+    colnames = _KNOWN_COLUMNS[which] if which == "gaia_dr3" else None
+    cat = get_refcatalog(ra, dec, radius + margin, which, enrich=True,
+                         colnames=colnames)
+    cat = cat[columns].reset_index(drop=True)
+    # ra, dec keep their float64 precision.
+    cat = cat.astype({col: "float32" for col in columns
+                      if col not in ("ra", "dec") and cat[col].dtype == "float64"})
+
+    with atomic_output(filepath) as tmpfile:
+        cat.to_parquet(tmpfile, index=False)
+    return filepath
+
+
+def build_field_refcats(headers, which, radius=0.7, margin=FIELD_REFCAT_MARGIN,
+                        overwrite=False):
+    """build the catalogs of the fields and rcids of the given science headers.
+
+    A single header per (FIELDID, RCID) is used, the first one given.
+
+    Parameters
+    ----------
+    headers: list
+        science quadrant headers (with wcs, FIELDID and RCID).
+
+    which: str
+        Name of the catalog (see get_refcatalog).
+
+    radius, margin, overwrite:
+        see build_field_refcat.
+
+    Returns
+    -------
+    list
+        paths of the catalogs.
+    """
+    done = {}
+    for header in headers:
+        key = (int(header["FIELDID"]), int(header["RCID"]))
+        if key in done:
+            continue
+        ra, dec = get_quadrant_center(header)
+        done[key] = build_field_refcat(*key, ra, dec, which, radius=radius,
+                                       margin=margin, overwrite=overwrite)
+        logger.debug("field refcat %s rc%02d: %s", *key, done[key])
+    return list(done.values())
@@ -1,6 +1,8 @@
 """ I/O for the IN2P3 pipeline """
 
+import contextlib
 import os
+import uuid
 from ztfquery.io import LOCALSOURCE
 import numpy as np
 from ztfquery import buildurl
@@ -297,6 +299,307 @@ def get_directory(kind, subkind):
     if subkind in ["object","science"]:
         return SCIENCE_DIR
     
+# =========== #
+#  Products   #
+# =========== #
+CALIB_PRODUCT_FORMATS = ["fits", "mmap"]
+
+def write_calib_product(filename, data, header=None, product_format="fits",
+                        overwrite=True, **kwargs):
+    """ store a master calibration image.
+
+    Parameters
+    ----------
+    filename: str
+        fullpath of the output file.
+
+    data: 2d-array
+        calibration image.
+
+    header: fits.Header
+        header to store with the data.
+
+    product_format: str
+        - fits: legacy format, data written as given by fits.writeto.
+        - mmap: memory-mappable layout: float32 (BITPIX=-32) contiguous data, no
+          BZERO/BSCALE scaling. FITS data are big-endian, so the data are
+          also written as a native-endian .npy file next to the fits one
+          (see get_calib_product_datafile), which read_calib_product(memmap=True)
+          maps without copy nor byte swapping. This doubles the disk usage.
+
+    overwrite: bool
+        if filename already exist, should this overwrite it ?
+
+    **kwargs goes to fits.writeto() or PrimaryHDU.writeto()
+
+    Returns
+    -------
+    str
+        the input filename
+    """
+    from astropy.io import fits
+    if product_format not in CALIB_PRODUCT_FORMATS:
+        raise ValueError(f"product_format should be one of {CALIB_PRODUCT_FORMATS}, {product_format} given")
+
+    if product_format == "fits":
+        fits.writeto(filename, data, header=header, overwrite=overwrite, **kwargs)
+        return filename
+
+    data = np.ascontiguousarray(data, dtype="float32") # native endian
+    # the .npy first: a fits with CALFMT=mmap always has its data file.
+    with atomic_output(get_calib_product_datafile(filename)) as tmpfile:
+        with open(tmpfile, "wb") as f:
+            np.save(f, data)
+    hdu = fits.PrimaryHDU(data=data, header=header)
+    for key in ["BZERO", "BSCALE"]:
+        hdu.header.remove(key, ignore_missing=True)
+    hdu.header["CALFMT"] = (product_format, "calibration product layout")
+    hdu.writeto(filename, overwrite=overwrite, **kwargs)
+    return filename
+
+def get_calib_product_datafile(filename):
+    """ native-endian data file of a mmap master calibration (see write_calib_product) """
+    return f"{os.path.splitext(filename)[0]}.npy"
+
+def read_calib_product(filename, memmap=True):
+    """ read a master calibration image (any format of write_calib_product).
+
+    Parameters
+    ----------
+    filename: str
+        fullpath of the calibration file.
+
+    memmap: bool
+        memory map the data, so only the pages that are accessed are read.
+        mmap products map their native-endian .npy data file, fits ones
+        their (big-endian) fits data. Scaled (BZERO/BSCALE) legacy products
+        are loaded in memory.
+
+    Returns
+    -------
+    2d-array, fits.Header
+        read-only data and header.
+    """
+    from astropy.io import fits
+    datafile = get_calib_product_datafile(filename)
+    if memmap and os.path.isfile(datafile):
+        header = fits.getheader(filename)
+        if header.get("CALFMT") == "mmap": # not rewritten in the fits format since
+            return np.load(datafile, mmap_mode="r"), header
+
+    with fits.open(filename, memmap=memmap) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+
+    data.setflags(write=False)
+    return data, header
+
+# ------------------------ #
+#  Master calibration log  #
+# ------------------------ #
+# header keys of a master calibration recorded in the log and catalogs.
+CALIB_LOG_KEYS = ["PERIOD", "CCDID", "IMGTYPE", "PTYPE", "NFRAMES", "PIPETIME",
+                  "PIPEV", "ZTFIMGV", "FILTRKEY", "FLTNORM", "FLTNORM_FP", "FINGERPR"]
+
+def get_calib_logfile(kind, year):
+    """ path of the log of produced master{kind} files of the given year """
+    return os.path.join(CAL_DIR, kind, "meta", f"master{kind}_log_{year}.jsonl")
+
+def get_calib_catalogfile(kind, year, uncut=False):
+    """ path of the master{kind} catalog of the given year (see parse_cal)
+
+    uncut: the catalog of all the files, without the --clean cut.
+    """
+    prefix = "uncut_" if uncut else ""
+    return os.path.join(CAL_DIR, kind, "meta", f"{prefix}master{kind}_metadata_{year}.parquet")
+
+def get_calib_lockfile(year):
+    """ lock of the master bias and flat logs and catalogs of the given year """
+    return os.path.join(CAL_DIR, f"mastercal_{year}.lock")
+
+@contextlib.contextmanager
+def file_lock(lockfile, shared=False):
+    """ hold an flock on lockfile (created if needed) within the context.
+
+    shared: shared lock, exclusive otherwise.
+    """
+    import fcntl
+    os.makedirs(os.path.dirname(lockfile) or ".", exist_ok=True)
+    with open(lockfile, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def atomic_output(filepath):
+    """ yield a unique temporary path next to filepath, moved onto it
+    when the context exits without error (removed otherwise), so that
+    readers never see a partial file and concurrent writers do not
+    share a temporary file.
+    """
+    dirname = os.path.dirname(filepath) or "."
+    os.makedirs(dirname, exist_ok=True)
+    # as mkstemp, but with the usual 0666 & ~umask permissions (mkstemp
+    # creates 0600 files).
+    tmpfile = os.path.join(dirname, f".{os.path.basename(filepath)}.{uuid.uuid4().hex}.tmp")
+    os.close(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    try:
+        yield tmpfile
+        os.replace(tmpfile, filepath)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def cut_incomplete_days(bias, flat, year):
+    """ remove the days without 64 master calibrations (bias + flats of
+    all filters), as parse_cal --clean.
+
+    Returns
+    -------
+    DataFrame, DataFrame
+        bias and flat catalogs of the complete days.
+    """
+    import pandas as pd
+    dates = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq="D")
+    df = pd.DataFrame(dates.astype(str).str.replace("-", ""), columns=["date"])
+
+    # count biases
+    df2 = pd.DataFrame(bias.groupby(bias["PERIOD"].astype(str)).size(), columns=["nbias"])
+    df = df.join(df2, "date")
+
+    # count flats
+    if len(flat) > 0:
+        df2 = flat.assign(PERIOD=flat["PERIOD"].astype(str)).pivot_table(
+            index="PERIOD", columns="FILTRKEY", aggfunc="count", values="IMGTYPE"
+        )
+        df = df.join(df2, "date")
+
+    df = df.reindex(columns=["date", "nbias", "zg", "zi", "zr"]).fillna(0)
+    df = df.astype({col: int for col in ["nbias", "zg", "zi", "zr"]})
+    df["tot"] = df[["nbias", "zg", "zi", "zr"]].sum(axis=1)
+
+    # Need to think some more on this operation.
+    # Especially since in the future we might have no bias but flats for a day.
+    to_remove = df[df.tot.lt(64)].date.astype(str).tolist()
+
+    bias = bias[~bias.PERIOD.astype(str).isin(to_remove)]
+    flat = flat[~flat.PERIOD.astype(str).isin(to_remove)]
+    return bias, flat
+
+def append_calib_log(kind, filename, header):
+    """ append a produced master calibration to the log of its year.
+
+    Each record is a single json line appended at once, so concurrent
+    writers (e.g. calib --workers) do not interleave, under a shared
+    lock so that no record is written while the log is compacted.
+
+    Parameters
+    ----------
+    kind: str
+        bias or flat
+
+    filename: str
+        fullpath of the master calibration file.
+
+    header: fits.Header
+        header written in the file.
+
+    Returns
+    -------
+    dict
+        the logged record.
+    """
+    import json
+    stat = os.stat(filename)
+    record = {key: header.get(key) for key in CALIB_LOG_KEYS}
+    record.update(FILEPATH=str(filename), MTIME=stat.st_mtime_ns, SIZE=stat.st_size)
+
+    year = str(record["PERIOD"])[:4]
+    logfile = get_calib_logfile(kind, year)
+    os.makedirs(os.path.dirname(logfile), exist_ok=True)
+    line = (json.dumps(record, default=str) + "\n").encode()
+    with file_lock(get_calib_lockfile(year), shared=True):
+        fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    return record
+
+def _calib_product_key(catalog):
+    """ (PERIOD, CCDID, FILTRKEY) of the catalog rows, as strings """
+    import pandas as pd
+    key = (catalog["PERIOD"].astype(str) + "_" +
+           pd.to_numeric(catalog["CCDID"]).astype("Int64").astype(str))
+    if "FILTRKEY" in catalog:
+        key = key + "_" + catalog["FILTRKEY"].fillna("").astype(str)
+    return key
+
+def compact_calib_log(kind, year):
+    """ fold the log of the given kind and year into the yearly catalogs.
+
+    Records are merged with the uncut catalog, keeping the last record
+    of each file (rows of legacy catalogs, without FILEPATH, are replaced
+    by the records of the same PERIOD, CCDID and FILTRKEY), then the (clean) catalogs of both kinds are rebuilt
+    from the uncut ones with the parse_cal --clean cut. Everything is
+    made under an exclusive lock of the year, so concurrent calib jobs
+    compact one after the other; catalogs are written atomically and
+    the log is removed last, so a crash only leads to records folded
+    again.
+
+    Returns
+    -------
+    int
+        number of folded records.
+    """
+    import pandas as pd
+    logfile = get_calib_logfile(kind, year)
+    # log left by a compaction of a previous version.
+    logfiles = [f for f in (f"{logfile}.compacting", logfile) if os.path.exists(f)]
+    if len(logfiles) == 0:
+        return 0
+
+    with file_lock(get_calib_lockfile(year)):
+        logfiles = [f for f in logfiles if os.path.exists(f)]
+        if len(logfiles) == 0: # compacted by another job meanwhile
+            return 0
+        log = pd.concat([pd.read_json(f, lines=True, dtype=False) for f in logfiles],
+                        ignore_index=True)
+
+        def _read_uncut(kind_):
+            for uncut in (True, False):
+                catalogfile = get_calib_catalogfile(kind_, year, uncut=uncut)
+                if os.path.exists(catalogfile):
+                    return pd.read_parquet(catalogfile)
+            return pd.DataFrame(columns=["PERIOD", "FILTRKEY", "IMGTYPE", "FILEPATH"])
+
+        catalog = pd.concat([_read_uncut(kind), log], ignore_index=True)
+        # rows of legacy catalogs have no FILEPATH: a rebuilt master
+        # replaces those of the same product.
+        legacy = catalog["FILEPATH"].isna()
+        product = _calib_product_key(catalog)
+        catalog = catalog[~(legacy & product.isin(product[~legacy]))]
+        key = catalog["FILEPATH"].fillna(pd.Series(catalog.index.astype(str), index=catalog.index))
+        catalog = catalog[~key.duplicated(keep="last")].reset_index(drop=True)
+        with atomic_output(get_calib_catalogfile(kind, year, uncut=True)) as tmpfile:
+            catalog.to_parquet(tmpfile)
+
+        catalogs = {kind: catalog}
+        other = "flat" if kind == "bias" else "bias"
+        catalogs[other] = _read_uncut(other)
+        catalogs["bias"], catalogs["flat"] = cut_incomplete_days(
+            catalogs["bias"], catalogs["flat"], year
+        )
+        for kind_, catalog_ in catalogs.items():
+            with atomic_output(get_calib_catalogfile(kind_, year)) as tmpfile:
+                catalog_.to_parquet(tmpfile)
+
+        for f in logfiles:
+            os.remove(f)
+    return len(log)
+
 # =========== #
 # Calibration #
 # =========== #
@@ -1,8 +1,11 @@
 """ Handling metadata """
 
+import json
 import logging
 import os
+import threading
 import warnings
+from collections import OrderedDict
 
 import dask
 import numpy as np
@@ -12,38 +15,326 @@ from astropy.io import fits
 from ztfquery.buildurl import parse_filename
 from ztfquery.io import LOCALSOURCE
 
+from .io import atomic_output, file_lock
 from .utils.tools import parse_singledate
 
 __all__ = ["get_metadata"]
 
+# rows per row-group in the metadata store. Small enough for a single day of a
+# single ccd to only touch a few row-groups, large enough to keep the footer small.
+STORE_ROWGROUP_SIZE = 8192
+# columns needed by metadata_to_url to build raw file paths.
+_FILEPATH_COLUMNS = ["filefracday", "field", "filtercode", "ccdid", "imgtypecode"]
+# parquet schema metadata key of the monthly file a store partition was built from.
+_STORE_SOURCE_KEY = b"ztfin2p3.source"
+
+# maximum memory used by the in-process monthly metadata cache.
+MONTHLY_CACHE_MAXBYTES = 2 * 1024**3
+# rows per row-group in the metaheader store (64 quadrants per exposure).
+METAHEADER_ROWGROUP_SIZE = 64 * 64
+# version of the metaheader store format, stores of other versions are ignored.
+METAHEADER_STORE_VERSION = b"2"
+_METAHEADER_VERSION_KEY = b"ztfin2p3.metaheader_version"
+
+
+class MetaDataCache( object ):
+    """ bounded LRU cache of monthly metadata dataframes.
+
+    Entries are keyed on (kind, subkind, year, month, columns) and are
+    invalidated when the size or modification time of the underlying
+    parquet file changes. The cache is bounded in memory: least recently
+    used entries are dropped once maxbytes is exceeded.
+    """
+    def __init__(self, maxbytes=MONTHLY_CACHE_MAXBYTES):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, filepath, loader):
+        """ get the cached data for key, calling loader() if needed.
+
+        Parameters
+        ----------
+        key: tuple
+            cache key.
+
+        filepath: str, None
+            file the data are read from, used for invalidation.
+            None means the entry is never invalidated.
+
+        loader: func
+            function returning the dataframe (called without argument).
+
+        Returns
+        -------
+        DataFrame
+            the cached dataframe, do not modify it in place.
+        """
+        if filepath is None:
+            signature = None
+        else:
+            stat = os.stat(filepath)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self.invalidations += 1
+                self._pop(key)
+            self.misses += 1
+
+        data = loader()
+        nbytes = int(data.memory_usage(deep=True).sum())
+        with self._lock:
+            if nbytes <= self.maxbytes:
+                if key in self._entries:
+                    self._pop(key)
+                self._entries[key] = (signature, nbytes, data)
+                self.nbytes += nbytes
+                while self.nbytes > self.maxbytes:
+                    self._pop(next(iter(self._entries)))
+        return data
+
+    def clear(self):
+        """ drop all entries (counters are kept) """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """ cache statistics (json serializable) """
+        return {"hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries), "nbytes": self.nbytes,
+                "maxbytes": self.maxbytes}
+
+    def _pop(self, key):
+        """ remove key from the cache (lock must be held) """
+        _, nbytes, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+
+MONTHLY_CACHE = MetaDataCache()
+
+
+def get_cache_info():
+    """ statistics of the monthly metadata cache (see MetaDataCache.info) """
+    return MONTHLY_CACHE.info()
+
 
 
 def get_sciheader(filename, **kwargs):
     # get needed information
-    logger = logging.getLogger(__name__)
     expid = filename_to_metadata(filename).iloc[0]["expid"]
     info = parse_filename(filename)
     month = f"{info['year']}{info['month']}"
-    #
-    try:
-        meta_df = _get_sciheader(month, expid=expid, rcid=info["rcid"], **kwargs)
-    except FileNotFoundError:
-        logger.warn("no header file for %s", filename)
-        return
-
-    try:
-        hdr = dict(meta_df.iloc[0])
-    except IndexError:
-        logger.warn("no header for %s", filename)
-        return
+    return get_sciheaders([expid], [info["rcid"]], month, **kwargs)[0]
+
+
+def get_sciheaders(expids, rcids, months, **kwargs):
+    """ bulk get_sciheader: science headers of many (expid, rcid) quadrants.
+
+    Headers are taken from the metaheader store (see build_metaheader_store)
+    whose row-groups are kept in the monthly cache, so that consecutive
+    exposures (e.g. a night) are read once. Months without store fall back
+    to a single EXPID-filtered read of the legacy metaheader file.
+
+    Parameters
+    ----------
+    expids, rcids: list
+        ZTF exposure ID and RCID of each quadrant.
+
+    months: str, list
+        month (YYYYMM) of each quadrant (or of all).
+
+    **kwargs goes to pandas.read_parquet() (legacy metaheader only)
+
+    Returns
+    -------
+    list
+        fits.Header, or None if no header is found for the quadrant.
+    """
+    logger = logging.getLogger(__name__)
+    expids = np.asarray(expids).astype("int64")
+    rcids = np.asarray(rcids).astype("int64")
+    months = np.broadcast_to(np.asarray(months, dtype=str), expids.shape)
+
+    headers = [None] * len(expids)
+    for month in np.unique(months):
+        index = np.flatnonzero(months == month)
+        meta_df = _read_metaheader_store(month, expids[index])
+        to_header = _typed_metaheader_to_header
+        if meta_df is None: # legacy metaheader, values as strings
+            filters = [("EXPID", "in", [str(e) for e in np.unique(expids[index])])]
+            try:
+                meta_df = _get_sciheader(month, filters=filters, **kwargs)
+            except FileNotFoundError:
+                logger.warn("no header file for month %s", month)
+                continue
+            to_header = _metaheader_to_header
+
+        keys = pandas.MultiIndex.from_arrays([meta_df["EXPID"].astype("int64"),
+                                              meta_df["RCID"].astype("int64")])
+        meta_df = meta_df.set_axis(keys)[~keys.duplicated()]
+        for i in index:
+            key = (expids[i], rcids[i])
+            if key in meta_df.index:
+                headers[i] = to_header(dict(meta_df.loc[key]))
+            else:
+                logger.warn("no header for expid=%s rcid=%s", *key)
+
+    return headers
+
+
+def get_metaheader_storefile(month):
+    """ path of the metaheader store file of the given month (YYYYMM) """
+    return os.path.join(_get_metadir("metaheader"), "store",
+                        f"metaheader_{month}.parquet")
+
+
+def build_metaheader_store(month, row_group_size=METAHEADER_ROWGROUP_SIZE):
+    """ build (or rebuild) the metaheader store file of the given month
+    from the legacy metaheader file.
+
+    Header values (strings in the legacy file) are stored as typed
+    columns (nullable int, float, bool or unquoted str), sorted by EXPID
+    and RCID.
 
+    Parameters
+    ----------
+    month: str, int
+        month YYYYMM, e.g. 201904 for April 2019.
+
+    row_group_size: int
+        number of rows per parquet row-group.
+
+    Returns
+    -------
+    str
+        path of the written file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    data = _get_sciheader(month)
+    # seems this one was not parsed correctly ("'")
+    data = data.drop(columns=["SCAMPPTH"], errors="ignore")
+    data = data.apply(_parse_metaheader_column)
+    data["EXPID"] = data["EXPID"].astype("int64")
+    data["RCID"] = data["RCID"].astype("int64")
+    data = data.sort_values(["EXPID", "RCID"], kind="stable")
+
+    fileout = get_metaheader_storefile(month)
+    os.makedirs(os.path.dirname(fileout), exist_ok=True)
+    # write next to the target then move, so readers never see partial files.
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           _METAHEADER_VERSION_KEY: METAHEADER_STORE_VERSION})
+    with atomic_output(fileout) as tmpfile:
+        pq.write_table(table, tmpfile, row_group_size=row_group_size,
+                       write_statistics=True)
+    return fileout
+
+
+def _parse_metaheader_column(values):
+    """ typed version of a column of header value strings """
+    strings = values.astype("string").str.strip()
+    strings = strings.where(strings != "")
+    notnull = strings.notna()
+    if notnull.any() and strings[notnull].isin(["T", "F"]).all():
+        return strings.map({"T": True, "F": False}).astype("boolean")
+
+    numbers = pandas.to_numeric(strings, errors="coerce")
+    if numbers[notnull].notna().all():
+        # integers stay integers where some headers lack the keyword
+        # (a NaN would otherwise turn the column, hence the headers, to float)
+        if strings[notnull].str.fullmatch(r"[+-]?\d+").all():
+            return numbers.astype("Int64")
+        return numbers
+
+    # FITS strings: 'value' with '' for quotes
+    return strings.str.replace(r"^'(.*)'$", r"\1", regex=True
+                               ).str.rstrip().str.replace("''", "'")
+
+
+def _read_metaheader_store(month, expids):
+    """ rows of the metaheader store of the given month for the given expids.
+
+    Only the row-groups containing these expids are read, and they are kept
+    in the monthly cache.
+
+    Returns None if there is no store for this month, or if it was built
+    by an older version (see METAHEADER_STORE_VERSION).
+    """
+    import pyarrow.parquet as pq
+
+    filepath = get_metaheader_storefile(month)
+    if not os.path.isfile(filepath):
+        return None
+
+    def _load_index():
+        metadata = pq.ParquetFile(filepath).metadata
+        if (metadata.metadata or {}).get(_METAHEADER_VERSION_KEY) != METAHEADER_STORE_VERSION:
+            return pandas.DataFrame({"outdated": [True]})
+        column = metadata.schema.names.index("EXPID")
+        stats = [metadata.row_group(i).column(column).statistics
+                 for i in range(metadata.num_row_groups)]
+        return pandas.DataFrame({"min": [stat.min for stat in stats],
+                                 "max": [stat.max for stat in stats]}, dtype="int64")
+
+    rg_index = MONTHLY_CACHE.get(("metaheader", month, "index"), filepath, _load_index)
+    if "outdated" in rg_index:
+        logging.getLogger(__name__).warning(
+            "outdated metaheader store for month %s, rebuild it", month)
+        return None
+
+    expids = np.unique(expids)
+    first = np.searchsorted(expids, rg_index["min"].values)
+    selected = np.flatnonzero(
+        (first < len(expids)) &
+        (expids[np.minimum(first, len(expids) - 1)] <= rg_index["max"].values)
+    )
+
+    parquet_file = None
+    frames = []
+    for rg in selected:
+        def _load_rowgroup(rg=rg):
+            nonlocal parquet_file
+            if parquet_file is None:
+                parquet_file = pq.ParquetFile(filepath)
+            return parquet_file.read_row_group(int(rg)).to_pandas()
+
+        frames.append(MONTHLY_CACHE.get(("metaheader", month, int(rg)), filepath,
+                                        _load_rowgroup))
+
+    if len(frames) == 0:
+        return pandas.DataFrame(columns=["EXPID", "RCID"])
+
+    data = pandas.concat(frames, ignore_index=True)
+    return data[data["EXPID"].isin(expids)]
+
+
+def _typed_metaheader_to_header(hdr):
+    """ build the astropy Header of a metaheader store row (dict) """
+    return fits.Header([(key, value.item() if isinstance(value, np.generic) else value)
+                        for key, value in hdr.items() if not pandas.isna(value)])
+
+
+def _metaheader_to_header(hdr):
+    """ build the astropy Header of a legacy metaheader row (dict) """
     # seems this one was not parsed correctly, remove it ("'")
-    del hdr['SCAMPPTH']
+    hdr.pop('SCAMPPTH', None)
     # reconstruct header string, so numerical values are parsed by Header
     hdr_string = "\n".join(f"{k:8s}= {v}" for k, v in hdr.items())
-    hdr = fits.Header.fromstring(hdr_string, sep="\n")
-    return hdr
-    
+    return fits.Header.fromstring(hdr_string, sep="\n")
+
 def filename_to_metadata(filename, kind="raw"):
     """ fetch metadata associated to the given filename 
 
@@ -404,7 +695,9 @@ class MetaDataHandler( object ):
         return io.bulk_get_file(files, client=client, as_dask=as_dask)
         
     @classmethod
-    def get_metadata(cls, date, ccdid=None, fid=None, add_filepath=False, **kwargs):
+    def get_metadata(cls, date, ccdid=None, fid=None, add_filepath=False,
+                     filters=None, use_store=True, columns=None, add_dates=True,
+                     **kwargs):
         """ General method to access the IRSA metadata given a date or a daterange. 
 
         The format of date is very flexible to quickly get what you need:
@@ -430,6 +723,23 @@ class MetaDataHandler( object ):
             value or list of ccd (ccdid=[1->16]) or filter (fid=[1->3]) you want
             to limit to.
 
+        filters: [dict] -optional-
+            additional {column: value or list of} selections (e.g. field, ledid).
+            Columns unknown to the metadata are ignored.
+
+        use_store: [bool] -optional-
+            read from the metadata store (see build_metadatastore) when it
+            covers the requested months, pushing the date and column
+            selections down to the parquet reader.
+            Falls back on the monthly metadata files otherwise.
+
+        columns: [list] -optional-
+            only read these columns (plus those needed for the selection
+            and the requested derived columns). None means all.
+
+        add_dates: [bool] -optional-
+            add the day, month and year (str) columns derived from filefracday.
+
         Returns
         -------
         dataframe (IRSA metadata)
@@ -450,26 +760,46 @@ class MetaDataHandler( object ):
         else:
             start, end = time.Time(date).datetime
 
+        selection = {"ccdid": ccdid, "fid": fid, **(filters or {})}
+        selection = {k: v for k, v in selection.items() if v is not None}
+
         months = cls._daterange_to_monthlist_(start, end)
-        data = pandas.concat([cls.get_monthly_metadata(yyyy,mm) for yyyy,mm in months])
+        if columns is not None:
+            columns = ["obsdate", *selection.keys(), *columns]
+            if add_dates:
+                columns.append("filefracday")
+            if add_filepath:
+                columns += _FILEPATH_COLUMNS
+            columns = list(dict.fromkeys(columns)) # unique, keeping order
+
+        data = None
+        if use_store:
+            data = cls._read_metadatastore_(months, start, end, filters=selection,
+                                            columns=columns)
+        if data is None:
+            if columns is not None:
+                import pyarrow.parquet as pq
+                names = pq.read_schema(cls._load_or_download_(*months[0])).names
+                columns = [col for col in columns if col in names]
+            data = pandas.concat([cls.get_monthly_metadata(yyyy, mm, columns=columns)
+                                  for yyyy,mm in months])
         
         datecol = pandas.to_datetime(data["obsdate"], format='ISO8601')
         data = data[datecol.between(start.isoformat(), end.isoformat())]
-        #          #
-        #  CCDID   #
-        #          #
-        if ccdid is not None:
-            data = data[data["ccdid"].isin(np.atleast_1d(ccdid))]
-        #          #
-        #  FID     #
-        #          #
-        if fid is not None:
-            data = data[data["fid"].isin(np.atleast_1d(fid))]
+        #                   #
+        #  CCDID, FID, ...  #
+        #                   #
+        for key, value in selection.items():
+            if key in data.columns:
+                data = data[data[key].isin(np.atleast_1d(value))]
 
         # - Add day, always useful
-        data["day"] = data["filefracday"].astype("str").str[:8]
-        data["month"] = data["filefracday"].astype("str").str[:6]
-        data["year"] = data["filefracday"].astype("str").str[:4]
+        if add_dates:
+            # filefracday: yyyymmddffffff
+            filefracday = data["filefracday"].to_numpy(dtype="int64")
+            data["day"] = (filefracday // 10**6).astype(str)
+            data["month"] = (filefracday // 10**8).astype(str)
+            data["year"] = (filefracday // 10**10).astype(str)
 
         if add_filepath:
             if len(data) == 0:
@@ -562,11 +892,195 @@ class MetaDataHandler( object ):
         return filepath
         
     @classmethod
-    def get_monthly_metadata(cls, year, month, force_dl=False, **kwargs):
-        """ """
+    def get_monthly_metadata(cls, year, month, force_dl=False, columns=None,
+                             use_cache=True, **kwargs):
+        """ get the metadata of the given month.
+
+        Parameters
+        ----------
+        year, month: int, str
+            month to load.
+
+        force_dl: bool
+            should the monthly metadata be downloaded again ?
+
+        columns: list
+            read_parquet option to select columns while reading
+
+        use_cache: bool
+            use the in-process monthly metadata cache (see MONTHLY_CACHE).
+            Ignored if extra read_parquet kwargs are given.
+
+        **kwargs goes to pandas.read_parquet
+
+        Returns
+        -------
+        DataFrame
+        """
         filepath = cls._load_or_download_(year, month, force_dl=force_dl)
-        return pandas.read_parquet(filepath, **kwargs)
+        if not use_cache or kwargs:
+            return pandas.read_parquet(filepath, columns=columns, **kwargs)
+
+        key = (cls._KIND, cls._SUBKIND, int(year), int(month),
+               None if columns is None else tuple(columns))
+        data = MONTHLY_CACHE.get(key, filepath,
+                                 lambda: pandas.read_parquet(filepath, columns=columns))
+        return data.copy()
     
+    # ================= #
+    #   Store           #
+    # ================= #
+    @classmethod
+    def get_metadatastore_partition(cls, year, month):
+        """ directory of the metadata store partition for the given month.
+
+        The store is a hive-partitioned parquet dataset:
+        meta/store/{kind}{subkind}/year={yyyy}/month={mm}/part-0.parquet
+        sorted by obsjd, so row-group statistics allow date selections
+        to only read the relevant row-groups. The index of the monthly
+        metadata is kept, and the mtime and size of the monthly file are
+        recorded so that stale partitions are not used.
+        """
+        year, month = int(year), int(month)
+        if cls._KIND is None or cls._SUBKIND is None:
+            raise AttributeError(f"_KIND {cls._KIND} or _SUBKIND {cls._SUBKIND} is None. Please define them")
+
+        return os.path.join(_get_metadir("store"), f"{cls._KIND}{cls._SUBKIND}",
+                            f"year={year:04d}", f"month={month:02d}")
+
+    @classmethod
+    def build_metadatastore(cls, year, month, force_dl=False,
+                            row_group_size=STORE_ROWGROUP_SIZE):
+        """ build (or rebuild) the metadata store partition of the given month
+        from the monthly metadata file.
+
+        Parameters
+        ----------
+        year, month: int, str
+            month to be converted.
+
+        force_dl: bool
+            should the monthly metadata be downloaded again ?
+
+        row_group_size: int
+            number of rows per parquet row-group.
+
+        Returns
+        -------
+        str
+            path of the written partition file.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        filepath = cls._load_or_download_(year, month, force_dl=force_dl)
+        stat = os.stat(filepath) # before reading: a later update makes it stale.
+        data = pandas.read_parquet(filepath)
+        data = data.sort_values(["obsjd", "ccdid"], kind="stable")
+
+        partition = cls.get_metadatastore_partition(year, month)
+        os.makedirs(partition, exist_ok=True)
+        fileout = os.path.join(partition, "part-0.parquet")
+
+        # write next to the target then move, so readers never see partial files
+        # (the hidden temporary file is ignored by the store dataset).
+        table = pa.Table.from_pandas(data, preserve_index=True)
+        source = json.dumps({"mtime_ns": stat.st_mtime_ns, "size": stat.st_size})
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                                               _STORE_SOURCE_KEY: source})
+        with atomic_output(fileout) as tmpfile:
+            pq.write_table(table, tmpfile, row_group_size=row_group_size,
+                           write_statistics=True)
+        return fileout
+
+    @classmethod
+    def is_metadatastore_current(cls, year, month):
+        """ is the store partition of the given month built from the
+        current monthly metadata file ?
+
+        A partition without monthly file (e.g. removed after the build) is
+        considered current. A partition built before the monthly file
+        was updated, or without recorded source, is not.
+        """
+        import pyarrow.parquet as pq
+
+        fileout = os.path.join(cls.get_metadatastore_partition(year, month), "part-0.parquet")
+        if not os.path.isfile(fileout):
+            return False
+
+        source = cls.get_monthly_metadatafile(year, month)
+        if not os.path.isfile(source):
+            return True
+
+        stat = os.stat(source)
+        recorded = (pq.read_schema(fileout).metadata or {}).get(_STORE_SOURCE_KEY)
+        return (recorded is not None and
+                json.loads(recorded) == {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size})
+
+    @classmethod
+    def bulk_build_metadatastore(cls, date, force_dl=False, **kwargs):
+        """ build the metadata store partitions for all months of the input date range.
+
+        date: see get_metadata()
+        **kwargs goes to build_metadatastore()
+
+        Returns
+        -------
+        list
+            paths of the written partition files.
+        """
+        if not hasattr(date, "__iter__"):
+            date = str(date)
+        if isinstance(date, str):
+            start, end = parse_singledate(date)
+        else:
+            start, end = time.Time(date).datetime
+
+        months = cls._daterange_to_monthlist_(start, end)
+        return [cls.build_metadatastore(yyyy, mm, force_dl=force_dl, **kwargs)
+                for yyyy, mm in months]
+
+    @classmethod
+    def _read_metadatastore_(cls, months, start, end, filters=None, columns=None):
+        """ read the store for the given months, pushing down the obsjd range
+        and the {column: values} filters to the parquet reader.
+
+        Returns None if the store does not cover all the requested months
+        or if a partition is older than its monthly file (see
+        is_metadatastore_current).
+        """
+        files = [os.path.join(cls.get_metadatastore_partition(yyyy, mm), "part-0.parquet")
+                 for yyyy, mm in months]
+        if not all(os.path.isfile(f) for f in files):
+            return None
+        for yyyy, mm in months:
+            if not cls.is_metadatastore_current(yyyy, mm):
+                logging.getLogger(__name__).warning(
+                    "stale metadata store for %04d-%02d, reading the monthly metadata"
+                    " (rebuild it with build_metadatastore)", yyyy, mm)
+                return None
+
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(files, format="parquet")
+        if columns is not None:
+            # the original index is stored as column(s)
+            pandas_metadata = json.loads(dataset.schema.metadata[b"pandas"])
+            columns = columns + [col for col in pandas_metadata["index_columns"]
+                                 if isinstance(col, str)]
+            columns = [col for col in columns if col in dataset.schema.names]
+
+        # obsjd is only used to prune row-groups, the exact date selection is
+        # made on obsdate afterwards. Hence the margin.
+        margin = 1 / 24
+        jdstart = time.Time(start.isoformat()).jd - margin
+        jdend = time.Time(end.isoformat()).jd + margin
+        expr = (ds.field("obsjd") >= jdstart) & (ds.field("obsjd") <= jdend)
+        for key, value in (filters or {}).items():
+            if key in dataset.schema.names:
+                expr &= ds.field(key).isin(np.atleast_1d(value).tolist())
+
+        return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
 
     # --------------- #
     #  INTERNAL       #
@@ -618,7 +1132,8 @@ class RawFlatMetaData( RawMetaData ):
     # ================= #    
     @classmethod
     def get_metadata(cls, date, ccdid=None, fid=None, ledid=None,
-                     add_filepath=True, add_ledid=True, **kwargs):
+                     add_filepath=True, add_ledid=True, use_store=True, columns=None,
+                     **kwargs):
         """ General method to access the IRSA metadata given a date or a daterange. 
 
         The format of date is very flexible to quickly get what you need:
@@ -644,11 +1159,19 @@ class RawFlatMetaData( RawMetaData ):
             value or list of ccd (ccdid=[1->16]), filter (fid=[1->3]) or LED (2->13 | but 6)
             to limit to.
 
+        use_store: [bool]
+            read from the metadata store when available (see MetaDataHandler.get_metadata)
+
+        columns: [list]
+            only read these columns (see MetaDataHandler.get_metadata)
+
         Returns
         -------
         dataframe (IRSA metadata)
         """
-        data = super().get_metadata(date, ccdid=ccdid, fid=fid, add_filepath=add_filepath)
+        data = super().get_metadata(date, ccdid=ccdid, fid=fid, add_filepath=add_filepath,
+                                    filters=dict(ledid=ledid), use_store=use_store,
+                                    columns=columns)
         if add_ledid and 'ledid' not in data.columns:
             data = cls._add_ledinfo_to_datafile(data, **kwargs)
 
@@ -661,40 +1184,129 @@ class RawFlatMetaData( RawMetaData ):
     #   Additional      #
     # ================= #    
     @classmethod
-    def add_ledinfo_to_metadata(cls, year, month, use_dask=True, update=False):
-        """ """
-        year, month = int(year), int(month)
-        from ztfquery import io
-        def getval_from_header(filename, value, ext=None, **kwargs):
-            """ """
-            return fits.getval(io.get_file(filename, **kwargs),  value, ext=ext)
-
-        zquery = cls.get_zquery(f"{year:04d}{month:02d}")
-        if "ledid" in zquery.data.columns:
-            warnings.warn("ledid already in data. update=False so nothing to do")
-            return
-        
-        # Only get the first filefracday index, since all filefactday have the same LED.
-        filefracdays= zquery.data[zquery.data["fid"].isin([1,2,3])].groupby("filefracday").head(1)
-        # Get the LEDID
-        files = [l.split("/")[-1] for l in zquery.get_data_path(indexes=filefracdays.index)]
-        if use_dask:
-            import dask
-            ilum_delayed = [dask.delayed(getval_from_header)(file_, "ILUM_LED")  for file_ in files]
-            ilum = dask.delayed(list)(ilum_delayed).compute()
+    def add_ledinfo_to_metadata(cls, date, month=None, max_workers=8, use_dask=False):
+        """ bulk build the ledid index (see get_ledid_indexfile) for the input date range.
+
+        Only the filefracdays that are not indexed yet are read, one raw file
+        per filefracday since all the ccds of an exposure share the same LED.
+
+        Parameters
+        ----------
+        date: see get_metadata()
+            date range to index. For backward compatibility, if month is
+            given, date is understood as the year.
+
+        max_workers: int
+            number of threads reading the raw flat headers.
+
+        use_dask: bool
+            read the headers with dask.delayed instead of threads.
+
+        Returns
+        -------
+        Series
+            the updated filefracday -> ledid index.
+        """
+        if month is not None:
+            date = f"{int(date):04d}{int(month):02d}"
+
+        data = super().get_metadata(date, add_filepath=False, add_dates=False,
+                                    columns=_FILEPATH_COLUMNS)
+        return cls.update_ledid_index(data, max_workers=max_workers, use_dask=use_dask)
+
+    @classmethod
+    def get_ledid_indexfile(cls):
+        """ path of the persisted filefracday -> ledid index """
+        from .io import get_directory
+        directory = get_directory(cls._KIND, cls._SUBKIND)
+        return os.path.join(directory, "meta", f"{cls._KIND}{cls._SUBKIND}_ledid.parquet")
+
+    @classmethod
+    def load_ledid_index(cls):
+        """ load the filefracday -> ledid index
+
+        Returns
+        -------
+        Series
+            ledid indexed by filefracday (empty if the index does not exist yet)
+        """
+        filepath = cls.get_ledid_indexfile()
+        if not os.path.isfile(filepath):
+            return pandas.Series([], name="ledid", dtype="int64",
+                                 index=pandas.Index([], name="filefracday", dtype="int64"))
+
+        return pandas.read_parquet(filepath).set_index("filefracday")["ledid"]
+
+    @classmethod
+    def update_ledid_index(cls, data, max_workers=8, use_dask=False):
+        """ add the filefracdays of data missing in the ledid index.
+
+        Parameters
+        ----------
+        data: DataFrame
+            raw flat metadata, with the filefracday column and either the filepath
+            column or the columns required by metadata_to_url.
+
+        max_workers: int
+            number of threads reading the raw flat headers.
+
+        use_dask: bool
+            read the headers with dask.delayed instead of threads.
+
+        Returns
+        -------
+        Series
+            the updated filefracday -> ledid index.
+        """
+        index = cls.load_ledid_index()
+        new = data[~data["filefracday"].isin(index.index)].groupby("filefracday").head(1)
+        if len(new) == 0:
+            return index
+
+        if "filepath" in new.columns:
+            files = new["filepath"].tolist()
         else:
-            ilum = [getval_from_header(file_, "ILUM_LED")  for file_ in files]
+            files = metadata_to_url(new)
+
+        ledids = np.asarray(cls._read_ledids_(files, max_workers=max_workers,
+                                              use_dask=use_dask), dtype="int64")
+        # failed reads (-1) are not stored, so they are tried again next time.
+        found = ledids >= 0
+        if not found.any():
+            return index
+
+        newindex = pandas.Series(ledids[found], name="ledid",
+                                 index=pandas.Index(new["filefracday"].to_numpy()[found],
+                                                    name="filefracday"))
+
+        # concurrent processes (d2a, FlatPipe) update the same index: the
+        # merge is made on the latest stored index, under lock.
+        fileout = cls.get_ledid_indexfile()
+        with file_lock(f"{fileout}.lock"):
+            index = pandas.concat([cls.load_ledid_index(), newindex])
+            index = index[~index.index.duplicated(keep="last")].sort_index()
+            with atomic_output(fileout) as tmpfile:
+                index.reset_index().to_parquet(tmpfile)
+        return index
+
+    @classmethod
+    def _add_ledinfo_to_datafile(cls, data, use_dask=False, max_workers=8):
+        """ add the ledid column to data joining the ledid index.
+
+        filefracdays not indexed yet are read from the raw files and
+        added to the index.
+        """
+        index = cls.load_ledid_index()
+        if not data["filefracday"].isin(index.index).all():
+            index = cls.update_ledid_index(data, max_workers=max_workers,
+                                           use_dask=use_dask)
+
+        data["ledid"] = data["filefracday"].map(index).fillna(-1).astype("int64")
+        return data
 
-        # merge that with the initial data.            
-        filefracdays.insert(len(filefracdays.columns), "ledid", ilum)
-        data = zquery.data.merge(filefracdays[["filefracday","ledid"]], on="filefracday")
-        # and store it back.
-        fileout = cls.get_monthly_metadatafile(year, month)
-        data.to_parquet(fileout)
-        return
-    
     @staticmethod
-    def _add_ledinfo_to_datafile(data, use_dask=True): 
+    def _read_ledids_(files, max_workers=8, use_dask=False):
+        """ read the ILUM_LED keyword of the input files (-1 if that failed) """
 
         def _get_ledid(fname):
             try:
@@ -703,18 +1315,13 @@ class RawFlatMetaData( RawMetaData ):
                 warnings.warn(f"could not get ledid: {exc}", UserWarning)
                 return -1
 
-        if use_dask :
+        if use_dask:
             import dask
-            _get_ledid = dask.delayed(_get_ledid)
+            return list(dask.compute(*[dask.delayed(_get_ledid)(f) for f in files]))
 
-        file_to_led = data.filepath.map(_get_ledid)
-
-        if use_dask : 
-            data['ledid'] = dask.compute(*file_to_led)
-        else : 
-            data['ledid'] = file_to_led
-
-        return data
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_get_ledid, files))
              
 class RawBiasMetaData( RawMetaData ):
     _SUBKIND = "bias"
@@ -756,8 +1363,5 @@ class RawScienceMetaData( RawMetaData ):
         -------
         dataframe (IRSA metadata)
         """
-        data = super().get_metadata(date, ccdid=ccdid, fid=fid, add_filepath=add_filepath)
-        if field is not None:
-            data = data[data["field"].isin(np.atleast_1d(field))]
-            
-        return data
+        return super().get_metadata(date, ccdid=ccdid, fid=fid, add_filepath=add_filepath,
+                                    filters=dict(field=field), **kwargs)
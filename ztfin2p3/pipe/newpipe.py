@@ -1,5 +1,7 @@
 import datetime
+import hashlib
 import itertools
+import json
 import logging
 import os
 
@@ -14,6 +16,46 @@ FILTER2LED = {"zg": [2, 3, 4, 5], "zr": [7, 8, 9, 10], "zi": [11, 12, 13]}
 LED2FILTER = {led: filt for filt, leds in FILTER2LED.items() for led in leds}
 
 
+# build options that do not change the products (not fingerprinted)
+_FINGERPRINT_IGNORED = {"max_bytes", "tmpdir", "max_scratch_bytes", "tiled", "memmap"}
+
+
+def compute_fingerprint(filepaths, **params):
+    """Fingerprint of a calibration product: sha1 of the input files
+    (name and size), the processing parameters and the code versions.
+
+    Parameters
+    ----------
+    filepaths: list
+        input files (can be nested lists).
+
+    **params
+        processing parameters (json serializable or str-able).
+
+    Returns
+    -------
+    str
+        hexadecimal sha1 (40 characters).
+    """
+    if len(filepaths) > 0 and isinstance(filepaths[0], list):
+        filepaths = list(itertools.chain(*filepaths))
+
+    files = []
+    for filepath in filepaths:
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = -1
+        files.append([os.path.basename(filepath), size])
+
+    params = {k: v for k, v in params.items() if k not in _FINGERPRINT_IGNORED}
+    content = json.dumps(
+        dict(files=files, params=params, ztfin2p3=__version__, ztfimg=ztfimg_version),
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
 def ensure_path_exists(filename):
     path = os.path.dirname(filename)
     if not os.path.isdir(path):
@@ -54,6 +96,7 @@ class CalibPipe:
                 lambda row: io.get_daily_biasfile(row.day, row.ccdid), axis=1
             )
         self.df["ccd"] = None
+        self.df["fingerprint"] = None
 
         if nskip is not None:
             self.df["filepath"] = self.df["filepath"].map(lambda x: x[nskip:])
@@ -72,10 +115,18 @@ class CalibPipe:
         load_if_exists: bool = False,
         reprocess: bool = False,
         save: bool = True,
+        product_format: str = "fits",
+        memmap: bool = False,
         **kwargs,
     ):
         """Compute/save/load the daily calibration file.
 
+        Existing files are only recomputed if their fingerprint (FINGERPR
+        header key, see compute_fingerprint) differs from the one of the
+        current inputs and parameters. Files without fingerprint are kept.
+        The built data are kept in ``df.ccd`` (e.g. for the flat stage,
+        see get_ccd).
+
         Parameters
         ----------
         corr_overscan : bool
@@ -86,9 +137,15 @@ class CalibPipe:
         load_if_exists : bool
             Load existing files in memory?
         reprocess : bool
-            Reprocess existing files?
+            Reprocess existing files, whatever their fingerprint?
         save : bool
             Save the processed files?
+        product_format : str
+            Layout of the saved files, see io.write_calib_product
+        memmap : bool
+            = ignored if not save =
+            keep a (read-only) memory map of the saved file instead of
+            the built array, to release its memory.
         **kwargs
             Instruction to average the data, passed to
             ztfimg.collection.ImageCollection.get_meandata()
@@ -96,7 +153,12 @@ class CalibPipe:
         """
         for i, row in self.df.iterrows():
             filename = row.fileout
-            if reprocess or not os.path.exists(filename):
+            fingerprint = compute_fingerprint(
+                row.filepath, corr_overscan=corr_overscan, corr_nl=corr_nl,
+                product_format=product_format, **kwargs
+            )
+            self.df.at[i, "fingerprint"] = fingerprint
+            if reprocess or self.needs_build(filename, fingerprint):
                 self.logger.info(
                     "processing %s %s (%d files)", self.kind, row.day, len(row.filepath)
                 )
@@ -108,9 +170,14 @@ class CalibPipe:
                 )
                 if save:
                     self.logger.info("writing file %s", filename)
-                    hdr = self.build_header(row)
+                    hdr = self.build_header(row, FINGERPR=fingerprint)
                     ensure_path_exists(filename)
-                    fits.writeto(filename, data, header=hdr, overwrite=True)
+                    io.write_calib_product(
+                        filename, data, header=hdr, product_format=product_format
+                    )
+                    io.append_calib_log(self.kind, filename, hdr)
+                    if memmap:
+                        data = io.read_calib_product(filename, memmap=True)[0]
             elif load_if_exists:
                 self.logger.info("loading file %s", filename)
                 data = CCD.from_filename(filename)
@@ -120,18 +187,65 @@ class CalibPipe:
             if data is not None:
                 self.df.at[i, "ccd"] = data
 
-    def store_ccds(self, overwrite: bool = True, **kwargs):
+    def store_ccds(
+        self, overwrite: bool = True, product_format: str = "fits", **kwargs
+    ):
         """Store created ccds.
-        Extra arguments are passed to `fits.writeto`.
+        Extra arguments are passed to `io.write_calib_product`.
         """
         for i, row in self.df.iterrows():
             hdr = self.build_header(row)
+            if row.fingerprint is not None:
+                hdr["FINGERPR"] = row.fingerprint
             ensure_path_exists(row.fileout)
-            fits.writeto(
-                row.fileout, row.ccd, header=hdr, overwrite=overwrite, **kwargs
+            io.write_calib_product(
+                row.fileout,
+                row.ccd,
+                header=hdr,
+                product_format=product_format,
+                overwrite=overwrite,
+                **kwargs,
             )
+            io.append_calib_log(self.kind, row.fileout, hdr)
+
+    def needs_build(self, filename: str, fingerprint: str) -> bool:
+        """Should the product be (re)built ? True if the file does not exist
+        or if its fingerprint differs. Legacy files (no fingerprint) are kept.
+        """
+        if not os.path.exists(filename):
+            return True
+
+        previous = fits.getheader(filename).get("FINGERPR")
+        if previous is None:
+            self.logger.debug("no fingerprint in %s, kept", filename)
+            return False
+        if previous != fingerprint:
+            self.logger.info("inputs or parameters changed for %s", filename)
+            return True
+        return False
 
     def get_ccd(self, day: str, ccdid: int = None, **kwargs):
+        """Get the calibration data, built or loaded.
+
+        Data not kept by build_ccds are loaded through the science
+        calibration cache (shared and read-only).
+        """
+        from ..science import get_calib_cache
+
+        idx = self._get_index(day, ccdid=ccdid, **kwargs)
+        row = self.df.loc[idx]
+        if row.ccd is None or (
+            isinstance(row.ccd, list) and all(x is None for x in row.ccd)
+        ):
+            self.logger.info("loading file %s", row.fileout)
+            self.df.at[idx, "ccd"] = get_calib_cache().get(row.fileout)
+        return self.df.loc[idx].ccd
+
+    def get_fileout(self, day: str, ccdid: int = None, **kwargs):
+        """Path of the calibration file, without loading it."""
+        return self.df.loc[self._get_index(day, ccdid=ccdid, **kwargs)].fileout
+
+    def _get_index(self, day: str, ccdid: int = None, **kwargs):
         sel = self.df.day == day
         if ccdid is not None:
             sel &= self.df.ccdid == ccdid
@@ -144,14 +258,7 @@ class CalibPipe:
             raise ValueError("not found")
         elif len(idx) > 1:
             raise ValueError("selection is not unique")
-
-        row = self.df.loc[idx[0]]
-        if row.ccd is None or (
-            isinstance(row.ccd, list) and all(x is None for x in row.ccd)
-        ):
-            self.logger.info("loading file %s", row.fileout)
-            self.df.at[idx[0], "ccd"] = CCD.from_filename(row.fileout)
-        return self.df.loc[idx[0]].ccd
+        return idx[0]
 
     def build_header(self, row, **kwargs):
         now = datetime.datetime.now().isoformat()
@@ -211,6 +318,7 @@ class FlatPipe(CalibPipe):
         _groupbyk = ["day", "ccdid", "filterid"]
         self.df = self.df.groupby(_groupbyk).aggregate(list).reset_index()
         self.df["nled"] = self.df.ledid.map(len)
+        self.df["fingerprint"] = None
         self.df.fileout = self.df.apply(
             lambda row: io.get_daily_flatfile(
                 row.day, row.ccdid, filtername=row.filterid
@@ -235,6 +343,7 @@ class FlatPipe(CalibPipe):
         reprocess: bool = False,
         save: bool = True,
         weights: dict[str, list[float]] | None = None,
+        product_format: str = "fits",
         **kwargs,
     ):
         """Compute/save/load the daily calibration file.
@@ -259,6 +368,8 @@ class FlatPipe(CalibPipe):
         weights : dict
             Dictionnary storing for each filter the weights to apply to each led.
             default ``dict(zg=None, zr=None, zi=None)``.
+        product_format : str
+            Layout of the saved files, see io.write_calib_product
         **kwargs
             Instruction to average the data, passed to
             ztfimg.collection.ImageCollection.get_meandata()
@@ -269,7 +380,19 @@ class FlatPipe(CalibPipe):
 
         for i, row in self.df.iterrows():
             filename = row.fileout
-            if reprocess or not os.path.exists(filename):
+            # the flat depends on the bias it is corrected with.
+            bias_fingerprint = (
+                bias.df.loc[bias._get_index(row.day, ccdid=row.ccdid)].fingerprint
+                if bias is not None else None
+            )
+            fingerprint = compute_fingerprint(
+                row.filepath, bias=bias_fingerprint, corr_nl=corr_nl,
+                corr_overscan=corr_overscan, corr_pocket=corr_pocket,
+                normalize=normalize, weights=weights[row.filterid],
+                product_format=product_format, **kwargs
+            )
+            self.df.at[i, "fingerprint"] = fingerprint
+            if reprocess or self.needs_build(filename, fingerprint):
                 self.logger.info(
                     "processing %s %s filter=%s", self.kind, row.day, row.filterid
                 )
@@ -300,9 +423,12 @@ class FlatPipe(CalibPipe):
 
                 if save:
                     self.logger.info("writing file %s", filename)
-                    hdr = self.build_header(row, FLTNORM=norm)
+                    hdr = self.build_header(row, FLTNORM=norm, FINGERPR=fingerprint)
                     ensure_path_exists(filename)
-                    fits.writeto(filename, data, header=hdr, overwrite=True)
+                    io.write_calib_product(
+                        filename, data, header=hdr, product_format=product_format
+                    )
+                    io.append_calib_log(self.kind, filename, hdr)
             elif load_if_exists:
                 self.logger.info("loading file %s", filename)
                 data = CCD.from_filename(filename)
@@ -1,8 +1,13 @@
 """ Module to create the science files """
 
+import itertools
 import logging
 import os
 import pathlib
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import dask
@@ -15,11 +20,18 @@ from ztfquery.buildurl import filename_to_url, get_scifile_of_filename, parse_fi
 from . import __version__
 from .io import (
     CAL_DIR,
+    append_calib_log,
     get_daily_biasfile,
     get_daily_flatfile,
     ipacfilename_to_ztfin2p3filepath,
+    read_calib_product,
 )
-from .metadata import get_sciheader
+from .metadata import filename_to_metadata, get_sciheader, get_sciheaders
+
+# maximum memory used by the master calibration cache (see CalibFrameCache)
+CALIB_CACHE_MAXBYTES = 4 * 1024**3
+# maximum memory of the raw exposures read ahead (see prefetch_raw_exposures)
+PREFETCH_MAXBYTES = 2 * 1024**3
 
 
 def build_science_exposure(rawfiles, flats, biases, dask_level="deep", **kwargs):
@@ -85,6 +97,7 @@ def build_science_image(
     overwrite=True,
     with_mask=False,
     corr_fringes=False,
+    calib_cache=True,
     **kwargs,
 ):
     """Top level method to build a single processed image.
@@ -160,6 +173,10 @@ def build_science_image(
     corr_fringes : bool
         Correct atmospheric fringes for i-band only.
 
+    calib_cache : bool
+        Load master bias/flat given as filepath through the process-wide
+        calibration cache (see get_calib_cache) ?
+
     **kwargs :
         Arguments passed to the ztfimg.RawCCD.get_data of the raw object image.
 
@@ -181,14 +198,14 @@ def build_science_image(
     if corr_fringes and filtername != 'zi':
         corr_fringes = False
 
+    # filepaths are loaded by build_science_data (see calib_cache)
     if bias is None:
-        biasfile = find_closest_calib_file(
+        bias = find_closest_calib_file(
             year, date, ccdid, kind="bias", max_timedelta=max_timedelta
         )
-        bias = ztfimg.CCD.from_filename(biasfile)
 
     if flat is None:
-        flatfile = find_closest_calib_file(
+        flat = find_closest_calib_file(
             year,
             date,
             ccdid,
@@ -196,7 +213,6 @@ def build_science_image(
             kind="flat",
             max_timedelta=max_timedelta,
         )
-        flat = ztfimg.CCD.from_filename(flatfile)
 
     # new of ipac sciimg.
     ipac_filepaths = get_scifile_of_filename(rawfile, source="local")
@@ -234,6 +250,7 @@ def build_science_image(
         corr_overscan=corr_overscan,
         corr_pocket=corr_pocket,
         fp_flatfield=fp_flatfield,
+        calib_cache=calib_cache,
         **kwargs,
     )
 
@@ -252,26 +269,13 @@ def build_science_image(
         )
 
     if return_sci_quads:
-        quads = []
-
-        for data, header, fname in zip(new_data, new_header, new_filenames):
-            quad = ztfimg.ScienceQuadrant(data=data, header=header)
-            if with_mask:
-                quad.set_mask(get_mskdata(fname))
-
-            if corr_fringes :
-                from .utils.tools import correct_fringes_zi
-                 # Need custom fringez package. For now optional.
-                 # In the future corr_fringes will default to True.
-                corr_data = correct_fringes_zi(quad.data,
-                                                mask_data=quad.mask,
-                                                image_path=fname)[0]
-
-                quad.set_data(corr_data) #Overwrite with data.
-                # Could save model and PCA components if needed.
-
-            quads.append(quad)
-        return quads
+        return build_science_quads(
+            new_data,
+            new_header,
+            new_filenames,
+            with_mask=with_mask,
+            corr_fringes=corr_fringes,
+        )
     elif store:
         return new_filenames
     else:
@@ -280,6 +284,452 @@ def build_science_image(
         )
 
 
+def build_science_batch(
+    rawfiles,
+    flats=None,
+    biases=None,
+    *,
+    batch_size=8,
+    corr_nl=True,
+    corr_overscan=True,
+    corr_pocket=False,
+    flat_coef=None,
+    fp_flatfield=False,
+    max_timedelta="1w",
+    newfile_dict={},
+    return_sci_quads=True,
+    store=False,
+    outpath=None,
+    overwrite=True,
+    with_mask=False,
+    corr_fringes=False,
+    calib_cache=True,
+    prefetch=None,
+    timings=None,
+    **kwargs,
+):
+    """Build the science quadrants of many raw images, by batches.
+
+    Consecutive raw images sharing the same ccd, master bias and master flat
+    are processed together: their raw data are loaded in a preallocated
+    [batch_size, N, M] float32 buffer, detrended in place (see
+    detrend_inplace) with a flat scaling computed once, and split
+    into quadrants that are views on that buffer.
+    dask is not supported.
+
+    Parameters
+    ----------
+    rawfiles: list
+        filenames or filepaths of raw images.
+
+    flats, biases: list, None
+        list of str (filepath), ztfimg.CCD or None, matching rawfiles.
+        None (or None entries) means the closest master is used
+        (see find_closest_calib_file).
+
+    batch_size: int
+        maximum number of raw images detrended together.
+        Memory is ~ batch_size * 150MB.
+
+    corr_pocket: bool, list
+        Should data be corrected for the pocket effect. A list gives
+        one value per raw image.
+
+    return_sci_quads : bool
+        If True, yields ztfimg.ScienceQuadrants. Otherwise, filepaths.
+
+    calib_cache : bool
+        Load master bias/flat filepaths through get_calib_cache() ?
+
+    prefetch : dict, None
+        options of prefetch_raw_exposures (depth, max_bytes, threads)
+        to read the raw data, headers and masks ahead on background
+        threads. None means they are read when needed.
+
+    timings : dict, None
+        if given, the time spent waiting for the raw exposures
+        ("read_wait"), detrending ("detrend") and building the headers
+        and quadrants ("finish") are added to it (in sec.).
+
+    **kwargs :
+        all the other options are the same as build_science_image().
+
+    Yields
+    ------
+    str, list or Exception
+        for each rawfile, in input order: the rawfile and either the list of
+        its ScienceQuadrants (or filepaths) or the exception raised while
+        processing it.
+    """
+    rawfiles = list(rawfiles)
+    nfiles = len(rawfiles)
+    flats = [None] * nfiles if flats is None else list(flats)
+    biases = [None] * nfiles if biases is None else list(biases)
+    corr_pocket = list(np.broadcast_to(np.asarray(corr_pocket, dtype=bool), (nfiles,)))
+
+    infos = [parse_filename(rawfile) for rawfile in rawfiles]
+    dates = [pd.to_datetime(f"{info['year']}{info['month']}{info['day']}") for info in infos]
+    ccdids = [int(info["ccdid"]) for info in infos]
+    filternames = [info["filtercode"] for info in infos]
+
+    # missing master bias/flat (None) are resolved at once.
+    calib_index = get_calibration_index()
+    for kind, calibs in (("bias", biases), ("flat", flats)):
+        missing = [i for i, calib in enumerate(calibs) if calib is None]
+        if len(missing) == 0:
+            continue
+        resolved = calib_index.resolve(
+            [dates[i] for i in missing],
+            [ccdids[i] for i in missing],
+            [filternames[i] for i in missing] if kind == "flat" else None,
+            kind=kind,
+            max_timedelta=max_timedelta,
+            errors="coerce",
+        )
+        for i, filepath in zip(missing, resolved):
+            calibs[i] = filepath
+
+    def _calibkey(calib):
+        return calib if isinstance(calib, str) or calib is None else id(calib)
+
+    # consecutive groups of images sharing ccd, calibrations and options.
+    keys = [
+        (ccdids[i], _calibkey(biases[i]), _calibkey(flats[i]), corr_pocket[i])
+        for i in range(nfiles)
+    ]
+    groups = [list(g) for _, g in itertools.groupby(range(nfiles), key=keys.__getitem__)]
+
+    # raw exposures are consumed in input order.
+    exposures = prefetch_raw_exposures(
+        rawfiles,
+        corr_pocket=corr_pocket,
+        with_mask=with_mask and return_sci_quads,
+        timings=timings,
+        corr_nl=corr_nl,
+        corr_overscan=corr_overscan,
+        **(prefetch if prefetch is not None else dict(depth=0)),
+        **kwargs,
+    )
+
+    for group in groups:
+        first = group[0]
+        try:
+            bias, biasfile, flat_scale, flatfile = _load_batch_calibrations(
+                biases[first],
+                flats[first],
+                flat_coef=flat_coef,
+                fp_flatfield=fp_flatfield,
+                calib_cache=calib_cache,
+                max_timedelta=max_timedelta,
+            )
+        except Exception as exc:
+            for i in group:
+                next(exposures)
+                yield rawfiles[i], exc
+            continue
+
+        for start in range(0, len(group), batch_size):
+            batch = group[start : start + batch_size]
+            buffer, loaded, extras = None, {}, {}
+            for j, i in enumerate(batch):
+                _, exposure = next(exposures)
+                if isinstance(exposure, Exception):
+                    loaded[i] = exposure
+                    continue
+
+                data = exposure.pop("data")
+                if buffer is None:
+                    buffer = np.empty((len(batch), *data.shape), dtype=data.dtype)
+                buffer[j] = data
+                loaded[i], extras[i] = j, exposure
+                del data
+
+            if buffer is not None:
+                t0 = time.perf_counter()
+                detrend_inplace(buffer, bias, *flat_scale)
+                _add_timing(timings, "detrend", time.perf_counter() - t0)
+
+            for i in batch:
+                if isinstance(loaded[i], Exception):
+                    yield rawfiles[i], loaded[i]
+                    continue
+
+                t0 = time.perf_counter()
+                try:
+                    result = _finish_science_image(
+                        rawfiles[i],
+                        _split_quadrants(buffer[loaded[i]]),
+                        biasfile,
+                        flatfile,
+                        newfile_dict=newfile_dict,
+                        outpath=outpath,
+                        store=store,
+                        overwrite=overwrite,
+                        return_sci_quads=return_sci_quads,
+                        with_mask=with_mask,
+                        corr_fringes=corr_fringes and filternames[i] == "zi",
+                        rawheaders=extras[i]["rawheaders"],
+                        masks=extras[i]["masks"],
+                    )
+                except Exception as exc:
+                    result = exc
+                _add_timing(timings, "finish", time.perf_counter() - t0)
+                yield rawfiles[i], result
+
+
+def prefetch_raw_exposures(
+    rawfiles,
+    corr_pocket=False,
+    with_headers=True,
+    with_mask=False,
+    depth=2,
+    max_bytes=PREFETCH_MAXBYTES,
+    threads=2,
+    timings=None,
+    **kwargs,
+):
+    """Read raw exposures ahead of their use, on background threads.
+
+    Up to depth exposures (raw ccd data, raw headers and quadrant masks)
+    are read ahead of the one being processed, as long as they fit in
+    max_bytes, so that the reading latency overlaps with the processing
+    of the current exposure.
+
+    Parameters
+    ----------
+    rawfiles: list
+        filenames or filepaths of raw images.
+
+    corr_pocket: bool, list
+        Should data be corrected for the pocket effect. A list gives
+        one value per raw image.
+
+    with_headers, with_mask: bool
+        Read the raw headers (see read_raw_headers) and the quadrant masks ?
+
+    depth: int
+        maximum number of exposures read ahead. 0 means each exposure is
+        read when requested, in the calling thread.
+
+    max_bytes: int
+        maximum memory of the exposures read ahead. The size of an
+        exposure is known once the first one is read.
+
+    threads: int
+        number of reading threads.
+
+    timings: dict, None
+        if given, the time spent waiting for the exposures is added
+        to its "read_wait" key (in sec.).
+
+    **kwargs goes to ztfimg.RawCCD.get_data()
+
+    Yields
+    ------
+    str, dict or Exception
+        for each rawfile, in input order: the rawfile and either a dict
+        with data, rawheaders and masks (None if not read) or the exception
+        raised while reading it.
+    """
+    rawfiles = list(rawfiles)
+    nfiles = len(rawfiles)
+    corr_pocket = list(np.broadcast_to(np.asarray(corr_pocket, dtype=bool), (nfiles,)))
+
+    def _read(i):
+        return _read_raw_exposure(rawfiles[i], corr_pocket=corr_pocket[i],
+                                  with_headers=with_headers, with_mask=with_mask,
+                                  **kwargs)
+
+    if depth <= 0:
+        for i, rawfile in enumerate(rawfiles):
+            t0 = time.perf_counter()
+            try:
+                exposure = _read(i)
+            except Exception as exc:
+                exposure = exc
+            _add_timing(timings, "read_wait", time.perf_counter() - t0)
+            yield rawfile, exposure
+        return
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    pending, itemsize = deque(), None
+    toread = iter(range(nfiles))
+
+    def _fill():
+        # read ahead, within depth and max_bytes.
+        while len(pending) < depth and (
+            len(pending) == 0 or
+            itemsize is not None and (len(pending) + 1) * itemsize <= max_bytes
+        ):
+            i = next(toread, None)
+            if i is None:
+                return
+            pending.append(executor.submit(_read, i))
+
+    try:
+        for rawfile in rawfiles:
+            _fill()
+            t0 = time.perf_counter()
+            try:
+                exposure = pending.popleft().result()
+                itemsize = exposure["nbytes"]
+            except Exception as exc:
+                exposure = exc
+            _add_timing(timings, "read_wait", time.perf_counter() - t0)
+            _fill() # the next ones are read while this one is processed.
+            yield rawfile, exposure
+    finally:
+        # the exposures not yet started are not read (python 3.8 has no
+        # shutdown(cancel_futures=True)).
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def read_raw_headers(rawfile):
+    """Read the primary and the 4 quadrant headers of a raw ccd file.
+
+    Returns
+    -------
+    list
+        [primary, q1, q2, q3, q4] headers, the primary being stripped.
+    """
+    # a single file opening for all the headers.
+    with fits.open(rawfile) as hdul:
+        rawheaders = [hdul[ext].header.copy() for ext in range(5)]
+    rawheaders[0].strip()
+    return rawheaders
+
+
+def _read_raw_exposure(rawfile, corr_pocket=False, with_headers=True,
+                       with_mask=False, **kwargs):
+    """Read the data, headers and masks of a raw exposure (see prefetch_raw_exposures)."""
+    rawccd = ztfimg.RawCCD.from_filename(rawfile, as_path=True, use_dask=False)
+    data = rawccd.get_data(corr_pocket=corr_pocket, **kwargs)
+    rawheaders = read_raw_headers(rawfile) if with_headers else None
+    masks = (
+        [get_mskdata(f) for f in get_scifile_of_filename(rawfile, source="local")]
+        if with_mask else None
+    )
+    nbytes = data.nbytes + sum(m.nbytes for m in masks or [] if m is not None)
+    return dict(data=data, rawheaders=rawheaders, masks=masks, nbytes=nbytes)
+
+
+def _add_timing(timings, key, value):
+    """Add value to timings[key], if timings is given."""
+    if timings is not None:
+        timings[key] = timings.get(key, 0) + value
+
+
+def build_science_quads(new_data, new_headers, new_filenames, with_mask=False,
+                        corr_fringes=False, masks=None):
+    """Build the ztfimg.ScienceQuadrant of processed quadrant data.
+
+    Parameters
+    ----------
+    new_data, new_headers, new_filenames: list
+        quadrant data, headers and ztfin2p3 filepaths.
+
+    with_mask : bool
+        Read mask file and add it to the ScienceQuadrant object ?
+
+    corr_fringes : bool
+        Correct atmospheric fringes (i-band only).
+
+    masks : list, None
+        already read quadrant masks, used if with_mask. None means they
+        are read from the mask files.
+
+    Returns
+    -------
+    list
+        ztfimg.ScienceQuadrant
+    """
+    quads = []
+    if masks is None:
+        masks = [None] * len(new_filenames)
+    for data, header, fname, mask in zip(new_data, new_headers, new_filenames, masks):
+        quad = ztfimg.ScienceQuadrant(data=data, header=header)
+        if with_mask:
+            quad.set_mask(get_mskdata(fname) if mask is None else mask)
+
+        if corr_fringes :
+            from .utils.tools import correct_fringes_zi
+             # Need custom fringez package. For now optional.
+             # In the future corr_fringes will default to True.
+            corr_data = correct_fringes_zi(quad.data,
+                                            mask_data=quad.mask,
+                                            image_path=fname)[0]
+
+            quad.set_data(corr_data) #Overwrite with data.
+            # Could save model and PCA components if needed.
+
+        quads.append(quad)
+    return quads
+
+
+def _load_batch_calibrations(bias, flat, flat_coef=None, fp_flatfield=False,
+                             calib_cache=True, max_timedelta="1w"):
+    """Get the bias data and the flat correction (see get_flat_scale)
+    used by build_science_batch.
+
+    Returns
+    -------
+    array, str, (array, float), str
+        bias data, bias filepath, flat correction and flat filepath.
+    """
+    if bias is None or flat is None:
+        kind = "bias" if bias is None else "flat"
+        raise ValueError(f"no master {kind} found within {max_timedelta}")
+
+    def _read_ccd(calib):
+        if not isinstance(calib, str):
+            return calib, getattr(calib, "filepath", None)
+        if calib_cache:
+            return get_calib_cache().get(calib), calib
+        return ztfimg.CCD.from_filename(calib, as_path=True, use_dask=False), calib
+
+    biasccd, biasfile = _read_ccd(bias)
+    flatccd, flatfile = _read_ccd(flat)
+
+    bias_data = biasccd.get_data() if isinstance(biasccd, ztfimg.CCD) else biasccd
+    prop = dict(flat_coef=flat_coef, fp_flatfield=fp_flatfield)
+    if calib_cache and isinstance(flat, str):
+        flat_scale = get_calib_cache().get_flat_scale(flat, flatccd, **prop)
+    else:
+        flat_scale = get_flat_scale(flatccd, **prop)
+    return bias_data, biasfile, flat_scale, flatfile
+
+
+def _finish_science_image(rawfile, new_data, biasfile, flatfile, newfile_dict={},
+                          outpath=None, store=False, overwrite=True,
+                          return_sci_quads=True, with_mask=False, corr_fringes=False,
+                          rawheaders=None, masks=None):
+    """Headers, storage and ScienceQuadrant of processed quadrant data
+    (as build_science_image does after build_science_data)."""
+    ipac_filepaths = get_scifile_of_filename(rawfile, source="local")
+    new_filenames = [
+        ipacfilename_to_ztfin2p3filepath(f, **newfile_dict) for f in ipac_filepaths
+    ]
+    if outpath is not None:
+        new_filenames = [
+            os.path.join(outpath, os.path.basename(f)) for f in new_filenames
+        ]
+
+    new_header = build_science_headers(
+        rawfile, ipac_filepaths, rawheaders=rawheaders,
+        BIASFILE=biasfile, FLATFILE=flatfile
+    )
+    if store:
+        store_science_image(new_data, new_header, new_filenames, overwrite=overwrite)
+
+    if return_sci_quads:
+        return build_science_quads(new_data, new_header, new_filenames,
+                                   with_mask=with_mask, corr_fringes=corr_fringes,
+                                   masks=masks)
+    return new_filenames
+
+
 # ------------- #
 #  mid-level    #
 # ------------- #
@@ -293,6 +743,7 @@ def build_science_data(
     corr_overscan=True,
     as_path=True,
     fp_flatfield=False,
+    calib_cache=True,
     **kwargs,
 ):
     """build a single processed image data
@@ -333,6 +784,12 @@ def build_science_data(
         if given, this will multiply to the flat
         flatused = flat*flatcoef
 
+    calib_cache: bool
+        = ignored if dask is used =
+        load flat and bias given as filepath through the process-wide
+        calibration cache (see get_calib_cache) ?
+        The input flat and bias data are never modified.
+
     Returns
     ----------
     list
@@ -346,27 +803,26 @@ def build_science_data(
     use_dask = dask_level is not None
     flatfile = biasfile = None
 
+    def _read_ccd(filepath):
+        if calib_cache and not use_dask:
+            return get_calib_cache().get(filepath)
+        return ztfimg.CCD.from_filename(filepath, as_path=True, use_dask=use_dask)
+
     # Generic I/O for flat and bias
+    flat_cached = isinstance(flat, str) and calib_cache and not use_dask
     if isinstance(flat, str):
-        flat = ztfimg.CCD.from_filename(flat, as_path=True, use_dask=use_dask)
+        flatfile = flat
+        flat = _read_ccd(flat)
 
     if isinstance(flat, ztfimg.CCD):
-        flatfile = flat.filepath
-        flat_data = flat.get_data()
+        flatfile = flatfile or flat.filepath
     else:  # numpy or dask
         raise ValueError(f"Cannot parse the input flat type ({type(flat)})")
 
-    if flat_coef is not None:
-        flat_data *= flat_coef
-
-    if fp_flatfield:
-        fp_flat_norm = flat.header['HIERARCH FLTNORM_FP'] / flat.header['FLTNORM']
-
     # bias
     if isinstance(bias, str):
         biasfile = bias
-        bias = ztfimg.CCD.from_filename(bias, as_path=True,
-                                        use_dask=use_dask).get_data()
+        bias = _read_ccd(bias).get_data()
     elif isinstance(bias, ztfimg.CCD):
         biasfile = bias.filepath
         bias = bias.get_data()
@@ -396,29 +852,122 @@ def build_science_data(
                                              shape=ztfimg.RawCCD.SHAPE)
 
     # calib_data = XXX # Pixel bias correction comes here
-    calib_data -= bias  # bias correction
-    calib_data /= flat_data  # flat correction
-    if fp_flatfield:
-        calib_data *= fp_flat_norm
+    if not use_dask:
+        # bias, flat and norm in a single pass on the (new) raw data;
+        # the flat and bias data (maybe cached) are not modified.
+        if flat_cached:
+            flat_scale = get_calib_cache().get_flat_scale(
+                flatfile, flat, flat_coef=flat_coef, fp_flatfield=fp_flatfield
+            )
+        else:
+            flat_scale = get_flat_scale(flat, flat_coef=flat_coef, fp_flatfield=fp_flatfield)
+
+        detrend_inplace(calib_data, bias, *flat_scale)
+        new_data = _split_quadrants(calib_data) # q1, q2, q3, q4 views
+        return new_data, biasfile, flatfile
+
+    flat_data, fp_flat_norm = get_flat_scale(flat, flat_coef=flat_coef,
+                                             fp_flatfield=fp_flatfield)
+    calib_data = calib_data - bias  # bias correction
+    calib_data = calib_data / flat_data  # flat correction
+    if fp_flat_norm is not None:
+        calib_data = calib_data * fp_flat_norm
 
     # CCD object to accurately split the data.
-    sciccd = ztfimg.CCD.from_data(calib_data) # dask.array if use_dask
+    sciccd = ztfimg.CCD.from_data(calib_data) # dask.array
     new_data = sciccd.get_quadrantdata(from_data=True, reorder=False) # q1, q2, q3, q4
     return new_data, biasfile, flatfile
 
 
-def build_science_headers(rawfile, ipac_filepaths, use_dask=False, **kwargs):
+def detrend_inplace(data, bias, flat_data, fp_flat_norm=None, strip_rows=64):
+    """Detrend data in place: data = (data - bias) / flat_data * fp_flat_norm
+
+    The image is processed by strips of strip_rows rows, so that all
+    operations are made while the strip is in cache, and no temporary
+    array is created. The operations are those of the per-file
+    detrending, so that the results are identical.
+
+    Parameters
+    ----------
+    data: array
+        [N, M] or [n, N, M] raw data, modified in place.
+
+    bias: array
+        [N, M] bias data (not modified).
+
+    flat_data: array
+        [N, M] flat, with flat_coef applied (see get_flat_scale, not modified).
+
+    fp_flat_norm: float, None
+        focal plane normalization, if any.
+
+    strip_rows: int
+        number of rows processed at once.
+
+    Returns
+    -------
+    array
+        the input data.
+    """
+    images = data.reshape(-1, *data.shape[-2:])
+    for image in images:
+        for start in range(0, image.shape[0], strip_rows):
+            rows = slice(start, start + strip_rows)
+            strip = image[rows]
+            np.subtract(strip, bias[rows], out=strip)
+            np.divide(strip, flat_data[rows], out=strip)
+            if fp_flat_norm is not None:
+                np.multiply(strip, fp_flat_norm, out=strip)
+    return data
+
+
+def get_flat_scale(flat, flat_coef=None, fp_flatfield=False):
+    """Get the flat correction used by detrend_inplace.
+
+    Parameters
+    ----------
+    flat: ztfimg.CCD
+        master flat (its data are not modified).
+
+    flat_coef: float
+        if given, the flat used is flat*flatcoef
+
+    fp_flatfield : bool
+        apply the focal plane normalization (FLTNORM_FP / FLTNORM) ?
+
+    Returns
+    -------
+    array, float
+        flat data (a copy if flat_coef is given) and the focal plane
+        normalization (None if not fp_flatfield).
+    """
+    flat_data = flat.get_data()
+    if flat_coef is not None:
+        flat_data = flat_data.copy()
+        flat_data *= flat_coef
+
+    fp_flat_norm = None
+    if fp_flatfield:
+        fp_flat_norm = flat.header['HIERARCH FLTNORM_FP'] / flat.header['FLTNORM']
+    return flat_data, fp_flat_norm
+
+
+def build_science_headers(rawfile, ipac_filepaths, use_dask=False, rawheaders=None,
+                          **kwargs):
     maybe_delayed = dask.delayed if use_dask else identity
     new_headers = []
-    rawhdr = fits.getheader(rawfile)
-    rawhdr.strip()
+    if rawheaders is None: # [primary, q1, q2, q3, q4]
+        rawheaders = read_raw_headers(rawfile)
+    rawhdr = rawheaders[0]
+    if use_dask:
+        scihdrs = [maybe_delayed(exception_header)(f) for f in ipac_filepaths]
+    else:
+        scihdrs = exception_headers(ipac_filepaths, expid=rawhdr.get("EXPID"))
 
-    for sciimg_ in ipac_filepaths:
+    for sciimg_, scihdr in zip(ipac_filepaths, scihdrs):
         header = rawhdr.copy()
         qid = parse_filename(sciimg_)['qid']
-        headerquad = fits.getheader(rawfile, ext=qid)
-        header.update(headerquad)
-        scihdr = maybe_delayed(exception_header)(sciimg_)
+        header.update(rawheaders[int(qid)])
         if scihdr is not None:
             header.update(scihdr)
         header = maybe_delayed(header_from_quadrantheader)(header)
@@ -431,11 +980,51 @@ def build_science_headers(rawfile, ipac_filepaths, use_dask=False, **kwargs):
 def exception_header(file_):
     hdr = get_sciheader(file_)
     if hdr is None:
-        try:
-            hdr = fits.getheader(file_)
-            hdr.strip()
-        except Exception as e:
-            logging.getLogger(__name__).warn("%s", e)
+        hdr = _read_sciimg_header(file_)
+    return hdr
+
+
+def exception_headers(ipac_filepaths, expid=None):
+    """Bulk exception_header for the quadrants of a single exposure.
+
+    The metaheaders are looked up at once (see get_sciheaders); only the
+    missing ones are read from the IPAC sciimg files.
+
+    Parameters
+    ----------
+    ipac_filepaths: list
+        IPAC sciimg filepaths of the quadrants.
+
+    expid: int, None
+        exposure ID (e.g. EXPID of the raw header). If None, it is
+        taken from the raw metadata.
+
+    Returns
+    -------
+    list
+        fits.Header or None
+    """
+    infos = [parse_filename(f) for f in ipac_filepaths]
+    if expid is None:
+        expid = filename_to_metadata(ipac_filepaths[0]).iloc[0]["expid"]
+
+    hdrs = get_sciheaders(
+        [expid] * len(infos),
+        [info["rcid"] for info in infos],
+        [f"{info['year']}{info['month']}" for info in infos],
+    )
+    return [hdr if hdr is not None else _read_sciimg_header(f)
+            for f, hdr in zip(ipac_filepaths, hdrs)]
+
+
+def _read_sciimg_header(file_):
+    """Header of the IPAC sciimg file (None if it cannot be read)."""
+    try:
+        hdr = fits.getheader(file_)
+        hdr.strip()
+    except Exception as e:
+        logging.getLogger(__name__).warn("%s", e)
+        return None
     return hdr
 
 
@@ -538,6 +1127,8 @@ def compute_fp_norm(flat_files):
         with fits.open(filepath, mode="update") as filehandle : 
             filehandle[0].header["HIERARCH FLTNORM_FP"] = fp_flats_norms
             filehandle[0].header["HIERARCH NFLATS_FP"] = len(flat_files)
+            header = filehandle[0].header.copy()
+        append_calib_log("flat", filepath, header)
 
     return fp_flats_norms
 
@@ -550,44 +1141,351 @@ def find_closest_calib_file(
     kind="bias",
     max_timedelta="1w",
 ):
-    """Use master bias/flat catalogs to find the closest one in time."""
-
-    logger = logging.getLogger(__name__)
-    CAL = pathlib.Path(CAL_DIR)
-    meta_file = CAL / kind / "meta" / f"master{kind}_metadata_{year}.parquet"
-    if not meta_file.exists():
-        raise ValueError(f"could not find master{kind} file ({meta_file})")
-
-    df = pd.read_parquet(meta_file)
-    date = pd.to_datetime(date)
-
-    df["date"] = pd.to_datetime(df.PERIOD)
-    df = df.set_index("date")
-    df = df[df.CCDID.eq(ccdid)]
-    if kind == "flat":
-        df = df[df.FILTRKEY.eq(filtername)]
-
-    # drop duplicates if multiple files with different suffixes
-    # TODO: find way to identify those variant and filter on them ?
-    df.drop_duplicates('PERIOD', inplace=True)
-    idx = df.index.get_indexer([date], method="nearest")
-
-    if len(df) == 0:
-        raise ValueError("no calib found")
-
-    td = abs(df.index[idx[0]] - date)
-    if td > pd.Timedelta(max_timedelta):
-        raise ValueError(f"found {kind} but time delta is greater than required ({td})")
-
-    item = df.iloc[idx[0]]
-    if kind == "bias":
-        filepath = get_daily_biasfile(item.PERIOD, ccdid)
-        logger.debug("found master bias: %s", filepath)
-        return filepath
-    elif kind == "flat":
-        filepath = get_daily_flatfile(item.PERIOD, ccdid, filtername=filtername)
-        logger.debug("found master flat: %s", filepath)
-        return filepath
+    """Use master bias/flat catalogs to find the closest one in time.
+
+    Only the master catalog of the given year is searched. This goes
+    through the process-wide CalibrationIndex (see get_calibration_index).
+    """
+    return get_calibration_index().resolve(
+        [date], [ccdid], None if filtername is None else [filtername],
+        kind=kind, max_timedelta=max_timedelta, years=[int(year)],
+    )[0]
+
+
+class CalibrationIndex:
+    """Resolve the closest master bias/flat of many raw exposures at once.
+
+    The master{kind}_metadata_{year}.parquet catalogs (see parse_cal) are
+    loaded once and reloaded only if the file changes. Master dates are kept
+    sorted per (ccdid, filter) so a whole list of dates is resolved with
+    np.searchsorted. Unless the catalog years are given, dates close to the
+    new year also look into the catalogs of the previous and next years.
+    """
+
+    def __init__(self, cal_dir=CAL_DIR):
+        self.cal_dir = pathlib.Path(cal_dir)
+        self._catalogs = {}
+
+    def get_catalog_file(self, kind, year):
+        """Path of the master catalog of the given kind and year."""
+        return self.cal_dir / kind / "meta" / f"master{kind}_metadata_{year}.parquet"
+
+    def get_catalog(self, kind, year):
+        """Sorted master dates per (ccdid, filter) for the given kind and year.
+
+        Returns
+        -------
+        dict or None
+            {(ccdid, filtername): (days, periods)} with days the sorted dates
+            in (fractional) days since epoch and periods the matching
+            PERIOD strings.
+            filtername is None for biases. None if the catalog does not exist.
+        """
+        filepath = self.get_catalog_file(kind, year)
+        try:
+            stat = filepath.stat()
+        except FileNotFoundError:
+            return None
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._catalogs.get((kind, year))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        groupkeys = ["CCDID", "FILTRKEY"] if kind == "flat" else ["CCDID"]
+        df = pd.read_parquet(filepath, columns=["PERIOD", *groupkeys])
+
+        catalog = {}
+        for key, df_ in df.groupby(groupkeys, sort=False):
+            ccdid, filtername = key if kind == "flat" else (key[0], None)
+            # drop duplicates if multiple files with different suffixes
+            # TODO: find way to identify those variant and filter on them ?
+            periods = df_["PERIOD"].drop_duplicates().to_numpy(dtype=str)
+            days = _to_days(pd.to_datetime(periods, format="%Y%m%d"))
+            order = np.argsort(days, kind="stable")
+            catalog[(int(ccdid), filtername)] = (days[order], periods[order])
+
+        self._catalogs[(kind, year)] = (signature, catalog)
+        return catalog
+
+    def resolve(
+        self,
+        dates,
+        ccdids,
+        filternames=None,
+        kind="bias",
+        max_timedelta="1w",
+        errors="raise",
+        years=None,
+    ):
+        """Find the closest master calibration files.
+
+        Parameters
+        ----------
+        dates: list
+            exposure dates (anything pandas.to_datetime understands).
+
+        ccdids: list
+            ccd ids, same size as dates.
+
+        filternames: list, None
+            filter names (zg, zr, zi), same size as dates.
+            Required for kind='flat'.
+
+        kind: str
+            bias or flat.
+
+        max_timedelta : str
+            maximum time delta to consider the master as valid.
+            Use pandas formats, e.g. "1d", "1w" etc.
+
+        errors: str
+            'raise' to raise a ValueError if any date has no valid master,
+            'coerce' to return None for them.
+
+        years: list, None
+            year of the master catalog searched for each date, same size
+            as dates. None means the year of the date, together with the
+            previous and next years.
+
+        Returns
+        -------
+        list
+            filepaths of the master calibrations (or None).
+        """
+        logger = logging.getLogger(__name__)
+        days = _to_days(dates)
+        ccdids = np.broadcast_to(np.asarray(ccdids, dtype=int), days.shape)
+        if kind == "flat":
+            if filternames is None:
+                raise ValueError("filternames must be given for kind='flat'")
+            filternames = np.broadcast_to(np.asarray(filternames, dtype=object), days.shape)
+        else:
+            filternames = np.full(days.shape, None, dtype=object)
+
+        neighbours = years is None
+        if neighbours:
+            years = (np.floor(days).astype("int64").astype("datetime64[D]")
+                     .astype("datetime64[Y]").astype(int) + 1970)
+        else:
+            years = np.broadcast_to(np.asarray(years, dtype=int), days.shape)
+        maxdays = pd.Timedelta(max_timedelta) / pd.Timedelta("1d")
+
+        filepaths = np.full(days.shape, None, dtype=object)
+        keys = pd.DataFrame({"year": years, "ccdid": ccdids, "filter": filternames})
+        groupkeys = ["year", "ccdid", "filter"] if kind == "flat" else ["year", "ccdid"]
+        for key, group in keys.groupby(groupkeys, sort=False):
+            year, ccdid, filtername = key if kind == "flat" else (*key, None)
+            ccdid = int(ccdid)
+            searched = (year - 1, year, year + 1) if neighbours else (year,)
+            catalogs = [self.get_catalog(kind, year_) for year_ in searched]
+            if all(cat is None for cat in catalogs):
+                if errors == "raise":
+                    raise ValueError(
+                        f"could not find master{kind} file ({self.get_catalog_file(kind, year)})"
+                    )
+                continue
+
+            entries = [cat[(ccdid, filtername)] for cat in catalogs
+                       if cat is not None and (ccdid, filtername) in cat]
+            indices = group.index.to_numpy()
+            if len(entries) == 0:
+                if errors == "raise":
+                    raise ValueError("no calib found")
+                continue
+
+            mdays = np.concatenate([e[0] for e in entries])
+            mperiods = np.concatenate([e[1] for e in entries])
+
+            # nearest master, ties broken by preferring the later one.
+            query = days[indices]
+            right = np.clip(np.searchsorted(mdays, query), 0, len(mdays) - 1)
+            left = np.clip(right - 1, 0, len(mdays) - 1)
+            use_right = np.abs(mdays[right] - query) <= np.abs(query - mdays[left])
+            closest = np.where(use_right, right, left)
+            timedelta = np.abs(mdays[closest] - query)
+
+            toofar = timedelta > maxdays
+            if toofar.any() and errors == "raise":
+                td = pd.Timedelta(timedelta[toofar].max(), "d")
+                raise ValueError(f"found {kind} but time delta is greater than required ({td})")
+
+            for index, period, bad in zip(indices, mperiods[closest], toofar):
+                if bad:
+                    continue
+                if kind == "bias":
+                    filepaths[index] = get_daily_biasfile(period, ccdid)
+                else:
+                    filepaths[index] = get_daily_flatfile(period, ccdid, filtername=filtername)
+                logger.debug("found master %s: %s", kind, filepaths[index])
+
+        return filepaths.tolist()
+
+
+_CALIBRATION_INDEX = None
+
+
+def get_calibration_index():
+    """Process-wide CalibrationIndex."""
+    global _CALIBRATION_INDEX
+    if _CALIBRATION_INDEX is None:
+        _CALIBRATION_INDEX = CalibrationIndex()
+    return _CALIBRATION_INDEX
+
+
+class CalibFrameCache:
+    """Byte-bounded LRU cache of master calibration CCDs keyed by filepath.
+
+    Within a d2a chunk, the same few master bias/flat are used by every
+    exposure, this avoids reading and decoding them for each raw file.
+    The cached data are flagged read-only and entries are reloaded if
+    the file changes on disk.
+    """
+
+    def __init__(self, maxbytes=CALIB_CACHE_MAXBYTES, memmap=False):
+        self.maxbytes = maxbytes
+        self.memmap = memmap
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_loaded = 0
+        self.bytes_saved = 0
+
+    def get(self, filepath):
+        """Get the ztfimg.CCD of the given master calibration file.
+
+        Parameters
+        ----------
+        filepath: str
+            path of the master bias/flat.
+
+        Returns
+        -------
+        ztfimg.CCD
+            shared object, its data are read-only.
+        """
+        filepath = str(filepath)
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(filepath)
+                self.hits += 1
+                self.bytes_saved += entry[1]
+                return entry[2]
+            if entry is not None:
+                self._pop(filepath)
+            self.misses += 1
+
+        ccd = self._read(filepath)
+        nbytes = ccd.data.nbytes
+        with self._lock:
+            self.bytes_loaded += nbytes
+            if nbytes <= self.maxbytes:
+                if filepath in self._entries:
+                    self._pop(filepath)
+                self._entries[filepath] = [signature, nbytes, ccd, {}]
+                self.nbytes += nbytes
+                while self.nbytes > self.maxbytes:
+                    self._pop(next(iter(self._entries)))
+        return ccd
+
+    def get_flat_scale(self, filepath, ccd, flat_coef=None, fp_flatfield=False):
+        """Get the flat correction (see get_flat_scale) of the given master flat.
+
+        The correction is computed once and cached with the flat entry.
+
+        Parameters
+        ----------
+        filepath: str
+            path of the master flat.
+
+        ccd: ztfimg.CCD
+            the flat, as returned by get(filepath); it is not read again
+            so that the cache statistics are not counted twice.
+
+        Returns
+        -------
+        array, float
+            read-only flat data and the focal plane normalization.
+        """
+        filepath = str(filepath)
+        key = (flat_coef, fp_flatfield)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[2] is ccd and key in entry[3]:
+                return entry[3][key]
+
+        flat_data, fp_flat_norm = get_flat_scale(ccd, flat_coef=flat_coef,
+                                                 fp_flatfield=fp_flatfield)
+        # only the copies (flat_coef) take extra memory.
+        nbytes = flat_data.nbytes if flat_coef is not None else 0
+        if flat_data.flags.writeable:
+            flat_data.setflags(write=False)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[2] is ccd:
+                entry[3][key] = (flat_data, fp_flat_norm)
+                entry[1] += nbytes
+                self.nbytes += nbytes
+                while self.nbytes > self.maxbytes:
+                    self._pop(next(iter(self._entries)))
+        return flat_data, fp_flat_norm
+
+    def clear(self):
+        """Drop all entries (counters are kept)."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """Cache statistics (json serializable)."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "nbytes": self.nbytes,
+            "maxbytes": self.maxbytes,
+            "bytes_loaded": self.bytes_loaded,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def _read(self, filepath):
+        if self.memmap:
+            data, header = read_calib_product(filepath, memmap=True)
+            ccd = ztfimg.CCD.from_data(data, header=header)
+        else:
+            ccd = ztfimg.CCD.from_filename(filepath, as_path=True, use_dask=False)
+        ccd.data.setflags(write=False)
+        return ccd
+
+    def _pop(self, filepath):
+        """Remove filepath from the cache (lock must be held)."""
+        self.nbytes -= self._entries.pop(filepath)[1]
+
+
+_CALIB_CACHE = None
+
+
+def get_calib_cache():
+    """Process-wide CalibFrameCache."""
+    global _CALIB_CACHE
+    if _CALIB_CACHE is None:
+        _CALIB_CACHE = CalibFrameCache()
+    return _CALIB_CACHE
+
+
+_NS_PER_DAY = 86400 * 10**9
+
+
+def _to_days(dates):
+    """Convert dates (or YYYYMMDD strings) into float days since epoch,
+    keeping the time of the day."""
+    dates = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(np.asarray(dates, dtype=object))))
+    return dates.values.astype("datetime64[ns]").astype("int64") / _NS_PER_DAY
 
 
 def get_mskdata(filename):
@@ -608,6 +1506,23 @@ def exception_mask(filename, suffix):
 
     return mskdata
 
+def _split_quadrants(data):
+    """Split ccd data [..., N, M] into its (q1, q2, q3, q4) quadrants.
+
+    Follows the ztfimg ccd layout (q2 | q1 above q3 | q4, lower origin)
+    as CCD.get_quadrantdata(from_data=True, reorder=False), i.e. each
+    quadrant is flipped on both axes.
+    The quadrants are (reversed) views on the input data.
+    """
+    nrows, ncols = data.shape[-2] // 2, data.shape[-1] // 2
+    return [
+        data[..., nrows:, ncols:][..., ::-1, ::-1],
+        data[..., nrows:, :ncols][..., ::-1, ::-1],
+        data[..., :nrows, :ncols][..., ::-1, ::-1],
+        data[..., :nrows, ncols:][..., ::-1, ::-1],
+    ]
+
+
 def is_array(x):
     """Test if variable is a Numpy or Dask array."""
     return isinstance(x, (np.ndarray, dask.array.Array))
@@ -2,8 +2,10 @@ import logging
 import sys
 import time
 import os 
+from concurrent.futures import ProcessPoolExecutor
 import rich_click as click
-from ztfin2p3.io import PACKAGE_PATH
+from ztfin2p3.builder import STACK_MAXBYTES
+from ztfin2p3.io import PACKAGE_PATH, compact_calib_log
 from ztfin2p3.pipe.newpipe import BiasPipe, FlatPipe
 from ztfin2p3.science import compute_fp_norm
 from ztfin2p3.scripts.utils import (_run_pdb, init_stats, 
@@ -28,12 +30,74 @@ from ztfin2p3.scripts.utils import (_run_pdb, init_stats,
 
 config_path = os.path.join(PACKAGE_PATH, 'scripts/config.yml')
 
+# memory used by a ccd build on top of the stacking budget (raw frames,
+# led stacks and outputs), used if not given in the config.
+CCD_WORKER_BYTES = 2 * 1024**3
+
+
+def process_ccd(day, ccdid, cfg, suffix=None, force=False):
+    """Build the master bias and flats of a ccd.
+
+    Returns
+    -------
+    dict, dict, int
+        bias and flat stats (None if not built) and number of errors.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("processing day %s, ccd=%s", day, ccdid)
+    bias_stats = flat_stats = None
+    try:
+        bi = BiasPipe(day, ccdid=ccdid, nskip=10)
+        if len(bi.df) == 0:
+            logger.warning(f"no bias for {day}")
+            return bias_stats, flat_stats, 1
+
+        #Should add a find nearest calib for bias if bias but no flat ?
+        #How to store this info ? In header ? 
+
+        # Generate master bias:
+        t0 = time.time()
+        bi.build_ccds(reprocess=force, **cfg['bias'])
+        timing = time.time() - t0
+        logger.info("bias done, %.2f sec.", timing)
+        bias_stats = {"ccd": ccdid, "time": timing}
+
+        fi = FlatPipe(day, ccdid=ccdid, suffix=suffix)
+        if len(fi.df) == 0:
+            logger.warning(f"no flat for {day}")
+            return bias_stats, flat_stats, 1
+
+        # Generate master flats:
+        t0 = time.time()
+        fi.build_ccds(bias=bi, reprocess=force, **cfg['flat'])
+        timing = time.time() - t0
+        logger.info("flat done, %.2f sec.", timing)
+        flat_stats = {"ccd": ccdid, "time": timing}
+    except Exception as e:
+        logger.error("failed: %s", e)
+        return bias_stats, flat_stats, 1
+
+    return bias_stats, flat_stats, 0
+
+
+def get_available_memory():
+    """Memory available to the job (bytes): the slurm allocation if any,
+    otherwise the available physical memory."""
+    if os.getenv("SLURM_MEM_PER_NODE"):
+        return int(os.getenv("SLURM_MEM_PER_NODE")) * 1024**2
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def _init_worker(debug=False):
+    setup_logger(debug=debug)
+
 @click.command(context_settings={"show_default": True})
 @click.argument("day")
 @click.option("--statsdir", help="path where statistics are stored")
 @click.option("--config", default=config_path, help='path to yaml config file')
 @click.option("--suffix", help="suffix for output science files")
 @click.option("--force", "-f", is_flag=True, help="force reprocessing all files?")
+@click.option("--workers", type=int, default=1, help="number of ccds built in parallel")
 @click.option("--debug", "-d", is_flag=True, help="show debug info?")
 @click.option("--pdb", is_flag=True, help="run pdb if an exception occurs")
 def calib(
@@ -42,6 +106,7 @@ def calib(
     config,
     suffix,
     force,
+    workers,
     debug,
     pdb,
 ):
@@ -52,6 +117,10 @@ def calib(
     - computer master bias
     - computer master flat
 
+    With --workers N, up to N ccds are built concurrently in worker
+    processes, fewer if the available memory cannot hold them
+    (calib.worker_mem in the config).
+
     """
 
     setup_logger(debug=debug)
@@ -60,8 +129,12 @@ def calib(
 
     cfg = get_config(config, command='calib')
 
-    cfg['bias'].update(dict(clipping_prop=cfg['clipping_prop']))
-    cfg['flat'].update(dict(clipping_prop=cfg['clipping_prop']))
+    product_format = cfg.get('product_format', "fits")
+    stack = cfg.get('stack', {})
+    cfg['bias'].update(dict(clipping_prop=cfg['clipping_prop'], product_format=product_format,
+                            **stack))
+    cfg['flat'].update(dict(clipping_prop=cfg['clipping_prop'], product_format=product_format,
+                            **stack))
 
     n_errors = 0
     day = day.replace("-", "")
@@ -72,42 +145,38 @@ def calib(
     stats["bias"] = []
     stats["flat"] = []
 
-    for ccdid in range(1, 17):
-        logger.info("processing day %s, ccd=%s", day, ccdid)
-
-        try:
-            bi = BiasPipe(day, ccdid=ccdid, nskip=10)
-            if len(bi.df) == 0:
-                logger.warning(f"no bias for {day}")
-                n_errors += 1
-                continue
-            
-            #Should add a find nearest calib for bias if bias but no flat ?
-            #How to store this info ? In header ? 
-
-            # Generate master bias:
-            t0 = time.time()
-            bi.build_ccds(reprocess=force, **cfg['bias'])
-            timing = time.time() - t0
-            logger.info("bias done, %.2f sec.", timing)
-            stats["bias"].append({"ccd": ccdid, "time": timing})
-
-            fi = FlatPipe(day, ccdid=ccdid, suffix=suffix)
-            if len(fi.df) == 0:
-                logger.warning(f"no flat for {day}")
-                n_errors += 1
-                continue
-
-            # Generate master flats:
-            t0 = time.time()
-            fi.build_ccds(bias=bi, reprocess=force, **cfg['flat'])
-            timing = time.time() - t0
-            logger.info("flat done, %.2f sec.", timing)
-            stats["flat"].append({"ccd": ccdid, "time": timing})
-        except Exception as e:
-            logger.error("failed: %s", e)
-            n_errors += 1
-
+    ccdids = range(1, 17)
+    if workers > 1:
+        if pdb:
+            raise ValueError("--pdb cannot be used with --workers")
+
+        # memory-aware admission: concurrent ccd builds must fit in memory.
+        worker_mem = cfg.get('worker_mem', CCD_WORKER_BYTES) + stack.get(
+            'max_bytes', STACK_MAXBYTES)
+        available = get_available_memory()
+        nworkers = max(1, min(workers, available // worker_mem))
+        logger.info("building %d ccds at once (%.1f GB available)",
+                    nworkers, available / 1024**3)
+        stats["workers"] = nworkers
+
+        with ProcessPoolExecutor(max_workers=nworkers, initializer=_init_worker,
+                                 initargs=(debug,)) as executor:
+            futures = [executor.submit(process_ccd, day, ccdid, cfg,
+                                       suffix=suffix, force=force)
+                       for ccdid in ccdids]
+            results = [future.result() for future in futures]
+    else:
+        results = [process_ccd(day, ccdid, cfg, suffix=suffix, force=force)
+                   for ccdid in ccdids]
+
+    for bias_stats, flat_stats, errors in results:
+        if bias_stats is not None:
+            stats["bias"].append(bias_stats)
+        if flat_stats is not None:
+            stats["flat"].append(flat_stats)
+        n_errors += errors
+
+    # all the ccds are done: the focal plane norm needs the 16 flats.
     #if n_errors == 0:
     logger.info("compute flat fp norm")
     stats["flat norm"] = {}
@@ -119,6 +188,11 @@ def calib(
             assert len(df) == 16
         stats["flat norm"][filterid] = float(compute_fp_norm(df.fileout.tolist()))
 
+    # make the new masters visible to find_closest_calib_file.
+    for kind in ("bias", "flat"):
+        nrecords = compact_calib_log(kind, day[:4])
+        logger.info("%d %s records added to the catalog", nrecords, kind)
+
     stats["total_time"] = time.time() - tot
     logger.info("all done, %.2f sec.", stats["total_time"])
 
@@ -0,0 +1,20 @@
+import rich_click as click
+
+from ztfin2p3.catalog import convert_htm_catalog
+
+
+@click.command(context_settings={"show_default": True})
+@click.argument("which", nargs=-1)
+@click.option("--overwrite", is_flag=True, help="convert existing trixels again?")
+@click.option("--workers", default=8, help="number of converting threads")
+def convert_refcat(which, overwrite, workers):
+    """Convert lsst refcats HTM trees (ps1, gaia_dr2, sdss) to parquet.
+
+    The fits trixels of $ZTFREFCAT are written in $ZTFREFCAT_PARQUET
+    with ra, dec in degrees and the magnitudes precomputed; they are
+    then used by catalog.get_refcatalog.
+    """
+    for which_ in which:
+        filepaths = convert_htm_catalog(which_, overwrite=overwrite,
+                                        max_workers=workers)
+        print(f"{which_}: {len(filepaths)} trixels")
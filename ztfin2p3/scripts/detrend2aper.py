@@ -1,4 +1,7 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from importlib import metadata
+import itertools
 import logging
 import sys
 import time
@@ -10,9 +13,10 @@ from ztfquery.buildurl import get_scifile_of_filename
 
 from ztfin2p3.aperture import get_aperture_photometry, store_aperture_catalog
 from ztfin2p3.io import ipacfilename_to_ztfin2p3filepath, PACKAGE_PATH
-from ztfin2p3.metadata import get_rawmeta, metadata_to_url
+from ztfin2p3.metadata import get_cache_info, get_rawmeta, metadata_to_url
 from ztfin2p3.pipe.newpipe import BiasPipe, FlatPipe
-from ztfin2p3.science import build_science_image
+from ztfin2p3.science import (build_science_batch, get_calib_cache,
+                               get_calibration_index)
 from ztfin2p3.scripts.utils import (_run_pdb, init_stats, save_stats, 
                                     setup_logger, get_config)
 
@@ -40,23 +44,10 @@ config_path = os.path.join(PACKAGE_PATH, 'scripts/config.yml')
 
 
 
-def process_sci(rawfile, flat, bias, suffix, radius, corr_pocket, 
-                do_aper=True, sci_params=None, aper_params=None):
+def run_aperture(rawfile, quads, suffix, radius, aper_params=None):
 
     logger = logging.getLogger(__name__)
-    quads = build_science_image(
-        rawfile,
-        flat,
-        bias,
-        corr_pocket=corr_pocket,
-        newfile_dict=dict(new_suffix=suffix),
-        **SCI_PARAMS,
-    )
-
     aper_stats = {}
-    if not do_aper:
-        return aper_stats
-
     ipac_filepaths = get_scifile_of_filename(rawfile, source="local")
 
     for i, (quad, out) in enumerate(zip(quads, ipac_filepaths), start=1):
@@ -67,7 +58,7 @@ def process_sci(rawfile, flat, bias, suffix, radius, corr_pocket,
         elif quad.qid is None:
             error = "no sci header"
         else:
-            apcat = get_aperture_photometry(quad, radius=radius, **APER_PARAMS)
+            apcat = get_aperture_photometry(quad, radius=radius, **aper_params)
             output_filename = ipacfilename_to_ztfin2p3filepath(
                 out, new_suffix=suffix or "apcat", new_extension="parquet"
             )
@@ -86,6 +77,149 @@ def process_sci(rawfile, flat, bias, suffix, radius, corr_pocket,
     return aper_stats
 
 
+def process_batch(sci_infos, flats, biases, suffix, radius, do_aper=True,
+                  pdb=False, start=1, nfiles=None, batch_size=1, prefetch=None,
+                  timings=None, sci_params=None, aper_params=None):
+    """Detrend a list of exposures and run their aperture photometry.
+
+    Parameters
+    ----------
+    sci_infos: list
+        one stats entry (dict) per exposure, with at least "file" and
+        "corr_pocket" keys. It is updated with the status, timing and
+        aperture stats of the exposure.
+
+    flats, biases: list
+        master flat and bias (filepath) of each exposure.
+
+    start, nfiles: int
+        index of the first exposure and total number of exposures
+        (only used in the logs).
+
+    batch_size: int
+        number of exposures detrended together (see build_science_batch).
+
+    prefetch: dict, None
+        read ahead options of the raw exposures (see build_science_batch).
+
+    timings: dict, None
+        if given, the time spent in each stage ("read_wait", "detrend",
+        "finish", "aperture") is added to it.
+
+    Returns
+    -------
+    list
+        the updated sci_infos.
+    """
+    logger = logging.getLogger(__name__)
+    nfiles = nfiles or len(sci_infos)
+
+    # Consecutive exposures sharing ccd and calibrations are detrended
+    # together, by batches of batch_size.
+    results = build_science_batch(
+        [info["file"] for info in sci_infos],
+        flats,
+        biases,
+        batch_size=batch_size,
+        prefetch=prefetch,
+        timings=timings,
+        corr_pocket=[info["corr_pocket"] for info in sci_infos],
+        newfile_dict=dict(new_suffix=suffix),
+        **sci_params,
+    )
+
+    t0 = time.time()
+    for i, (sci_info, (raw_file, quads)) in enumerate(zip(sci_infos, results), start=start):
+        msg = "processing sci %d/%d filter=%s ccd=%s pocket=%s: %s"
+        logger.info(msg, i, nfiles, sci_info["filter"], sci_info["ccd"],
+                    sci_info["corr_pocket"], raw_file)
+
+        try:
+            if isinstance(quads, Exception):
+                raise quads
+            t1 = time.perf_counter()
+            aper_stats = (
+                run_aperture(raw_file, quads, suffix, radius,
+                             aper_params=aper_params)
+                if do_aper else {}
+            )
+            if timings is not None:
+                timings["aperture"] = timings.get("aperture", 0) + time.perf_counter() - t1
+        except Exception as exc:
+            if pdb:
+                raise
+
+            aper_stats = {}
+            status, error_msg = "error", str(exc)
+            logger.error("failed: %s", error_msg)
+        else:
+            status, error_msg = "ok", ""
+
+        if do_aper and any(d["error"] for d in aper_stats.values()):
+            status, error_msg = "error", "error in aperture photometry"
+
+        # for batched exposures, the detrending time is counted in the
+        # first exposure of the batch.
+        timing = time.time() - t0
+        logger.info("sci done, status=%s, %.2f sec.", status, timing)
+        sci_info.update({"time": timing, "status": status, "error_msg": error_msg})
+        sci_info.update(aper_stats)
+        del quads
+        t0 = time.time()
+
+    return sci_infos
+
+
+def split_batches(sci_infos, flats, biases, batch_size=1):
+    """Split the exposures in batches of consecutive exposures sharing
+    ccd, calibrations and pocket correction, of at most batch_size.
+
+    Returns
+    -------
+    list
+        list of slices.
+    """
+    keys = [(info["ccd"], str(bias), str(flat), info["corr_pocket"])
+            for info, flat, bias in zip(sci_infos, flats, biases)]
+    batches, start = [], 0
+    for _, group in itertools.groupby(keys):
+        stop = start + len(list(group))
+        batches += [slice(i, min(i + batch_size, stop))
+                    for i in range(start, stop, batch_size)]
+        start = stop
+    return batches
+
+
+def _init_worker(cache_cfg, calibfiles, debug=False):
+    """Setup a d2a worker process: logging and calibration cache.
+
+    The calibration cache is pre-warmed with calibfiles, as long as they
+    fit in its byte budget. With calib_cache.memmap, the data pages are
+    shared between the workers through the OS page cache.
+    """
+    setup_logger(debug=debug)
+    calib_cache = get_calib_cache()
+    for key, value in cache_cfg.items():
+        setattr(calib_cache, key, value)
+
+    logger = logging.getLogger(__name__)
+    for filepath in calibfiles:
+        if calib_cache.nbytes >= calib_cache.maxbytes:
+            break
+        try:
+            calib_cache.get(filepath)
+        except Exception as exc: # raised again, and recorded, when used.
+            logger.debug("cannot pre-warm %s: %s", filepath, exc)
+
+
+def _run_worker_batch(*args, **kwargs):
+    """process_batch in a worker, with its stage timings and the worker
+    calibration and metadata cache stats."""
+    timings = {}
+    sci_infos = process_batch(*args, timings=timings, **kwargs)
+    return sci_infos, timings, (os.getpid(), get_calib_cache().info(), get_cache_info())
+
+
 @click.command(context_settings={"show_default": True})
 @click.argument("day", default=None, required=False)
 @click.option("-t", "--table", help="parquet table with files to process")
@@ -96,6 +230,7 @@ def process_sci(rawfile, flat, bias, suffix, radius, corr_pocket,
 @click.option("--config", default=config_path, help='path to yaml config file')
 @click.option("--statsdir", help="path where statistics are stored")
 @click.option("--suffix", help="suffix for output catalogs")
+@click.option("--workers", type=int, default=1, help="number of worker processes")
 @click.option("--debug", "-d", is_flag=True, help="show debug info?")
 @click.option("--pdb", is_flag=True, help="run pdb if an exception occurs")
 def d2a(
@@ -108,6 +243,7 @@ def d2a(
     config,
     statsdir,
     suffix,
+    workers,
     debug,
     pdb,
 ):
@@ -123,6 +259,9 @@ def d2a(
     The list of files to process can be splitted in chunks with --chunk-id and
     --chunk--size.
 
+    With --workers N, batches of exposures are processed by N worker
+    processes; at most 2N batches are in flight at once.
+
     """
 
     setup_logger(debug=debug)
@@ -131,13 +270,16 @@ def d2a(
 
     tot = time.time()
     logger = logging.getLogger(__name__)
-    n_errors = 0
 
     cfg = get_config(config, command='d2a')
     radius = cfg['radius']
 
     stats = init_stats(ccd=ccdid, science=[])
 
+    calib_cache = get_calib_cache()
+    for key, value in cfg.get('calib_cache', {}).items():
+        setattr(calib_cache, key, value)
+
     if day is not None:
         day = day.replace("-", "")
         meta = get_rawmeta("science", day, ccdid=ccdid)
@@ -169,71 +311,130 @@ def d2a(
 
     stats["nfiles"] = nfiles
 
-    for i, (_, row) in enumerate(meta.iterrows(), start=1):
+    if cfg['use_closest_calib'] and nfiles > 0:
+        # resolve the master bias/flat of the whole chunk at once. Files
+        # without valid calibration keep None, so the error is raised and
+        # recorded when processing them.
+        calib_index = get_calibration_index()
+        dates = pd.to_datetime(meta.day, format="%Y%m%d")
+        calib_prop = dict(
+            max_timedelta=cfg['sci_params'].get('max_timedelta', "1w"), errors="coerce"
+        )
+        meta = meta.assign(
+            biasfile=calib_index.resolve(dates, meta.ccdid, kind="bias", **calib_prop),
+            flatfile=calib_index.resolve(
+                dates, meta.ccdid, meta.filtercode, kind="flat", **calib_prop
+            ),
+        )
+
+    biases, flats, sci_infos = [], [], []
+    pipes = {}
+    for _, row in meta.iterrows():
         if cfg['use_closest_calib']:
-            bias = flat = None
+            bias, flat = row.biasfile, row.flatfile
         else:
-            bi = BiasPipe(row.day, ccdid=ccdid, nskip=10)
-            if len(bi.df) == 0:
-                raise Exception(f"no bias for {row.day}")
-
-            fi = FlatPipe(row.day, ccdid=ccdid)
-            if len(fi.df) == 0:
-                raise Exception(f"no flat for {row.day}")
-
-            bias = bi.get_ccd(day=row.day, ccdid=row.ccdid)
-            flat = fi.get_ccd(day=row.day, ccdid=row.ccdid, filterid=row.filtercode)
-
+            if row.day not in pipes:
+                bi = BiasPipe(row.day, ccdid=ccdid, nskip=10)
+                if len(bi.df) == 0:
+                    raise Exception(f"no bias for {row.day}")
+
+                fi = FlatPipe(row.day, ccdid=ccdid)
+                if len(fi.df) == 0:
+                    raise Exception(f"no flat for {row.day}")
+                pipes[row.day] = bi, fi
+
+            bi, fi = pipes[row.day]
+            # the masters are loaded when used (calibration cache), they must
+            # have been built (ztfin2p3 calib).
+            bias = bi.get_fileout(day=row.day, ccdid=row.ccdid)
+            flat = fi.get_fileout(day=row.day, ccdid=row.ccdid, filterid=row.filtercode)
+            for kind, filepath in (("bias", bias), ("flat", flat)):
+                if not os.path.isfile(filepath):
+                    raise FileNotFoundError(
+                        f"no master {kind} for {row.day} ccd {row.ccdid}: {filepath}"
+                        " (build it with ztfin2p3 calib)"
+                    )
+
+        biases.append(bias)
+        flats.append(flat)
 
         corr_pocket = cfg['corr_pocket'] and pd.to_datetime(row.day) >= pd.to_datetime("20191022")
-
-        raw_file = row.filepath
-        msg = "processing sci %d/%d filter=%s ccd=%s pocket=%s: %s"
-        logger.info(msg, i, nfiles, row.filtercode, row.ccdid, corr_pocket, raw_file)
-
-        sci_info = {
+        sci_infos.append({
             "day": row.day,
             "filter": row.filtercode,
             "ccd": row.ccdid,
-            "file": raw_file,
+            "file": row.filepath,
             "expid": row.expid,
             "corr_pocket": corr_pocket,
-        }
-
-        t0 = time.time()
-        try:
-            aper_stats = process_sci(
-                raw_file,
-                flat,
-                bias,
-                suffix,
-                radius,
-                corr_pocket=corr_pocket,
-                do_aper=aper,
-                sci_params = cfg['sci_params'],
-                aper_params = cfg['aper_params']
-            )
-        except Exception as exc:
-            if pdb:
-                raise
-
-            aper_stats = {}
-            status, error_msg = "error", str(exc)
-            n_errors += 1
-            logger.error("failed: %s", error_msg)
-        else:
-            status, error_msg = "ok", ""
-
-        if aper and any(d["error"] for d in aper_stats.values()):
-            n_errors += 1
-            status, error_msg = "error", "error in aperture photometry"
-
-        timing = time.time() - t0
-        logger.info("sci done, status=%s, %.2f sec.", status, timing)
-        sci_info.update({"time": timing, "status": status, "error_msg": error_msg})
-        sci_info.update(aper_stats)
-        stats["science"].append(sci_info)
-
+        })
+
+    batch_prop = dict(
+        do_aper=aper,
+        nfiles=nfiles,
+        batch_size=cfg.get('batch_size', 1),
+        prefetch=cfg.get('prefetch'),
+        sci_params=cfg['sci_params'],
+        aper_params=cfg['aper_params'],
+    )
+    if workers > 1 and nfiles > 0:
+        if pdb:
+            raise ValueError("--pdb cannot be used with --workers")
+
+        # most used calibrations first for the pre-warming.
+        calibfiles = pd.Series(biases + flats).dropna().value_counts().index.tolist()
+        batches = split_batches(sci_infos, flats, biases, batch_size=batch_prop["batch_size"])
+        logger.info("%d batches on %d workers", len(batches), workers)
+
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(cfg.get('calib_cache', {}), calibfiles, debug),
+        )
+        calib_stats, metadata_stats, timings = {}, {}, {}
+        with executor:
+            # results are consumed in order, with a bounded number of
+            # batches in flight, so the stats keep the files order.
+            pending = deque()
+            batches = iter(batches)
+            while True:
+                for sel in itertools.islice(batches, 2 * workers - len(pending)):
+                    pending.append(executor.submit(
+                        _run_worker_batch, sci_infos[sel], flats[sel], biases[sel],
+                        suffix, radius, start=sel.start + 1, **batch_prop,
+                    ))
+                if not pending:
+                    break
+
+                batch_infos, batch_timings, (pid, calib_info, metadata_info) = (
+                    pending.popleft().result()
+                )
+                stats["science"] += batch_infos
+                for key, value in batch_timings.items():
+                    timings[key] = timings.get(key, 0) + value
+                calib_stats[pid] = calib_info # cumulative per worker
+                metadata_stats[pid] = metadata_info
+
+        calib_info = {key: sum(info[key] for info in calib_stats.values())
+                      for key in ("hits", "misses", "bytes_loaded", "bytes_saved")}
+        calib_info["workers"] = workers
+        # main process (file list) and workers (science headers)
+        metadata_stats["main"] = get_cache_info()
+        metadata_info = {key: sum(info[key] for info in metadata_stats.values())
+                         for key in ("hits", "misses", "invalidations")}
+        metadata_info["workers"] = workers
+    else:
+        timings = {}
+        stats["science"] = process_batch(sci_infos, flats, biases, suffix, radius,
+                                         pdb=pdb, timings=timings, **batch_prop)
+        calib_info = calib_cache.info()
+        metadata_info = get_cache_info()
+
+    n_errors = sum(info["status"] == "error" for info in stats["science"])
+
+    stats["metadata_cache"] = metadata_info
+    stats["calib_cache"] = calib_info
+    # total time per stage, summed over the workers (sec.)
+    stats["stages"] = timings
     stats["total_time"] = time.time() - tot
     logger.info("all done, %.2f sec.", stats["total_time"])
 
@@ -0,0 +1,29 @@
+import rich_click as click
+from astropy.io import fits
+
+from ztfin2p3.catalog import build_field_refcats
+
+
+@click.command(context_settings={"show_default": True})
+@click.argument("sciimgs", nargs=-1)
+@click.option("--which", default="gaia_dr3", help="reference catalog")
+@click.option("--radius", default=0.7, help="catalog radius (deg), see refcat_radius")
+@click.option("--overwrite", is_flag=True, help="rebuild existing catalogs?")
+@click.option("--fromfile", help="text file with a science image per line")
+def field_refcats(sciimgs, which, radius, overwrite, fromfile):
+    """Precompute the reference catalogs of ZTF fields, per (field, rcid).
+
+    SCIIMGS are science quadrant images, one per (field, rcid) is enough:
+    their header gives the field, rcid and wcs of the quadrant.
+    The catalogs are then used by the aperture photometry with
+    aper_params.field_refcat.
+    """
+    sciimgs = list(sciimgs)
+    if fromfile is not None:
+        with open(fromfile) as f:
+            sciimgs += [line.strip() for line in f if line.strip()]
+
+    headers = (fits.getheader(sciimg) for sciimg in sciimgs)
+    filepaths = build_field_refcats(headers, which, radius=radius,
+                                    overwrite=overwrite)
+    print(f"{len(filepaths)} field refcats")
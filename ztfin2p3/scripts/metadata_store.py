@@ -0,0 +1,43 @@
+import rich_click as click
+from astropy import time
+
+from ztfin2p3.metadata import (MetaDataHandler, RawBiasMetaData, RawFlatMetaData,
+                               RawScienceMetaData, build_metaheader_store)
+from ztfin2p3.utils.tools import parse_singledate
+
+METADATA_HANDLERS = {"bias": RawBiasMetaData,
+                     "flat": RawFlatMetaData,
+                     "object": RawScienceMetaData}
+
+
+@click.command(context_settings={"show_default": True})
+@click.argument("date")
+@click.option("--kind", "kinds", multiple=True, default=list(METADATA_HANDLERS),
+              type=click.Choice(list(METADATA_HANDLERS)), help="raw metadata kinds")
+@click.option("--metaheader", is_flag=True,
+              help="also build the science metaheader stores of these months")
+@click.option("--force-dl", is_flag=True, help="download the monthly metadata again?")
+def metadata_store(date, kinds, metaheader, force_dl):
+    """Build the metadata stores of the months of DATE.
+
+    DATE is any get_metadata date (e.g. 2019, 201904 or 2019-04-01,2019-06-30).
+    The raw metadata store partitions are read by get_metadata, which
+    falls back on the monthly metadata files for months without (or with
+    an outdated) partition. Run it again after the monthly files change.
+    """
+    if "," in date:
+        date = date.split(",")
+
+    for kind in kinds:
+        filepaths = METADATA_HANDLERS[kind].bulk_build_metadatastore(date, force_dl=force_dl)
+        print(f"{kind}: {len(filepaths)} store partitions")
+
+    if metaheader:
+        if isinstance(date, str):
+            start, end = parse_singledate(date)
+        else:
+            start, end = time.Time(date).datetime
+        months = MetaDataHandler._daterange_to_monthlist_(start, end)
+        for yyyy, mm in months:
+            build_metaheader_store(f"{yyyy:04d}{mm:02d}")
+        print(f"metaheader: {len(months)} stores")
@@ -1,16 +1,43 @@
 import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import rich_click as click
 from astropy.io import fits
 
-from ztfin2p3.io import CAL_DIR
+from ztfin2p3.io import (CAL_DIR, atomic_output, cut_incomplete_days, file_lock,
+                         get_calib_lockfile)
+
+# file bookkeeping columns, used by the incremental parsing.
+FILE_COLUMNS = ("FILEPATH", "MTIME", "SIZE")
 
 
 def parse_tree(
-    path: pathlib.Path, outfile: str = None, verbose: bool = False
+    path: pathlib.Path,
+    outfile: str = None,
+    verbose: bool = False,
+    previous: pd.DataFrame = None,
+    max_workers: int = 8,
 ) -> pd.DataFrame:
+    """Build the catalog of the master calibrations of a year directory.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        e.g. cal/bias/2019
+    outfile : str
+        if given, where the catalog is stored (atomic write).
+    verbose : bool
+        print the number of files per date?
+    previous : pd.DataFrame
+        catalog of a previous parsing (with FILE_COLUMNS). Rows of
+        unchanged files (same mtime and size) are reused, so only the
+        headers of new or modified files, including in-place header
+        updates (e.g. compute_fp_norm), are read.
+    max_workers : int
+        number of threads reading the headers.
+    """
     colnames = (
         "PERIOD",
         "CCDID",
@@ -24,67 +51,106 @@ def parse_tree(
     if "flat" in str(path):
         colnames = colnames + ("FILTRKEY", "FLTNORM", "FLTNORM_FP")
 
-    meta = []
+    if previous is not None and set(FILE_COLUMNS).issubset(previous.columns):
+        known = previous.set_index("FILEPATH", drop=False)
+    else:
+        known = None
+
+    # every file is checked: an in-place header update changes the file
+    # mtime but not the directory one.
+    reused, toread = [], []
     for date in sorted(os.listdir(path)):
-        flist = sorted(os.listdir(path / date))
+        dirpath = path / date
+        flist = sorted(os.listdir(dirpath))
         if verbose:
             print(date, len(flist))
         for fname in flist:
-            hdr = fits.getheader(path / date / fname)
-            meta.append([hdr[k] for k in colnames if k in hdr.keys()])
-            # Checking for key to catch KeyError
-
-    df = pd.DataFrame(meta, columns=colnames)
+            filepath = str(dirpath / fname)
+            stat = os.stat(filepath)
+            fileinfo = (filepath, stat.st_mtime_ns, stat.st_size)
+            if (known is not None and filepath in known.index
+                    and known.at[filepath, "MTIME"] == stat.st_mtime_ns
+                    and known.at[filepath, "SIZE"] == stat.st_size):
+                reused.append(filepath)
+            else:
+                toread.append(fileinfo)
+
+    def _read(fileinfo):
+        hdr = fits.getheader(fileinfo[0])
+        return [hdr.get(k) for k in colnames] + list(fileinfo)
+
+    if verbose:
+        print(f"{len(toread)} headers to read")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        meta = list(executor.map(_read, toread))
+
+    rows = [pd.DataFrame(meta, columns=colnames + FILE_COLUMNS)]
+    if len(reused) > 0:
+        # DIRMTIME: column of previous versions, unused.
+        rows.insert(0, known.loc[reused].drop(columns="DIRMTIME", errors="ignore"))
+    df = pd.concat(rows, ignore_index=True)
+    df = df.sort_values("FILEPATH", kind="stable").reset_index(drop=True)
     if outfile:
-        df.to_parquet(outfile)
+        write_catalog(df, outfile)
     return df
 
 
+def write_catalog(df: pd.DataFrame, outfile) -> None:
+    """Write the catalog next to outfile then move it, so readers never
+    see a partial file."""
+    with atomic_output(str(outfile)) as tmpfile:
+        df.to_parquet(tmpfile)
+
+
 @click.command(context_settings={"show_default": True})
 @click.argument("year", nargs=-1)
 @click.option("--clean", is_flag=True, help="keep only complete days?")
 @click.option("--prefix", is_flag=False, default='',  help="prefix to file")
-def parse_cal(year, clean, prefix):
-    """Parse calibration folder to produce catalogs."""
+@click.option("--incremental", is_flag=True,
+              help="only read the headers of new or changed files?")
+@click.option("--workers", default=8, help="number of threads reading headers")
+def parse_cal(year, clean, prefix, incremental, workers):
+    """Parse calibration folder to produce catalogs.
 
+    With --incremental, the uncut catalogs of the previous run are reused:
+    only the headers of new or changed files are read.
+    """
+
+    for y in year:
+        # the catalogs are also updated by calib (see io.compact_calib_log):
+        # no compaction while parsing, calib can still log new masters.
+        with file_lock(get_calib_lockfile(y), shared=True):
+            parse_year(y, clean, prefix, incremental, workers)
+
+
+def parse_year(y, clean, prefix, incremental, workers):
+    """Write the master bias and flat catalogs of the year y (see parse_cal)."""
     CAL = pathlib.Path(CAL_DIR)
     BIAS = CAL / "bias"
     FLAT = CAL / "flat"
 
-    for y in year:
-        bias = parse_tree(BIAS / y)
-        flat = parse_tree(FLAT / y)
+    catalogs = {}
+    for kind, path in (("bias", BIAS), ("flat", FLAT)):
+        # the uncut catalog keeps all the files, whatever --clean.
+        uncut = path / "meta" / f"uncut_master{kind}_metadata_{y}.parquet"
+        previous = (
+            pd.read_parquet(uncut) if incremental and uncut.exists() else None
+        )
+        catalogs[kind] = parse_tree(path / y, previous=previous, max_workers=workers)
+        if incremental:
+            write_catalog(catalogs[kind], uncut)
+
+    bias, flat = catalogs["bias"], catalogs["flat"]
+    print(f"{len(bias)} bias, {len(flat)} flats")
+
+    if clean:
+        print("removal incomplete days")
+        bias, flat = cut_incomplete_days(bias, flat, y)
         print(f"{len(bias)} bias, {len(flat)} flats")
+    
+    else : 
+        prefix = 'uncut_' 
+        #Hard-code prefix to get no cut metadata and prevent accidental overwriting.
 
-        if clean:
-            print("removal incomplete days")
-            dates = pd.date_range(f"{y}-01-01", f"{y}-12-31", freq="D")
-            df = pd.DataFrame(dates.astype(str).str.replace("-", ""), columns=["date"])
-
-            # count biases
-            df2 = pd.DataFrame(bias.groupby("PERIOD").size(), columns=["nbias"])
-            df = df.join(df2, "date")
-
-            # count flats
-            df2 = flat.pivot_table(
-                index="PERIOD", columns="FILTRKEY", aggfunc="count", values="IMGTYPE"
-            )
-            df = df.join(df2, "date")
-
-            df = df.fillna(0).astype(int)
-            df["tot"] = df[["nbias", "zg", "zi", "zr"]].sum(axis=1)
-
-            # Need to think some more on this operation.
-            # Especially since in the future we might have no bias but flats for a day.
-            to_remove = df[df.tot.lt(64)].date.astype(str).tolist()
-
-            bias = bias[~bias.PERIOD.isin(to_remove)]
-            flat = flat[~flat.PERIOD.isin(to_remove)]
-            print(f"{len(bias)} bias, {len(flat)} flats")
-        
-        else : 
-            prefix = 'uncut_' 
-            #Hard-code prefix to get no cut metadata and prevent accidental overwriting.
-
-        bias.to_parquet(BIAS / "meta" / f"{prefix}masterbias_metadata_{y}.parquet")
-        flat.to_parquet(FLAT / "meta" / f"{prefix}masterflat_metadata_{y}.parquet")
+    write_catalog(bias, BIAS / "meta" / f"{prefix}masterbias_metadata_{y}.parquet")
+    write_catalog(flat, FLAT / "meta" / f"{prefix}masterflat_metadata_{y}.parquet")
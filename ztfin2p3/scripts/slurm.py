@@ -68,6 +68,7 @@ def sbatch(
 @click.option("--account", default="ztf", help="account to charge resources to")
 @click.option("--cpu-time", "-c", default="2:00:00", help="cputime limit")
 @click.option("--mem", "-m", default="16GB", help="memory limit")
+@click.option("--cpus", default=1, help="cpus per task (e.g. for d2a --workers)")
 @click.option("--partition", default="htc", help="partition for resource allocation")
 #
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
@@ -85,6 +86,7 @@ def run(
     account,
     cpu_time,
     mem,
+    cpus,
     partition,
     args,
 ):
@@ -113,6 +115,7 @@ def run(
             cmdstr,
             array=array,
             cpu_time=cpu_time,
+            cpus=cpus,
             mem=mem,
             account=account,
             partition=partition,
@@ -152,10 +155,12 @@ def run(
         cfg = get_config(config, command=cmd)
             
         if date is not None:
+            # only the number of files per day and ccd is needed here.
+            meta_prop = dict(use_dask=False, columns=["ccdid"], add_filepath=False)
             if to is not None:
-                meta = get_rawmeta("science", [date, to], use_dask=False)
+                meta = get_rawmeta("science", [date, to], **meta_prop)
             else:
-                meta = get_rawmeta("science", date, use_dask=False)
+                meta = get_rawmeta("science", date, **meta_prop)
 
             meta.day = pd.to_datetime(meta.day)
             meta = meta.groupby(["day", "ccdid"]).size().unstack(["ccdid"]).fillna(0)
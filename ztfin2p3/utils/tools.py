@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 from ..io import get_trained_model_path
 
@@ -105,8 +107,14 @@ def get_htm_intersect(ra, dec, radius, depth=7, **kwargs):
     -------
     list of ID (htm ids overlapping with the input circle.)
     """
+    return _get_htm(depth).intersect(ra, dec, radius, **kwargs)
+
+
+@functools.lru_cache
+def _get_htm(depth):
+    """ cached HMpTy.HTM of the given depth """
     from HMpTy import HTM
-    return HTM(depth=depth).intersect(ra, dec, radius, **kwargs)
+    return HTM(depth=depth)
 
 # --------------------------- #
 # - Conversion Tools        - #